@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import queue
+import socket
+import resource
+import itertools
+import multiprocessing
+import numpy as np
+from utils.misc import get_params, write_log
+from utils.resources import mem_available_mb
+from utils.host_profile import TARGETS, load_profile, profile_path, set_threads
+
+BAYESIAN_MODELS = ["BayesianCNN", "EB_BayesianCNN", "LastLayerBayesianCNN"]
+
+
+def model_params(params, params_file):
+    """
+    parameters of a model's params file with the data and the outputs of
+    the autotune block, nothing is written next to the real results.
+    """
+    config = params.autotune
+    model_params = get_params(params_file)
+    for key in ['brands', 'models', 'brand_models', 'patch_dir',
+                'patch_sampling', 'min_patch_score']:
+        setattr(model_params.dataloader, key, getattr(params.dataloader, key))
+    model_params.log.log_dir = config.work_dir
+    model_params.log.log_file = params.log.log_file
+    model_params.log.tensorboard_dir = os.path.join(config.work_dir, 'tensorboard')
+    model_params.trainer.ckpt_dir = os.path.join(config.work_dir, 'ckpts')
+    return model_params
+
+
+def sweep_model(params, params_file, intra_op_threads, inter_op_threads, results):
+    """
+    measure the steps of one model for all batch sizes with one thread
+    setting. It runs in its own process, the threads of tensorflow can only
+    be set before the first op. The batch sizes are measured in increasing
+    order, so that the peak memory of the process after a batch size is
+    what this batch size needs.
+    Args:
+        params: parameters of the autotune command.
+        params_file: params file of the model and its trainer.
+        intra_op_threads, inter_op_threads: thread setting, None for the default.
+        results: queue receiving one result per target and batch size.
+    """
+    from utils.misc import configure_devices, instantiate
+    configure_devices()
+    set_threads(intra_op_threads, inter_op_threads)
+    import tensorflow as tf
+    from utils.data_preparation import build_dataset, num_train_examples
+    config = params.autotune
+    params = model_params(params, params_file)
+    name = params.model.name
+    if name in BAYESIAN_MODELS:
+        model = instantiate("model_lib", name)(params, num_train_examples(params))
+    else:
+        model = instantiate("model_lib", name)(params)
+    model.build(input_shape=(None, params.model.input_shape.height,
+                             params.model.input_shape.width, 1))
+    trainer = instantiate("trainer_lib", params.trainer.name)(params, model)
+    # the step index and writers used by the train steps
+    trainer.tensorboard_init()
+    # the stochastic forward passes of the Monte Carlo experiments
+    if hasattr(model, 'mc_predict'):
+        mc_step = tf.function(lambda images: model.mc_predict(images, config.num_monte_carlo))
+    else:
+        mc_step = tf.function(lambda images: tf.stack(
+                [tf.nn.softmax(model(images)) for _ in range(config.num_monte_carlo)]))
+    # each step returns a tensor to wait for
+    def train_step(images, labels):
+        trainer.train_step(images, labels)
+        return trainer.train_loss.result()
+    def eval_step(images, labels):
+        trainer.eval_step(images, labels)
+        return trainer.eval_loss.result()
+    steps = {'train_step': train_step,
+             'eval_step': eval_step,
+             'mc_inference': lambda images, labels: mc_step(images)}
+    targets = [t for t in config.targets
+               if t != 'mc_inference' or name in BAYESIAN_MODELS]
+    for batch_size in sorted(config.batch_sizes):
+        # one batch of real or synthetic patches, the input pipeline is not measured
+        images, labels = next(build_dataset(params.dataloader.patch_dir,
+                                            params.dataloader.brand_models,
+                                            'test', batch_size))
+        for target in targets:
+            result = {'model': name, 'target': target, 'batch_size': batch_size,
+                      'intra_op_threads': intra_op_threads,
+                      'inter_op_threads': inter_op_threads, 'error': None}
+            try:
+                times = []
+                for i in range(1 + config.repeats):
+                    start = time.perf_counter()
+                    for _ in range(config.steps):
+                        out = steps[target](images, labels)
+                    # wait for the device, ops are dispatched asynchronously
+                    out.numpy()
+                    if i > 0:
+                        times.append(time.perf_counter() - start)
+            except tf.errors.ResourceExhaustedError:
+                result['error'] = 'out of memory'
+                results.put(result)
+                return
+            median = float(np.median(times))
+            draws = config.num_monte_carlo if target == 'mc_inference' else 1
+            # ru_maxrss is in KB on linux
+            result.update(times=times, median_s=median,
+                          patches_per_s=config.steps * batch_size / median,
+                          draws_per_s=config.steps * batch_size * draws / median,
+                          peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+            results.put(result)
+
+
+class Autotuner(object):
+    """
+    sweep the batch sizes and the thread settings of the train step, the
+    eval step and the Monte Carlo inference of each model on this host, and
+    write the fastest configuration within the memory budget to the host
+    profile that the trainers and experiments load.
+    """
+    def __init__(self, params):
+        self.params = params
+        self.config = self.params.autotune
+        self.log_file = self.params.log.log_file
+        self.memory_budget = self.config.memory_budget_mb
+        if self.memory_budget is None:
+            self.memory_budget = mem_available_mb() - self.params.resources.reserve_mb
+
+    def thread_settings(self):
+        """
+        Return:
+            (intra_op_threads, inter_op_threads) pairs, None is the default of
+            tensorflow. Without a list, powers of two up to the number of cores.
+        """
+        intra = self.config.intra_op_threads
+        if intra is None:
+            intra = [None] + [2**i for i in range(os.cpu_count().bit_length())
+                              if 2**i <= os.cpu_count()]
+        return list(itertools.product(intra, self.config.inter_op_threads))
+
+    def prepare_data(self):
+        """
+        point the parameters to the synthetic patches if configured, they are
+        generated once in the work directory.
+        """
+        if self.config.data != 'synthetic':
+            return
+        from benchmarks.synthetic import make_dataset
+        data = make_dataset(self.config.work_dir, self.config.synthetic_scale)
+        self.params.dataloader.brand_models = list(data['brand_models'])
+        self.params.dataloader.brands = data['brands']
+        self.params.dataloader.models = data['models']
+        self.params.dataloader.patch_dir = data['patch_dir']
+
+    def sweep(self):
+        """
+        Return:
+            results: measurements of all models, targets, batch sizes and threads.
+        """
+        # tensorflow is not fork-safe once initialised
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for params_file in self.config.params_files:
+            for intra, inter in self.thread_settings():
+                msg = "... Autotuning {} with intra-op threads {}, inter-op threads {}\n".format(
+                        params_file, intra, inter)
+                write_log(self.log_file, msg)
+                measured = ctx.Queue()
+                process = ctx.Process(target=sweep_model,
+                                      args=(self.params, params_file, intra, inter, measured))
+                process.start()
+                # the results are read while the process runs, the queue
+                # would block it otherwise
+                while process.is_alive() or not measured.empty():
+                    try:
+                        result = measured.get(timeout=1)
+                    except queue.Empty:
+                        continue
+                    results.append(result)
+                    self.log_result(result)
+                process.join()
+                if process.exitcode != 0:
+                    # e.g. killed by the kernel for running out of memory
+                    msg = "!!! Sweep of {} exited with code {}\n".format(
+                            params_file, process.exitcode)
+                    write_log(self.log_file, msg)
+        return results
+
+    def log_result(self, result):
+        if result['error'] is not None:
+            msg = "... {} {} batch size {}: {}\n".format(
+                    result['model'], result['target'], result['batch_size'], result['error'])
+        else:
+            msg = "... {} {} batch size {}: {:.1f} patches/s, peak {:.0f} MB\n".format(
+                    result['model'], result['target'], result['batch_size'],
+                    result['patches_per_s'], result['peak_rss_mb'])
+        write_log(self.log_file, msg)
+
+    def select(self, results):
+        """
+        Return:
+            best: {model: {target: fastest configuration within the memory budget}}.
+        """
+        best = {}
+        for r in results:
+            if r['error'] is not None or r['peak_rss_mb'] > self.memory_budget:
+                continue
+            tuned = best.setdefault(r['model'], {})
+            if r['target'] not in tuned or r['patches_per_s'] > tuned[r['target']]['patches_per_s']:
+                tuned[r['target']] = {k: r[k] for k in ['batch_size', 'intra_op_threads',
+                                                        'inter_op_threads', 'patches_per_s',
+                                                        'draws_per_s', 'peak_rss_mb']}
+        return best
+
+    def write_profile(self, best, results):
+        """
+        merge the tuned models into the profile of the host, the models that
+        were not swept keep their configuration.
+        """
+        profile_dir = self.params.host_profile.profile_dir
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        profile = load_profile(profile_dir) or {'models': {}}
+        for name, tuned in best.items():
+            profile['models'].setdefault(name, {}).update(tuned)
+        profile.update(host=socket.gethostname(), cpu_count=os.cpu_count(),
+                       time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                       data=self.config.data, memory_budget_mb=self.memory_budget)
+        profile['sweep'] = results
+        fname = profile_path(profile_dir)
+        with open(fname, 'w') as f:
+            json.dump(profile, f, indent=4)
+        msg = "... Saved host profile {}\n".format(fname)
+        for name, tuned in best.items():
+            for target in TARGETS:
+                if target in tuned:
+                    msg += "    {} {}: batch size {}, threads {}/{}, {:.1f} patches/s\n".format(
+                            name, target, tuned[target]['batch_size'],
+                            tuned[target]['intra_op_threads'],
+                            tuned[target]['inter_op_threads'],
+                            tuned[target]['patches_per_s'])
+        write_log(self.log_file, msg)
+        return fname
+
+    def run(self):
+        self.prepare_data()
+        results = self.sweep()
+        best = self.select(results)
+        if not best:
+            raise Exception("!!! No configuration fits into {:.0f} MB".format(self.memory_budget))
+        return self.write_profile(best, results)
@@ -0,0 +1,119 @@
+"""
+check utils/metrics.py against sklearn.metrics on random scores, with and
+without ties: the ROC curve, AUROC, AUPR and FPR@95TPR of roc_stats, and
+the count-weighted statistics that bootstrap_ci computes per resample.
+
+    python benchmarks/check_metrics.py
+"""
+import os
+import sys
+import argparse
+import numpy as np
+from sklearn import metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from utils.metrics import SortedScores, curve_stats, merge, roc_stats
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('-n', '--cases', type=int, default=20,
+                            help='number of random cases per setting')
+    argparser.add_argument('--seed', type=int, default=0,
+                            help='random seed of the scores')
+    return argparser.parse_args()
+
+
+def make_scores(rng, tied):
+    """
+    Return:
+        safe, risky: in- and out-of-distribution scores, the risky ones
+                     larger on average. Tied scores are rounded to a few
+                     distinct values, as the max softmax of a confident model.
+    """
+    safe = rng.normal(0, 1, rng.randint(20, 500))
+    risky = rng.normal(1, 1, rng.randint(20, 500))
+    if tied:
+        safe, risky = np.round(safe, 1), np.round(risky, 1)
+    return safe, risky
+
+
+def reference(safe, risky, inverse, weights=None):
+    """
+    the same statistics with sklearn, the risky examples are positive
+    unless inverse.
+    """
+    y_true = np.r_[np.zeros(len(safe)), np.ones(len(risky))]
+    y_score = np.r_[safe, risky]
+    if inverse:
+        y_true = 1 - y_true
+    fpr, tpr, thresholds = metrics.roc_curve(y_true, y_score, sample_weight=weights,
+                                             drop_intermediate=False)
+    return {'fpr': fpr, 'tpr': tpr, 'thresholds': thresholds,
+            'auroc': metrics.roc_auc_score(y_true, y_score, sample_weight=weights),
+            'aupr': metrics.average_precision_score(y_true, y_score,
+                                                    sample_weight=weights),
+            'fpr95': fpr[np.argmax(tpr >= 0.95)]}
+
+
+def check_roc_stats(safe, risky, inverse):
+    """
+    Return:
+        errors: names of the statistics that differ from sklearn.
+    """
+    ours = roc_stats(safe, risky, inverse=inverse)
+    ref = reference(safe, risky, inverse)
+    # the threshold of the starting point (0, 0) is arbitrary
+    ours['thresholds'], ref['thresholds'] = ours['thresholds'][1:], ref['thresholds'][1:]
+    return [k for k in ['fpr', 'tpr', 'thresholds', 'auroc', 'aupr', 'fpr95']
+            if np.shape(ours[k]) != np.shape(ref[k]) or not np.allclose(ours[k], ref[k])]
+
+
+def check_weighted(rng, safe, risky):
+    """
+    statistics of one bootstrap resample, given as counts per example, as
+    bootstrap_ci computes them.
+    """
+    neg, pos = SortedScores(safe), SortedScores(risky)
+    thresholds, neg_idx, pos_idx = merge(neg, pos)
+    neg_weights = rng.multinomial(len(neg), np.full(len(neg), 1. / len(neg)))
+    pos_weights = rng.multinomial(len(pos), np.full(len(pos), 1. / len(pos)))
+    neg_counts = np.bincount(neg_idx, neg_weights, minlength=len(thresholds))
+    pos_counts = np.bincount(pos_idx, pos_weights, minlength=len(thresholds))
+    _, _, auroc, aupr, fpr95 = curve_stats(neg_counts, pos_counts)
+    # SortedScores sorts the examples, the weights belong to the sorted ones
+    ref = reference(neg.scores, pos.scores, False,
+                    weights=np.r_[neg_weights, pos_weights])
+    return [k for k, v in [('auroc', auroc), ('aupr', aupr), ('fpr95', fpr95)]
+            if not np.isclose(v, ref[k])]
+
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(args.seed)
+    failures = 0
+    for tied in [False, True]:
+        for inverse in [False, True]:
+            for case in range(args.cases):
+                safe, risky = make_scores(rng, tied)
+                errors = check_roc_stats(safe, risky, inverse)
+                if errors:
+                    failures += 1
+                    print("!!! roc_stats tied={} inverse={} case {}: {} differ".format(
+                            tied, inverse, case, ", ".join(errors)))
+        for case in range(args.cases):
+            safe, risky = make_scores(rng, tied)
+            errors = check_weighted(rng, safe, risky)
+            if errors:
+                failures += 1
+                print("!!! bootstrap resample tied={} case {}: {} differ".format(
+                        tied, case, ", ".join(errors)))
+    total = 6 * args.cases
+    print("... {} of {} cases match sklearn.metrics".format(total - failures, total))
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+track the results of benchmarks/run.py over time. Runs are kept in a local
+results store, a new run is compared with the stored runs of the same host
+and configuration, run by run:
+
+    python benchmarks/compare.py store results.json
+    python benchmarks/compare.py compare results.json
+    python benchmarks/compare.py history train_step/BayesianCNN
+
+The trials of a run share the state of the host (clock, load, caches), so
+each run is summarised by its median log trial time. A hot path is reported
+as slower if the new run falls outside the prediction interval of the
+stored runs' medians, i.e. the between-run spread, and the slowdown is
+above --min-change.
+"""
+import os
+import sys
+import glob
+import json
+import shutil
+import argparse
+import numpy as np
+from scipy import stats
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORE = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--store', default=STORE,
+                            help='directory of the stored results')
+    subparsers = argparser.add_subparsers(dest='command')
+    store = subparsers.add_parser('store', help='add a run to the results store')
+    store.add_argument('results', help='json output of benchmarks/run.py')
+    compare = subparsers.add_parser('compare', help='compare a run with the stored runs')
+    compare.add_argument('results', help='json output of benchmarks/run.py')
+    compare.add_argument('--baseline', nargs='+', default=None,
+                            help='compare with these runs instead of the stored runs')
+    compare.add_argument('--window', type=int, default=5,
+                            help='number of latest stored runs used as baseline')
+    compare.add_argument('--alpha', type=float, default=0.05,
+                            help='significance level of the test and the intervals')
+    compare.add_argument('--min-change', type=float, default=0.05,
+                            help='smallest relative slowdown that is reported')
+    compare.add_argument('-o', '--output', default=None,
+                            help='json file for the report')
+    history = subparsers.add_parser('history', help='rate of a hot path over the stored runs')
+    history.add_argument('name', help='name of the benchmark, e.g. roc')
+    args = argparser.parse_args()
+    if args.command is None:
+        argparser.error('missing command')
+    return args
+
+
+def load(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+
+def run_key(run):
+    """
+    runs are only comparable on the same host with the same configuration.
+    """
+    config = run['config']
+    return os.path.join(run['environment']['host'],
+                        '{}_s{}_b{}'.format(config['scale'], config['steps'],
+                                            config['batch_size']))
+
+
+def store_run(store_dir, fname):
+    run = load(fname)
+    env = run['environment']
+    out_dir = os.path.join(store_dir, run_key(run))
+    os.makedirs(out_dir, exist_ok=True)
+    name = env['time'].replace('-', '').replace(':', '').replace(' ', '-')
+    if env['commit']:
+        name += '_' + env['commit'][:8]
+    target = os.path.join(out_dir, name + '.json')
+    shutil.copyfile(fname, target)
+    print("... stored {}".format(target))
+    return target
+
+
+def stored_runs(store_dir, run):
+    """
+    stored runs comparable with run, oldest first.
+    """
+    return [load(f) for f in sorted(glob.glob(os.path.join(store_dir, run_key(run), '*.json')))]
+
+
+def rate(name, result, config):
+    """
+    the rate reported for a hot path, from the trial times.
+    Return:
+        values: one per trial.
+        unit: e.g. 'steps/s', 'ms' for the latency of the ROC.
+        higher_is_better: direction of the rate.
+    """
+    times = np.asarray(result['times'])
+    if name.startswith('roc'):
+        return 1000 * times, 'ms', False
+    if name.startswith('train_step') or name.startswith('eval_step'):
+        return config['steps'] / times, 'steps/s', True
+    return result['items'] / times, '{}/s'.format(result['unit']), True
+
+
+def run_median(times):
+    """
+    one value per run, the trials of a run are not independent.
+    """
+    return float(np.median(np.log(times)))
+
+
+def prediction_test(baseline, current, alpha):
+    """
+    t-test of the median log time of the current run against the medians of
+    the baseline runs, with the prediction interval of a new run, and the
+    confidence interval of the speed ratio baseline time / current time,
+    below 1 is slower.
+    Args:
+        baseline: median log trial time of each baseline run.
+        current: median log trial time of the current run.
+    Return:
+        ratio, (lower, upper), p_value. None if there are fewer than two
+        baseline runs.
+    """
+    a = np.asarray(baseline)
+    if len(a) < 2:
+        return None
+    diff = np.mean(a) - current
+    # the spread between runs, and the uncertainty of the baseline mean
+    se = np.std(a, ddof=1) * np.sqrt(1 + 1 / len(a))
+    if se == 0:
+        return float(np.exp(diff)), (float(np.exp(diff)), float(np.exp(diff))), \
+               1.0 if diff == 0 else 0.0
+    df = len(a) - 1
+    p_value = 2 * stats.t.sf(abs(diff / se), df)
+    half = stats.t.ppf(1 - alpha / 2, df) * se
+    return float(np.exp(diff)), (float(np.exp(diff - half)), float(np.exp(diff + half))), \
+           float(p_value)
+
+
+def compare(current, baselines, alpha, min_change):
+    """
+    Args:
+        current: run to check.
+        baselines: runs whose medians are the baseline.
+    Return:
+        report: {name: rates, speed ratio, interval, p-value and verdict}.
+    """
+    report = {}
+    config = current['config']
+    for name, result in current['results'].items():
+        base_runs = [run['results'][name]['times'] for run in baselines
+                     if name in run['results']]
+        values, unit, higher = rate(name, result, config)
+        entry = {'unit': unit, 'current': float(np.median(values)),
+                 'baseline': None, 'speed': None, 'interval': None,
+                 'p_value': None, 'runs': len(base_runs), 'verdict': 'new'}
+        if base_runs:
+            base_values = [np.median(rate(name, dict(result, times=times), config)[0])
+                           for times in base_runs]
+            entry['baseline'] = float(np.median(base_values))
+            test = prediction_test([run_median(times) for times in base_runs],
+                                   run_median(result['times']), alpha)
+            if test is None:
+                entry['verdict'] = 'too few runs'
+            else:
+                speed, interval, p_value = test
+                entry.update(speed=speed, interval=interval, p_value=p_value)
+                if p_value < alpha and speed < 1 - min_change:
+                    entry['verdict'] = 'SLOWER'
+                elif p_value < alpha and speed > 1 + min_change:
+                    entry['verdict'] = 'faster'
+                else:
+                    entry['verdict'] = 'unchanged'
+        report[name] = entry
+    return report
+
+
+def print_report(report, alpha):
+    print("{:<32} {:>12} {:>12} {:<10} {:>8} {:>17} {:>8}  {}".format(
+            'hot path', 'baseline', 'current', 'unit', 'speed',
+            '{:.0%} CI'.format(1 - alpha), 'p', 'verdict'))
+    for name, e in sorted(report.items()):
+        baseline = '-' if e['baseline'] is None else '{:.2f}'.format(e['baseline'])
+        speed = '-' if e['speed'] is None else '{:.3f}'.format(e['speed'])
+        interval = '-' if e['interval'] is None else \
+                   '[{:.3f}, {:.3f}]'.format(*e['interval'])
+        p_value = '-' if e['p_value'] is None else '{:.3f}'.format(e['p_value'])
+        print("{:<32} {:>12} {:>12.2f} {:<10} {:>8} {:>17} {:>8}  {}".format(
+                name, baseline, e['current'], e['unit'], speed, interval,
+                p_value, e['verdict']))
+
+
+def history(store_dir, name):
+    for key in sorted(glob.glob(os.path.join(store_dir, '*', '*'))):
+        print(os.path.relpath(key, store_dir))
+        for fname in sorted(glob.glob(os.path.join(key, '*.json'))):
+            run = load(fname)
+            if name not in run['results']:
+                continue
+            values, unit, _ = rate(name, run['results'][name], run['config'])
+            print("  {:<20} {:<10} {:>12.2f} {}".format(
+                    run['environment']['time'], str(run['environment']['commit'])[:8],
+                    np.median(values), unit))
+
+
+def main():
+    args = get_args()
+    if args.command == 'store':
+        store_run(args.store, args.results)
+    elif args.command == 'history':
+        history(args.store, args.name)
+    else:
+        current = load(args.results)
+        if args.baseline is not None:
+            baselines = [load(fname) for fname in args.baseline]
+        else:
+            # the run itself may already be stored
+            baselines = [run for run in stored_runs(args.store, current)
+                         if run['environment'] != current['environment']][-args.window:]
+        if not baselines:
+            print("... no baseline, store a run first")
+        report = compare(current, baselines, args.alpha, args.min_change)
+        print_report(report, args.alpha)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=4)
+        # a non-zero exit status lets scripts stop on slowdowns
+        if any(e['verdict'] == 'SLOWER' for e in report.values()):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+startup time of the subcommands of main.py, each measured in a fresh
+interpreter: the imports of the old entry point (train and experiment
+eagerly) against the modules each subcommand imports now, as well as the
+imports of the worker processes (experiment scheduler, plot rendering).
+"""
+import os
+import sys
+import ast
+import json
+import argparse
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def command_modules():
+    """
+    modules imported lazily by each subcommand, read from the functions of
+    main.py and the functions of main.py they call.
+    Return:
+        modules: {command: [module]}.
+    """
+    with open(os.path.join(ROOT, 'main.py')) as f:
+        tree = ast.parse(f.read())
+    functions = {node.name: node for node in tree.body
+                 if isinstance(node, ast.FunctionDef)}
+    commands = [node.value for node in tree.body if isinstance(node, ast.Assign)
+                and [t.id for t in node.targets] == ['COMMANDS']][0]
+
+    def imports(name, seen):
+        seen.add(name)
+        modules = []
+        for node in ast.walk(functions[name]):
+            if isinstance(node, ast.ImportFrom):
+                modules.append(node.module)
+            elif isinstance(node, ast.Import):
+                modules.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                if node.func.id in functions and node.func.id not in seen:
+                    modules.extend(imports(node.func.id, seen))
+                # e.g. instantiate("dataloader_lib", name)
+                elif node.func.id == 'instantiate':
+                    modules.append(ast.literal_eval(node.args[0]))
+        return modules
+
+    return {ast.literal_eval(key): sorted(set(imports(value.id, set())))
+            for key, value in zip(commands.keys, commands.values)}
+
+# statements that are timed, the old entry point imported both modules
+CASES = [('main.py (eager, before)', 'import train, experiment'),
+         ('main.py --help', 'import main')]
+CASES += [('main.py ' + command, 'import main; ' +
+           '; '.join('import ' + m for m in modules))
+          for command, modules in sorted(command_modules().items())]
+CASES += [('plot worker', 'import utils.visualization'),
+          ('plot worker (render)', 'import utils.visualization; '
+                                   'import matplotlib.pyplot, seaborn, pandas')]
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--repeats', type=int, default=5,
+                            help='number of interpreters per case')
+    argparser.add_argument('-o', '--output', default=None,
+                            help='json file for the results')
+    return argparser.parse_args()
+
+
+def import_time(statement, repeats):
+    """
+    wall time of starting an interpreter and running statement, in seconds.
+    Return:
+        times: one per repeat, None if the statement failed.
+    """
+    times = []
+    for _ in range(repeats):
+        process = subprocess.run(
+            [sys.executable, '-c',
+             'import time; t = time.perf_counter(); {}; '
+             'print(time.perf_counter() - t)'.format(statement)],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            return None
+        times.append(float(process.stdout.decode().strip().splitlines()[-1]))
+    return times
+
+
+def main():
+    args = get_args()
+    results = {}
+    print("{:<32} {:>10} {:>10}".format('case', 'median s', 'min s'))
+    for name, statement in CASES:
+        times = import_time(statement, args.repeats)
+        results[name] = {'statement': statement, 'times': times}
+        if times is None:
+            print("{:<32} {:>10}".format(name, 'failed'))
+            continue
+        print("{:<32} {:>10.3f} {:>10.3f}".format(name, np.median(times),
+                                                  np.min(times)))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+throughput of the hot paths on synthetic data: patch extraction,
+degradation, input pipeline, train/eval steps of each model, Monte Carlo
+statistics, uncertainty and ROC. Runs on CPU without network access, the
+results are written to a json file to compare runs.
+
+    python benchmarks/run.py --scale small --output results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from utils.misc import configure_devices, get_params
+from benchmarks.synthetic import SCALES, make_dataset
+
+# models whose train_step/eval_step are measured, with their params file
+MODELS = [('VanillaCNN', 'vanilla_cnn'),
+          ('BayesianCNN', 'bayesian_cnn'),
+          ('LastLayerBayesianCNN', 'last_layer_bayesian_cnn')]
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                            help='size of the synthetic dataset')
+    argparser.add_argument('--work-dir', default='benchmarks/work',
+                            help='directory of the synthetic data and outputs')
+    argparser.add_argument('--repeats', type=int, default=3,
+                            help='number of timed trials of each benchmark')
+    argparser.add_argument('--steps', type=int, default=10,
+                            help='number of steps/batches per trial')
+    argparser.add_argument('--batch-size', type=int, default=16,
+                            help='batch size of the input pipeline and the steps')
+    argparser.add_argument('--only', nargs='*', default=None,
+                            choices=[group for group, _ in BENCHMARKS],
+                            help='run only these groups of benchmarks')
+    argparser.add_argument('-o', '--output', default=None,
+                            help='json file for the results')
+    return argparser.parse_args()
+
+
+def load_params(name, data, work_dir):
+    """
+    parameters of params/<name>.json pointing to the synthetic data, all
+    outputs go to work_dir.
+    """
+    params = get_params(os.path.join(ROOT, 'params', name + '.json'))
+    params.dataloader.brands = data['brands']
+    params.dataloader.models = data['models']
+    params.dataloader.brand_models = list(data['brand_models'])
+    params.dataloader.database_image_dir = data['image_dir']
+    params.dataloader.patch_dir = data['patch_dir']
+    params.log.log_dir = os.path.join(work_dir, 'logs')
+    params.log.log_file = os.path.join(work_dir, 'logs', name + '.log')
+    if hasattr(params.log, 'tensorboard_dir'):
+        params.log.tensorboard_dir = os.path.join(work_dir, 'tensorboard')
+    if hasattr(params, 'trainer'):
+        params.trainer.ckpt_dir = os.path.join(work_dir, 'ckpts', name)
+    # only the plot data is saved, figures are not part of the hot paths
+    params.plot.mode = 'lazy'
+    os.makedirs(params.log.log_dir, exist_ok=True)
+    return params
+
+
+def measure(fn, repeats, items, unit, setup=None, warmup=1):
+    """
+    time fn in repeated trials, setup runs before each trial and is not timed.
+    Args:
+        items: number of items processed by one call of fn.
+        unit: name of the items, e.g. 'images'.
+        warmup: number of untimed trials, e.g. for tracing tf.functions.
+    Return:
+        result: trial times, median and throughput (items/s of the median).
+    """
+    times = []
+    for i in range(warmup + repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    return {'times': times, 'median_s': median, 'items': items, 'unit': unit,
+            'throughput': items / median if median > 0 else None}
+
+
+def bench_extract_patch(data, args):
+    from utils.patch import extract_patch
+    patch_dir = os.path.join(args.work_dir, 'extract')
+    setup = lambda: shutil.rmtree(patch_dir, ignore_errors=True)
+    fn = lambda: extract_patch(data['img_paths'], 'test', patch_dir, 25, 1280)
+    yield 'extract_patch', measure(fn, args.repeats, len(data['img_paths']),
+                                   'images', setup=setup, warmup=0)
+
+
+def bench_degradate(data, args):
+    from utils.data_preparation import degradate
+    img_paths = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(os.path.join(data['patch_dir'], 'test'))
+                       for name in names)
+    img_root = os.path.join(args.work_dir, 'degradation')
+    setup = lambda: shutil.rmtree(img_root, ignore_errors=True)
+    for degradation_id, factor in [('jpeg', 70), ('blur', 1.1), ('noise', 0.1)]:
+        fn = lambda: degradate(img_paths, img_root, 'synthetic', degradation_id, factor)
+        yield 'degradate/' + degradation_id, measure(fn, args.repeats, len(img_paths),
+                                                     'patches', setup=setup, warmup=0)
+
+
+def bench_build_dataset(data, args):
+    from utils.data_preparation import build_dataset
+    for ds_id in ['train', 'test']:
+        iterator = iter(build_dataset(data['patch_dir'], data['brand_models'],
+                                      ds_id, args.batch_size))
+        def fn():
+            for _ in range(args.steps):
+                next(iterator)
+        yield 'build_dataset/' + ds_id, measure(fn, args.repeats,
+                                                args.steps * args.batch_size, 'patches')
+
+
+def model_and_trainer(name, params_name, data, args):
+    from utils.misc import instantiate
+    from utils.data_preparation import num_train_examples
+    params = load_params(params_name, data, args.work_dir)
+    if name in ["BayesianCNN", "LastLayerBayesianCNN"]:
+        model = instantiate("model_lib", name)(params, num_train_examples(params))
+    else:
+        model = instantiate("model_lib", name)(params)
+    model.build(input_shape=(None, 256, 256, 1))
+    trainer = instantiate("trainer_lib", params.trainer.name)(params, model)
+    # writers and the step index used by the train steps
+    trainer.tensorboard_init()
+    return params, model, trainer
+
+
+def synthetic_batch(data, batch_size, seed=0):
+    import tensorflow as tf
+    rng = np.random.RandomState(seed)
+    images = tf.constant(rng.uniform(size=(batch_size, 256, 256, 1)), tf.float32)
+    labels = tf.one_hot(rng.randint(len(data['brand_models']), size=batch_size),
+                        len(data['brand_models']))
+    return images, labels
+
+
+def bench_steps(data, args):
+    images, labels = synthetic_batch(data, args.batch_size)
+    for name, params_name in MODELS:
+        _, _, trainer = model_and_trainer(name, params_name, data, args)
+        def train():
+            for _ in range(args.steps):
+                trainer.train_step(images, labels)
+        def evaluate():
+            for _ in range(args.steps):
+                trainer.eval_step(images, labels)
+        yield 'train_step/' + name, measure(train, args.repeats,
+                                            args.steps * args.batch_size, 'patches')
+        yield 'eval_step/' + name, measure(evaluate, args.repeats,
+                                           args.steps * args.batch_size, 'patches')
+
+
+def bench_mc_stats(data, args):
+    from utils.misc import instantiate
+    from utils.data_preparation import build_dataset
+    from experiment_lib import MCStats
+    params = load_params('experiment', data, args.work_dir)
+    params.dataloader.batch_size = args.batch_size
+    model = instantiate("model_lib", params.mc_stats.model)(params, 1)
+    stats = MCStats(params, model)
+    num_monte_carlo = params.mc_stats.num_monte_carlo
+    iterator = iter(build_dataset(data['patch_dir'], data['brand_models'],
+                                  'test', args.batch_size))
+    # one draw is one stochastic forward pass of a patch
+    yield 'mc_stats', measure(lambda: stats.mc_stats(iterator, num_monte_carlo, args.steps),
+                              args.repeats, args.steps * args.batch_size * num_monte_carlo,
+                              'draws')
+    # the aligned test set of the experiments has a few thousand patches
+    rng = np.random.RandomState(0)
+    mc_softmax_prob = rng.dirichlet(np.ones(len(data['brand_models'])),
+                                    size=(num_monte_carlo, 5000))
+    yield 'image_uncertainty', measure(lambda: stats.image_uncertainty(mc_softmax_prob),
+                                       args.repeats, 5000, 'patches')
+
+
+def bench_roc(data, args):
+    from experiment_lib import Experiment
+    params = load_params('experiment', data, args.work_dir)
+    experiment = Experiment(params)
+    rng = np.random.RandomState(0)
+    safe, risky = rng.normal(0, 1, 20000), rng.normal(1, 1, 20000)
+    # different scores each trial, so that the sorted scores are not cached
+    fn = lambda: experiment.roc(safe + rng.normal(0, 1e-6, len(safe)), risky)
+    yield 'roc', measure(fn, args.repeats, len(safe) + len(risky), 'scores')
+    params.experiment.bootstrap_resamples = 1000
+    yield 'roc/bootstrap', measure(fn, args.repeats, len(safe) + len(risky), 'scores')
+
+
+BENCHMARKS = [('extract_patch', bench_extract_patch),
+              ('degradate', bench_degradate),
+              ('build_dataset', bench_build_dataset),
+              ('steps', bench_steps),
+              ('mc_stats', bench_mc_stats),
+              ('roc', bench_roc)]
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                                ).stdout.decode().strip()
+    except OSError:
+        commit = None
+    import tensorflow as tf
+    return {'host': socket.gethostname(), 'python': platform.python_version(),
+            'tensorflow': tf.__version__, 'cpu_count': os.cpu_count(),
+            'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main():
+    args = get_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    configure_devices()
+    data = make_dataset(args.work_dir, args.scale)
+    report = {'environment': environment(),
+              'config': {'scale': args.scale, 'repeats': args.repeats,
+                         'steps': args.steps, 'batch_size': args.batch_size},
+              'results': {}}
+    for group, bench in BENCHMARKS:
+        if args.only and group not in args.only:
+            continue
+        for name, result in bench(data, args):
+            report['results'][name] = result
+            print("{:<36} {:>10.4f} s {:>12.1f} {}/s".format(
+                    name, result['median_s'], result['throughput'], result['unit']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == '__main__':
+    main()
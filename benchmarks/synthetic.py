@@ -0,0 +1,116 @@
+"""
+synthetic camera data in the on-disk layout of the project, so that the
+benchmarks run without the Dresden database, network access or a GPU.
+Each synthetic camera model adds its own fixed noise pattern (similar to a
+sensor fingerprint) to smooth random scenes.
+"""
+import os
+import zlib
+import numpy as np
+from skimage import io
+
+# number of full-sized images and patches per camera model
+SCALES = {'small': {'num_models': 3, 'images_per_model': 2,
+                    'patches_per_model': {'train': 64, 'val': 16, 'test': 16}},
+          'medium': {'num_models': 5, 'images_per_model': 8,
+                     'patches_per_model': {'train': 256, 'val': 64, 'test': 64}},
+          'large': {'num_models': 5, 'images_per_model': 32,
+                    'patches_per_model': {'train': 1024, 'val': 256, 'test': 256}}}
+# size of the full-sized images, large enough for an extract_span of 1280
+IMAGE_SHAPE = (1536, 2048)
+
+
+def brand_models(num_models):
+    brands = ['Synthetic'] * num_models
+    models = ['Cam{}'.format(i) for i in range(num_models)]
+    return brands, models
+
+
+def sensor_pattern(brand_model, shape):
+    """
+    fixed noise pattern of a camera model.
+    """
+    rng = np.random.RandomState(zlib.crc32(brand_model.encode()))
+    pattern = rng.normal(0, 3., size=(64, 64))
+    reps = (shape[0] // 64 + 1, shape[1] // 64 + 1)
+    return np.tile(pattern, reps)[:shape[0], :shape[1]]
+
+
+def scene(rng, shape):
+    """
+    smooth random content, a few gradients and sinusoids.
+    """
+    y, x = np.meshgrid(np.linspace(0, 1, shape[0]),
+                       np.linspace(0, 1, shape[1]), indexing='ij')
+    img = 128 + 60 * (rng.uniform(-1, 1) * x + rng.uniform(-1, 1) * y)
+    for _ in range(3):
+        fy, fx = rng.uniform(1, 8, size=2)
+        img += 20 * np.sin(2 * np.pi * (fy * y + fx * x) + rng.uniform(0, 2 * np.pi))
+    return img
+
+
+def camera_image(rng, brand_model, shape):
+    img = scene(rng, shape) + sensor_pattern(brand_model, shape) \
+          + rng.normal(0, 2., size=shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_images(image_dir, brand_models, images_per_model, shape=IMAGE_SHAPE, seed=42):
+    """
+    full-sized RGB JPEGs, 'image_dir/<brand_model>/<brand_model>_<i>.JPG'.
+    Return:
+        img_paths: paths of the images.
+    """
+    rng = np.random.RandomState(seed)
+    img_paths = []
+    for m in brand_models:
+        os.makedirs(os.path.join(image_dir, m), exist_ok=True)
+        for i in range(images_per_model):
+            green = camera_image(rng, m, shape)
+            img = np.stack([np.clip(green.astype(np.int16) + d, 0, 255).astype(np.uint8)
+                            for d in [6, 0, -6]], axis=-1)
+            path = os.path.join(image_dir, m, '{}_{}.JPG'.format(m, i))
+            io.imsave(path, img, plugin='pil', quality=92, check_contrast=False)
+            img_paths.append(path)
+    return img_paths
+
+
+def make_patches(patch_dir, brand_models, patches_per_model, seed=42):
+    """
+    256 x 256 grayscale PNG patches,
+    'patch_dir/<split>/<brand_model>/<brand_model>_<i>_<j>.png'.
+    Args:
+        patches_per_model: number of patches of each split, e.g. {'train': 64}.
+    """
+    rng = np.random.RandomState(seed)
+    for ds_id, num_patches in patches_per_model.items():
+        for m in brand_models:
+            out_dir = os.path.join(patch_dir, ds_id, m)
+            os.makedirs(out_dir, exist_ok=True)
+            for i in range(num_patches):
+                path = os.path.join(out_dir, '{}_{}_{:02}.png'.format(m, i // 25, i % 25))
+                io.imsave(path, camera_image(rng, m, (256, 256)), check_contrast=False)
+
+
+def make_dataset(work_dir, scale, seed=42):
+    """
+    generate the synthetic dataset once, it is reused if it exists.
+    Return:
+        data: dict of brands, models, brand_models, image_dir, patch_dir and img_paths.
+    """
+    config = SCALES[scale]
+    brands, models = brand_models(config['num_models'])
+    names = ['_'.join([b, m]) for b, m in zip(brands, models)]
+    root = os.path.join(work_dir, 'data_' + scale)
+    image_dir = os.path.join(root, 'synthetic')
+    patch_dir = os.path.join(root, 'synthetic_base')
+    done = os.path.join(root, '.done')
+    if not os.path.exists(done):
+        make_images(image_dir, names, config['images_per_model'], seed=seed)
+        make_patches(patch_dir, names, config['patches_per_model'], seed=seed)
+        open(done, 'w').close()
+    img_paths = sorted(os.path.join(image_dir, m, name)
+                       for m in names
+                       for name in os.listdir(os.path.join(image_dir, m)))
+    return {'brands': brands, 'models': models, 'brand_models': names,
+            'image_dir': image_dir, 'patch_dir': patch_dir, 'img_paths': img_paths}
@@ -8,6 +8,7 @@ from skimage import io
 from tqdm import tqdm, trange
 from utils.misc import write_log
 from utils.patch import extract_patch
+from utils.data_preparation import train_image_list
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
@@ -61,90 +62,125 @@ class DresdenDataLoader(BaseDataLoader):
         self.images_dir = self.params.dataloader.database_image_dir
         self.num_cls = len(self.brand_models)
 
-    def collect_dataset(self):
-        """Download data from the input csv to specific directory.
-        Args:
-            data: a csv file storing the dataset with filename, 
-                    model, brand and etc.
-            images_dir: target root directory for the downloaded images.
-            brand_models: the brand_model name of the target images.
+    def dataset_rows(self):
+        """
+        rows of the database csv for the targeted camera models.
         Return:
-            saved files in the directory images_dir.
-            For example: 'image_dir/brand_model/filname.jpg'.
+            rows: list of (image path, url).
         """
-        csv_rows = []
-        dirs = [os.path.join(self.images_dir, d) 
-                for d in self.brand_models]
-        download = False
-        if not os.path.exists(self.images_dir):
-            download = True
-        for path in dirs:
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-        # collect data if not downloaded
+        rows = []
         data = pd.read_csv(self.params.dataloader.database_csv)
         data = data[([m in self.models 
                     for m in data['model']])]
         data = data[['filename', 'brand', 'model', 'url']]
         for i in range((data.shape[0])): 
-            csv_rows.append(list(data.iloc[i, :]))
-
-        for csv_row in tqdm(csv_rows):
-            filename, brand, model = csv_row[0:3]
-            url = csv_row[-1]
+            filename, brand, model = list(data.iloc[i, :])[0:3]
+            url = data.iloc[i, -1]
             brand_model = '_'.join([brand, model])
             img_path = os.path.join(
                 self.images_dir,
                 brand_model, 
                 filename)
-            if download:
+            rows.append((img_path, url))
+        return rows
+
+    def download(self):
+        """
+        download the images in the database csv that are missing in images_dir.
+        saved files in the directory images_dir, 
+        for example: 'image_dir/brand_model/filname.jpg'.
+        """
+        for path in [os.path.join(self.images_dir, d) 
+                     for d in self.brand_models]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        for img_path, url in tqdm(self.dataset_rows()):
+            if not os.path.exists(img_path):
+                filename = os.path.split(img_path)[-1]
+                tqdm.write('Downloading {:}'.format(filename))
                 try:
-                    if not os.path.exists(img_path):
-                        tqdm.write('Downloading {:}'.format(filename))
-                        urllib.request.urlretrieve(url, img_path)
-                    # Load the image and check its dimensions
-                    img = io.imread(img_path)
-                    if img is None or not isinstance(img, np.ndarray):
-                        print('Unable to read image: {:}'.format(filename))
-                        # removes (deletes) the file path
-                        os.unlink(img_path)
-                    # if the size of all images are not zero, then append to the list
-                    if all(img.shape[:2]):
-                        self.img_path_ls.append(img_path)
-                    else:
-                        print('Zero-sized image: {:}'.format(filename))
-                        os.unlink(img_path)
+                    urllib.request.urlretrieve(url, img_path)
                 except IOError:
-                    print('Unable to decode: {:}'.format(filename))
-                    os.unlink(img_path)
-                except Exception as e:
-                    print('Error while loading: {:}'.format(filename))
+                    print('Unable to download: {:}'.format(filename))
                     if os.path.exists(img_path):
                         os.unlink(img_path)
-            else:
-                self.img_path_ls.append(img_path)
+
+    def validate(self):
+        """
+        decode the downloaded images, delete the ones that cannot be decoded 
+        or are zero-sized, and keep the others in img_path_ls.
+        """
+        self.img_path_ls = []
+        for img_path, _ in tqdm(self.dataset_rows()):
+            filename = os.path.split(img_path)[-1]
+            if not os.path.exists(img_path):
+                continue
+            try:
+                # Load the image and check its dimensions
+                img = io.imread(img_path)
+                if img is None or not isinstance(img, np.ndarray):
+                    print('Unable to read image: {:}'.format(filename))
+                    # removes (deletes) the file path
+                    os.unlink(img_path)
+                # if the size of all images are not zero, then append to the list
+                elif all(img.shape[:2]):
+                    self.img_path_ls.append(img_path)
+                else:
+                    print('Zero-sized image: {:}'.format(filename))
+                    os.unlink(img_path)
+            except IOError:
+                print('Unable to decode: {:}'.format(filename))
+                os.unlink(img_path)
+            except Exception as e:
+                print('Error while loading: {:}'.format(filename))
+                if os.path.exists(img_path):
+                    os.unlink(img_path)
         msg = 'Number of images: {:}\n'.format(len(self.img_path_ls))
         write_log(self.log_file, msg)
 
-    def load_data(self):
+    def collect_dataset(self):
+        """Download data from the input csv to specific directory.
+        Args:
+            data: a csv file storing the dataset with filename, 
+                    model, brand and etc.
+            images_dir: target root directory for the downloaded images.
+            brand_models: the brand_model name of the target images.
+        Return:
+            saved files in the directory images_dir.
+            For example: 'image_dir/brand_model/filname.jpg'.
         """
-        load data, split data into train, validation and test set, and then extract the 256*256 patches
-        from images' green channel.
+        # collect data if not downloaded
+        if not os.path.exists(self.images_dir):
+            self.download()
+            self.validate()
+        else:
+            self.img_path_ls = [img_path for img_path, _ in self.dataset_rows()]
+            msg = 'Number of images: {:}\n'.format(len(self.img_path_ls))
+            write_log(self.log_file, msg)
+
+    def extract(self):
         """
-        # download images
-        self.collect_dataset()
-        # split into train, val and test 
-        self.split_dataset(self.params.dataloader.random_seed)
+        extract the 256*256 patches from images' green channel of the split. 
+        If the training patches are sampled on the fly, only the list of 
+        training images is saved.
+        """
+        random_sampling = self.params.dataloader.patch_sampling == 'random'
+        if random_sampling:
+            if not os.path.exists(self.params.dataloader.patch_dir):
+                os.makedirs(self.params.dataloader.patch_dir)
+            with open(train_image_list(self.params.dataloader.patch_dir), 'w') as f:
+                for i in range(self.num_cls):
+                    f.writelines(path + '\n' for path in self.split_ds[i][0])
         for i in range(self.num_cls):
             print("... Extracting patches from {} images\n"
                     .format(self.brand_models[i]))
-            extract_patch(
-                img_path_ls=self.split_ds[i][0], 
-                ds_id='train', 
-                patch_dir=self.params.dataloader.patch_dir,
-                num_patch=self.params.dataloader.num_patch,
-                extract_span=self.params.dataloader.extract_span)
+            if not random_sampling:
+                extract_patch(
+                    img_path_ls=self.split_ds[i][0], 
+                    ds_id='train', 
+                    patch_dir=self.params.dataloader.patch_dir,
+                    num_patch=self.params.dataloader.num_patch,
+                    extract_span=self.params.dataloader.extract_span)
             extract_patch(
                 img_path_ls=self.split_ds[i][1], 
                 ds_id='val', 
@@ -159,6 +195,17 @@ class DresdenDataLoader(BaseDataLoader):
                 extract_span=self.params.dataloader.extract_span)
             print("... Done\n")
 
+    def load_data(self):
+        """
+        load data, split data into train, validation and test set, and then extract the 256*256 patches
+        from images' green channel.
+        """
+        # download images
+        self.collect_dataset()
+        # split into train, val and test 
+        self.split_dataset(self.params.dataloader.random_seed)
+        self.extract()
+
 
 class UnseenDresdenDataLoader(DresdenDataLoader):
     """
@@ -1,57 +1,122 @@
-import os
 import numpy as np
 import tensorflow as tf
-from utils.data_preparation import build_dataset, post_processing
-from utils.misc import instantiate, write_log
-from experiment_lib import SoftmaxStats, MCStats, MultiMCStats, EnsembleStats, MCDegradationStats
+from utils.data_preparation import build_dataset, num_train_examples, post_processing
+from utils.misc import configure_devices, instantiate, write_log
+from utils.visualization import configure_plotting
+from utils.resources import configure_resources
+from utils.host_profile import apply_host_profile, set_threads
+from experiment_lib import DatasetContext, SoftmaxStats, MCStats, MultiMCStats, EnsembleStats, MCDegradationStats, \
+                        MCCascadeStats, PruningStats, QuantizationStats, StudentStats, \
+                        ImageLevelStats
+from scheduler_lib import ExperimentScheduler
+
+# experiments in order of execution, with their class and the config block
+# naming the model. Experiments with the same config block share the model.
+EXPERIMENTS = [
+    # softmax statistics and ensemble use the vanilla CNN
+    ('softmax_stats', SoftmaxStats, 'softmax_stats'),
+    ('ensemble_stats', EnsembleStats, 'softmax_stats'),
+    # other experiments use the BNN.
+    ('mc_stats', MCStats, 'mc_stats'),
+    ('multi_mc_stats', MultiMCStats, 'mc_stats'),
+    ('mc_degradation_stats', MCDegradationStats, 'mc_stats'),
+    ('mc_cascade_stats', MCCascadeStats, 'mc_stats'),
+    ('pruning_stats', PruningStats, 'mc_stats'),
+    # the student distilled from the ensemble or the BNN
+    ('student_stats', StudentStats, 'student_stats'),
+    # image-level decisions with early exit across patches
+    ('image_level_stats', ImageLevelStats, None),
+    # post-training quantisation of the vanilla CNN or the posterior mean of the BNN
+    ('quantization_stats', QuantizationStats, 'quantization_stats')]
+
+
+def build_model(params, model_config):
+    """
+    instantiate the model named in the config block.
+    """
+    model_name = getattr(params, model_config).model
+    if model_name in ["BayesianCNN", "EB_BayesianCNN", "LastLayerBayesianCNN"]:
+        examples_per_epoch = num_train_examples(params)
+        return instantiate("model_lib", model_name)(params, examples_per_epoch)
+    return instantiate("model_lib", model_name)(params)
+
+
+def run_experiment(params, name, intra_op_threads=None, inter_op_threads=None,
+                   context=None, models=None):
+    """
+    run a single experiment.
+    Args:
+        params: parameters from the json file.
+        name: name of the experiment, e.g. 'mc_stats'.
+        intra_op_threads, inter_op_threads: thread budget of tensorflow,
+                                            set when running in its own process.
+        context: DatasetContext shared with other experiments.
+        models: dict of the models shared with other experiments.
+    """
+    # experiments started by the scheduler run in a spawned process
+    configure_devices()
+    configure_plotting(params)
+    configure_resources(params)
+    set_threads(intra_op_threads, inter_op_threads)
+    if context is None:
+        context = DatasetContext(params)
+    if models is None:
+        models = {}
+    _, cls, model_config = [e for e in EXPERIMENTS if e[0] == name][0]
+    if model_config is None:
+        stats = cls(params, context)
+    else:
+        if model_config not in models:
+            models[model_config] = build_model(params, model_config)
+        stats = cls(params, models[model_config], context)
+    stats.experiment()
+
+
+def degradations(params, names):
+    """
+    (name, factor) of the degraded sets used by the experiments.
+    """
+    pairs = []
+    for name in names:
+        config = getattr(params, name)
+        if not hasattr(config, 'degradation_id'):
+            continue
+        ids, factors = config.degradation_id, config.degradation_factor
+        # mc_degradation_stats has a list for each level of degradation
+        if ids and isinstance(ids[0], list):
+            ids = [i for level in ids for i in level]
+            factors = [f for level in factors for f in level]
+        for pair in zip(ids, factors):
+            if pair not in pairs:
+                pairs.append(pair)
+    return pairs
+
 
 def experiment(params):
     """
     perfome experiments.
     """
+    configure_devices()
+    configure_resources(params)
+    # batch size and threads found by the autotune command on this host
+    threads = apply_host_profile(params, 'experiment')
     msg = "... Preparing dataset for statistics experiment\n"
     write_log(params.log.log_file, msg)
-    
-    # prepare unseen data from Dresden and Kaggle dataset
-    for b, m in zip(params.unseen_dataloader.brands, 
-                    params.unseen_dataloader.models):
-        params.unseen_dataloader.brand_models.append("_".join([b, m]))
-    params.kaggle_dataloader.brand_models = os.listdir(
-                        params.kaggle_dataloader.database_image_dir)
-
-    unseen_dataloader = instantiate("dataloader_lib", 
-                    params.unseen_dataloader.name)(params)
-    kaggle_dataloader = instantiate("dataloader_lib", 
-                    params.kaggle_dataloader.name)(params)
-    unseen_dataloader.load_data()
-    kaggle_dataloader.load_data()
-
-    # softmax statistics and ensemble use the vanilla CNN
-    if params.experiment.softmax_stats or params.experiment.ensemble_stats:
-        model = instantiate("model_lib",
-                    params.softmax_stats.model)(params)
-        if params.experiment.softmax_stats:
-            softmax_stats = SoftmaxStats(params, model)
-            softmax_stats.experiment()
-        if params.experiment.ensemble_stats:
-            ensemble_stats = EnsembleStats(params, model)
-            ensemble_stats.experiment()
+    # aligned sets, unseen data from Dresden and Kaggle dataset and degraded 
+    # sets are prepared once, when the first experiment needs them.
+    context = DatasetContext(params)
+    names = [name for name, _, _ in EXPERIMENTS 
+             if getattr(params.experiment, name)]
 
-    # other experiments use the BNN.
-    if params.experiment.mc_stats or params.experiment.multi_mc_stats or params.experiment.mc_degradation_stats:
-        examples_per_epoch = 0
-        for m in params.dataloader.brand_models:
-            examples_per_epoch += len(os.listdir(os.path.join(
-                                    params.dataloader.patch_dir, 
-                                    "train", m)))
-        model = instantiate("model_lib",
-                    params.mc_stats.model)(params, examples_per_epoch)
-        if params.experiment.mc_stats:
-            mc_stats = MCStats(params, model)
-            mc_stats.experiment()
-        if params.experiment.multi_mc_stats:
-            multi_mc_stats = MultiMCStats(params, model)
-            multi_mc_stats.experiment()
-        if params.experiment.mc_degradation_stats:
-            mc_degradation_stats = MCDegradationStats(params, model)
-            mc_degradation_stats.experiment()
\ No newline at end of file
+    if params.scheduler.parallel and len(names) > 1:
+        # the data on disk is prepared here, so that the processes only read it
+        context.prepare(degradations(params, names))
+        scheduler = ExperimentScheduler(params, run_experiment)
+        scheduler.run(names)
+    else:
+        # the processes of the scheduler use its thread budget instead
+        if threads is not None:
+            set_threads(*threads)
+        models = {}
+        for name in names:
+            run_experiment(params, name, context=context, models=models)
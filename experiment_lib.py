@@ -1,72 +1,245 @@
 import os
+import json
+import time
 import numpy as np
 import tensorflow as tf
-import sklearn.metrics as sk
 from functools import partial
 from tqdm import trange
-from utils.misc import write_log
-from utils.data_preparation import build_dataset, degradate, parse_image
+from utils.misc import instantiate, write_log
+from utils.data_preparation import build_dataset, dataset_cache, degradate, parse_image
+from utils.patch import read_manifest
+from utils.metrics import bootstrap_ci, optimal_threshold, roc_stats
+from utils.resources import stage
 from utils.visualization import histogram, plot_curve, plot_held_out
+from export_lib import TFLiteExporter, TFLiteModel
+from pruning_lib import SNRPruner, count_params
+from inference_lib import ImageClassifier, build_predictor
+from skimage import io
 keras = tf.keras
 
-class Experiment(object):
+def aligned_dataset(patch_dir, brand_models, batch_size=64,
+                    num_batches=None, seed=42):
+    """
+    set a fix subset of total test dataset, so that:
+    1. each class has same size of test images (ROC curve
+       is sensitive to class imbalance)
+    2. each monte carlo draw has the same images as input
+    3. random seed controls the how to sample this subset
+    Args:
+        patch_dir: directory storing patches.
+        brand_models: name of camera models for testing.
+        batch_size: batch size for testing.
+        num_batches: the number of batches from test dataset,
+                     use this number to determine the number of 
+                     batches of unseen dataset.
+        seed: random seed controls the sampling process 
+              from the overall test set.
+    """
+    # default for 'test' data
+    np.random.seed(seed)
+    image_paths, num_images, img_paths = [], [], []
+    for model in brand_models:
+        images = os.listdir(os.path.join(patch_dir, model))
+        paths = [os.path.join(patch_dir, model, img) for img in images]
+        image_paths.append(paths)
+        num_images.append(len(images))
+    # number of batches for one class
+    class_batches = min(num_images) // batch_size
+    num_test_batches = len(brand_models) * class_batches
+    # sometimes database has more data in 'test', some has more in 'unseen'
+    if num_batches is not None:
+        num_test_batches = min(num_test_batches, num_batches)
+        class_batches = round(num_test_batches / len(brand_models))
+        num_test_batches = len(brand_models) * class_batches
+    for images in image_paths:
+        np.random.shuffle(images)
+        img_paths.extend(images[0:class_batches * batch_size])
+    print("class batch number is {}".format(class_batches))
+    print("number of test batches is {}".format(num_batches))
+    return img_paths, num_test_batches
+
+
+class DatasetContext(object):
+    """
+    datasets shared by all experiments of one run. The aligned path lists,
+    their iterators, the unseen and Kaggle data and the degraded sets are 
+    prepared lazily once and handed to every experiment. Experiments have to
+    consume the shared iterators in whole passes, i.e. num_batches steps, 
+    so that the next experiment sees the same order.
+    """
     def __init__(self, params):
         self.params = params
         self.random_seed = self.params.experiment.random_seed
-        self.in_img_paths, self.num_in_batches = \
-                self.aligned_dataset(os.path.join(
+        self.batch_size = self.params.dataloader.batch_size
+        # experiments of one run share the decoded examples if enabled
+        self.cache = dataset_cache(self.params)
+        self.in_paths = None
+        self.in_distribution = None
+        self.out_distribution = None
+        self.degradation_ls = {}
+
+    def in_img_paths(self):
+        """
+        Return:
+            img_paths and number of batches of the aligned test set.
+        """
+        if self.in_paths is None:
+            self.in_paths = aligned_dataset(os.path.join(
                     self.params.dataloader.patch_dir, 'test'),
                     self.params.dataloader.brand_models,
+                    batch_size=self.batch_size,
                     seed=self.random_seed)
-        self.in_iter = build_dataset(
+        return self.in_paths
+
+    def in_dataset(self):
+        """
+        Return:
+            img_paths, iterator and number of batches of the aligned test set.
+        """
+        if self.in_distribution is None:
+            img_paths, num_batches = self.in_img_paths()
+            iterator = build_dataset(
                         self.params.dataloader.patch_dir,
                         self.params.dataloader.brand_models,
                         "in distribution",
-                        self.params.dataloader.batch_size,
-                        self.in_img_paths)
+                        self.batch_size,
+                        img_paths,
+                        cache=self.cache)
+            self.in_distribution = (img_paths, iterator, num_batches)
+        return self.in_distribution
+
+    def load_unseen_data(self):
+        """
+        collect and extract the unseen data from Dresden and Kaggle dataset.
+        """
+        # the names may be set already, e.g. by the process scheduling the experiments
+        if not self.params.unseen_dataloader.brand_models:
+            for b, m in zip(self.params.unseen_dataloader.brands, 
+                            self.params.unseen_dataloader.models):
+                self.params.unseen_dataloader.brand_models.append("_".join([b, m]))
+        if not self.params.kaggle_dataloader.brand_models:
+            self.params.kaggle_dataloader.brand_models = os.listdir(
+                            self.params.kaggle_dataloader.database_image_dir)
+        if self.params.experiment.data_prepared:
+            # done by the process scheduling the experiments, the experiments
+            # must not collect and extract the same files concurrently
+            return
+        unseen_dataloader = instantiate("dataloader_lib", 
+                        self.params.unseen_dataloader.name)(self.params)
+        kaggle_dataloader = instantiate("dataloader_lib", 
+                        self.params.kaggle_dataloader.name)(self.params)
+        unseen_dataloader.load_data()
+        kaggle_dataloader.load_data()
+
+    def prepare(self, degradations):
+        """
+        prepare the data on disk, i.e. the unseen data and the degraded sets,
+        before the experiments run in separate processes.
+        Args:
+            degradations: list of (name, factor) of the degraded sets.
+        """
+        self.load_unseen_data()
+        img_paths, _ = self.in_img_paths()
+        for name, factor in degradations:
+            degradate(img_paths, 
+                        self.params.experiment.degradation_dir,
+                        self.params.dataloader.database,
+                        name, factor)
+        # copied into the parameters of the experiment processes
+        self.params.experiment.data_prepared = True
+
+    def out_dataset(self):
+        """
+        Return:
+            iterators and numbers of batches of the aligned unseen and 
+            Kaggle sets.
+        """
+        if self.out_distribution is None:
+            self.load_unseen_data()
+            # both dataset may have different size, might need different batch size.
+            _, _, num_in_batches = self.in_dataset()
+            unseen_img_paths, num_unseen_batches = \
+                aligned_dataset(self.params.unseen_dataloader.patch_dir, 
+                                self.params.unseen_dataloader.brand_models,
+                                batch_size=self.batch_size,
+                                num_batches=num_in_batches,
+                                seed=self.random_seed)
+            kaggle_img_paths, num_kaggle_batches = \
+                aligned_dataset(self.params.kaggle_dataloader.patch_dir,
+                                self.params.kaggle_dataloader.brand_models,
+                                batch_size=self.batch_size,
+                                num_batches=num_in_batches,
+                                seed=self.random_seed)
+            unseen_iter = build_dataset(
+                            self.params.unseen_dataloader.patch_dir,
+                            self.params.unseen_dataloader.brand_models,
+                            "unseen",
+                            self.batch_size,
+                            unseen_img_paths,
+                            cache=self.cache)
+            kaggle_iter = build_dataset(
+                            self.params.kaggle_dataloader.patch_dir,
+                            self.params.kaggle_dataloader.brand_models,
+                            "kaggle",
+                            self.batch_size,
+                            kaggle_img_paths,
+                            cache=self.cache)
+            self.out_distribution = (unseen_iter, num_unseen_batches,
+                                     kaggle_iter, num_kaggle_batches)
+        return self.out_distribution
+
+    def degradation_dataset(self, name, factor):
+        """
+        iterator of the degraded aligned test set.
+        """
+        if (name, factor) not in self.degradation_ls:
+            in_img_paths, _ = self.in_img_paths()
+            img_paths = degradate(in_img_paths, 
+                                    self.params.experiment.degradation_dir,
+                                    self.params.dataloader.database,
+                                    name, factor)
+            patch_dir = os.path.split(img_paths[0])[0]
+            self.degradation_ls[(name, factor)] = build_dataset(patch_dir,
+                                    self.params.dataloader.brand_models,
+                                    name,
+                                    self.batch_size,
+                                    img_paths)
+        return self.degradation_ls[(name, factor)]
+
+
+class Experiment(object):
+    def __init__(self, params, context=None):
+        """
+        Args:
+            params: parameters from the json file.
+            context: DatasetContext shared with other experiments, a new one
+                     is created if None.
+        """
+        self.params = params
+        self.random_seed = self.params.experiment.random_seed
+        self.context = DatasetContext(params) if context is None else context
         self.log_file = self.params.log.log_file
 
+    @property
+    def in_img_paths(self):
+        return self.context.in_img_paths()[0]
+
+    @property
+    def in_iter(self):
+        return self.context.in_dataset()[1]
+
+    @property
+    def num_in_batches(self):
+        return self.context.in_img_paths()[1]
+
     def aligned_dataset(self,
             patch_dir, brand_models, batch_size=64,
             num_batches=None, seed=42):
         """
-        set a fix subset of total test dataset, so that:
-        1. each class has same size of test images (ROC curve
-           is sensitive to class imbalance)
-        2. each monte carlo draw has the same images as input
-        3. random seed controls the how to sample this subset
-        Args:
-            patch_dir: directory storing patches.
-            brand_models: name of camera models for testing.
-            batch_size: batch size for testing.
-            num_batches: the number of batches from test dataset,
-                         use this number to determine the number of 
-                         batches of unseen dataset.
-            seed: random seed controls the sampling process 
-                  from the overall test set.
-        """
-        # default for 'test' data
-        np.random.seed(seed)
-        image_paths, num_images, img_paths = [], [], []
-        for model in brand_models:
-            images = os.listdir(os.path.join(patch_dir, model))
-            paths = [os.path.join(patch_dir, model, img) for img in images]
-            image_paths.append(paths)
-            num_images.append(len(images))
-        # number of batches for one class
-        class_batches = min(num_images) // batch_size
-        num_test_batches = len(brand_models) * class_batches
-        # sometimes database has more data in 'test', some has more in 'unseen'
-        if num_batches is not None:
-            num_test_batches = min(num_test_batches, num_batches)
-            class_batches = round(num_test_batches / len(brand_models))
-            num_test_batches = len(brand_models) * class_batches
-        for images in image_paths:
-            np.random.shuffle(images)
-            img_paths.extend(images[0:class_batches * batch_size])
-        print("class batch number is {}".format(class_batches))
-        print("number of test batches is {}".format(num_batches))
-        return img_paths, num_test_batches
+        see aligned_dataset.
+        """
+        return aligned_dataset(patch_dir, brand_models, batch_size,
+                               num_batches, seed)
 
     def load_checkpoint(self, model, ckpt_dir):
         self.ckpt = tf.train.Checkpoint(step=tf.Variable(1),
@@ -83,26 +256,14 @@ class Experiment(object):
 
     def optimal_threshold(self, fpr, tpr, thresholds):
         """
-        find out the optimal threshold for the ROC curve, where the optimal 
-        cutoff is the threshold with (tpr - (1 - fpr)) closest to 0.
-        Args:
-            fpr: false positive rate.
-            tpr: true positive rate.
-            thresholds: the corresponding thresholds.
-        Return:
-            optimal: the optimal fpr, tpr and threshold for the ROC curve.
+        see utils.metrics.optimal_threshold.
         """
-        distance = np.abs(tpr - (1 - fpr))
-        idx = np.argmin(distance)
-        optimal_fpr = fpr[idx]
-        optimal_tpr = tpr[idx]
-        optimal_thresholds = thresholds[idx]
-        optimal = [optimal_fpr, optimal_tpr, optimal_thresholds]
-        return optimal
+        return optimal_threshold(fpr, tpr, thresholds)
 
     def roc(self, safe, risky, inverse=False):
         """
-        generate roc curve.
+        generate roc curve, the AUPR, FPR@95TPR and, if configured, the
+        bootstrap confidence intervals are written to the log.
         Args:
             safe: examples that are likely to be in-distribution.
             risky: examples that are likely to be out-of-distribution.
@@ -115,57 +276,30 @@ class Experiment(object):
                      and tpr.
             auroc: area under the ROC curve.
         """
-        labels = np.zeros((safe.shape[0] + risky.shape[0]), dtype=np.int32)
-        if inverse:
-            labels[:safe.shape[0]] += 1
-        else:
-            labels[safe.shape[0]:] += 1
-        examples = np.concatenate((safe, risky))
-        auroc = round(100 * sk.roc_auc_score(labels, examples), 2)
-        fpr, tpr, thresholds = sk.roc_curve(labels, examples)
-        optimal = self.optimal_threshold(fpr, tpr, thresholds)
-        # aupr = round(100 * sk.average_precision_score(labels, examples), 2)
-        # precision, recall, _ = sk.precision_recall_curve(labels, examples)
-        return fpr, tpr, optimal, auroc
+        stats = roc_stats(safe, risky, inverse)
+        auroc = round(100 * stats['auroc'], 2)
+        msg = "auroc: {:.2f}, aupr: {:.2f}, fpr@95tpr: {:.3%}".format(
+                auroc, 100 * stats['aupr'], stats['fpr95'])
+        if self.params.experiment.bootstrap_resamples > 0:
+            ci = bootstrap_ci(safe, risky, inverse,
+                              num_resamples=self.params.experiment.bootstrap_resamples,
+                              alpha=self.params.experiment.bootstrap_alpha,
+                              seed=self.random_seed)
+            msg += ", {:.0%} CI auroc: [{:.2f}, {:.2f}], aupr: [{:.2f}, {:.2f}], " \
+                   "fpr@95tpr: [{:.3%}, {:.3%}]".format(
+                    1 - self.params.experiment.bootstrap_alpha,
+                    100 * ci['auroc'][0], 100 * ci['auroc'][1],
+                    100 * ci['aupr'][0], 100 * ci['aupr'][1],
+                    ci['fpr95'][0], ci['fpr95'][1])
+        write_log(self.log_file, msg + '\n')
+        return stats['fpr'], stats['tpr'], stats['optimal'], auroc
 
     def prepare_unseen_dataset(self):
-        # form dataset and unseen dataset.
-        # both dataset may have different size, might need different batch size.
-        unseen_img_paths, self.num_unseen_batches = \
-            self.aligned_dataset(self.params.unseen_dataloader.patch_dir, 
-                                self.params.unseen_dataloader.brand_models,
-                                num_batches=self.num_in_batches,
-                                seed=self.random_seed)
-        kaggle_img_paths, self.num_kaggle_batches = \
-            self.aligned_dataset(self.params.kaggle_dataloader.patch_dir,
-                                self.params.kaggle_dataloader.brand_models,
-                                num_batches=self.num_in_batches,
-                                seed=self.random_seed)
-        self.unseen_iter = build_dataset(
-                            self.params.unseen_dataloader.patch_dir,
-                            self.params.unseen_dataloader.brand_models,
-                            "unseen",
-                            self.params.dataloader.batch_size,
-                            unseen_img_paths)
-        self.kaggle_iter = build_dataset(
-                            self.params.kaggle_dataloader.patch_dir,
-                            self.params.kaggle_dataloader.brand_models,
-                            "kaggle",
-                            self.params.dataloader.batch_size,
-                            kaggle_img_paths)
+        (self.unseen_iter, self.num_unseen_batches,
+         self.kaggle_iter, self.num_kaggle_batches) = self.context.out_dataset()
 
     def prepare_degradation_dataset(self, name, factor):
-        img_paths = degradate(self.in_img_paths, 
-                                self.params.experiment.degradation_dir,
-                                self.params.dataloader.database,
-                                name, factor)
-        patch_dir = os.path.split(img_paths[0])[0]
-        iterator = build_dataset(patch_dir,
-                                self.params.dataloader.brand_models,
-                                name,
-                                self.params.dataloader.batch_size,
-                                img_paths)
-        return iterator
+        return self.context.degradation_dataset(name, factor)
 
     @tf.function
     def eval_step(self, images):
@@ -180,8 +314,8 @@ class SoftmaxStats(Experiment):
     """
     perform softmax statistics.
     """
-    def __init__(self, params, model):
-        super(SoftmaxStats, self).__init__(params)
+    def __init__(self, params, model, context=None):
+        super(SoftmaxStats, self).__init__(params, context)
         self.model = model
         self.model.build(input_shape=(None, 256, 256, 1))
         self.degradation_id = self.params.softmax_stats.degradation_id
@@ -303,8 +437,8 @@ class SoftmaxStats(Experiment):
 
 
 class MCStats(Experiment):
-    def __init__(self, params, model):
-        super(MCStats, self).__init__(params)
+    def __init__(self, params, model, context=None):
+        super(MCStats, self).__init__(params, context)
         self.model = model
         self.model.build(input_shape=(None, 256, 256, 1))
         self.degradation_id = self.params.mc_stats.degradation_id
@@ -367,24 +501,48 @@ class MCStats(Experiment):
         epistemic_all = np.asarray(epistemic_all)
         return entropy_all, epistemic_all
 
+    @tf.function
+    def mc_eval_step(self, images, num_monte_carlo):
+        mc_softmax = self.model.mc_predict(images, num_monte_carlo)
+        max_softmax_cls = tf.one_hot(tf.math.argmax(mc_softmax, axis=2),
+                                    len(self.params.dataloader.brand_models))
+        return mc_softmax, max_softmax_cls
+
     def mc_stats(self, iterator, num_monte_carlo, num_steps, fname=None):
         """
         compute softmax predictions for each image throughout multiple Monte Carlo samples, 
         and plot the results (optional).
         """
+        with stage('mc_stats'):
+            return self.mc_predictions(iterator, num_monte_carlo, num_steps, fname)
+
+    def mc_predictions(self, iterator, num_monte_carlo, num_steps, fname=None):
         mc_softmax_prob = []
         cls_count = [0 for m in self.params.dataloader.brand_models]
-        for mc_step in trange(num_monte_carlo):
-            softmax_prob = []
-            for step in range(num_steps):
+        if hasattr(self.model, 'mc_predict'):
+            # partially stochastic models draw all samples of a batch at once.
+            for step in trange(num_steps):
                 images, labels = iterator.get_next()
-                softmax, max_softmax_cls = self.eval_step(images)
+                # a tensor, the step is not traced again for each number of draws
+                softmax, max_softmax_cls = self.mc_eval_step(images, 
+                                                tf.constant(num_monte_carlo))
                 cls_count = [sum(x) for x in zip(tf.math.reduce_sum(
-                                                    max_softmax_cls, axis=0),
+                                                    max_softmax_cls, axis=[0, 1]),
                                                 cls_count)]
-                softmax_prob.extend(softmax)
-            mc_softmax_prob.append(softmax_prob)
-        mc_softmax_prob = np.asarray(mc_softmax_prob)
+                mc_softmax_prob.append(softmax.numpy())
+            mc_softmax_prob = np.concatenate(mc_softmax_prob, axis=1)
+        else:
+            for mc_step in trange(num_monte_carlo):
+                softmax_prob = []
+                for step in range(num_steps):
+                    images, labels = iterator.get_next()
+                    softmax, max_softmax_cls = self.eval_step(images)
+                    cls_count = [sum(x) for x in zip(tf.math.reduce_sum(
+                                                        max_softmax_cls, axis=0),
+                                                    cls_count)]
+                    softmax_prob.extend(softmax)
+                mc_softmax_prob.append(softmax_prob)
+            mc_softmax_prob = np.asarray(mc_softmax_prob)
         if fname is not None:
             plot_held_out(images, labels, 
                             self.params.dataloader.brand_models, 
@@ -528,8 +686,8 @@ class MCStats(Experiment):
                 fname=self.roc_path)
 
 class MultiMCStats(MCStats):
-    def __init__(self, params, model):
-        super(MultiMCStats, self).__init__(params, model)
+    def __init__(self, params, model, context=None):
+        super(MultiMCStats, self).__init__(params, model, context)
         self.num_monte_carlo_ls = self.params.multi_mc_stats.num_monte_carlo_ls 
         self.degradation_id = self.params.multi_mc_stats.degradation_id
         self.degradation_factor = self.params.multi_mc_stats.degradation_factor
@@ -648,8 +806,8 @@ class MultiMCStats(MCStats):
                 fname=self.params.multi_mc_stats.epistemic_roc_path)
 
 class EnsembleStats(MCStats):
-    def __init__(self, params, model):
-        super(EnsembleStats, self).__init__(params, model)
+    def __init__(self, params, model, context=None):
+        super(EnsembleStats, self).__init__(params, model, context)
         self.degradation_id = self.params.ensemble_stats.degradation_id
         self.degradation_factor = self.params.ensemble_stats.degradation_factor
 
@@ -811,8 +969,8 @@ class EnsembleStats(MCStats):
 
 
 class MCDegradationStats(MCStats):
-    def __init__(self, params, model):
-        super(MCDegradationStats, self).__init__(params, model)
+    def __init__(self, params, model, context=None):
+        super(MCDegradationStats, self).__init__(params, model, context)
         self.degradation_id = self.params.mc_degradation_stats.degradation_id
         self.degradation_factor = self.params.mc_degradation_stats.degradation_factor
         self.num_monte_carlo = self.params.mc_degradation_stats.num_monte_carlo
@@ -966,4 +1124,569 @@ class MCDegradationStats(MCStats):
                 ylabel="True Positive Rate",
                 labels=self.params.mc_degradation_stats.degradation_factor,
                 suptitle= "Degradation Experiment",
-                fname=self.params.mc_degradation_stats.epistemic_roc_path)
\ No newline at end of file
+                fname=self.params.mc_degradation_stats.epistemic_roc_path)
+
+class MCCascadeStats(MCStats):
+    """
+    posterior mean pass for every patch, Monte Carlo sampling only for the 
+    patches in the ambiguous band of the posterior mean pass.
+    """
+    def __init__(self, params, model, context=None):
+        super(MCCascadeStats, self).__init__(params, model, context)
+        self.num_monte_carlo = self.params.mc_cascade_stats.num_monte_carlo
+        self.ckpt_dir = self.params.mc_cascade_stats.ckpt_dir
+        self.measure = self.params.mc_cascade_stats.measure
+        self.band = self.params.mc_cascade_stats.band
+        self.roc_path = self.params.mc_cascade_stats.roc_path
+
+    def full_mc(self, images):
+        """
+        the full Monte Carlo path of mc_stats the cascade is compared with.
+        """
+        return [self.eval_step(images)[0] for _ in range(self.num_monte_carlo)]
+
+    def warm_up(self, images):
+        """
+        trace the tf.functions of both paths, untimed. Both stages of the
+        cascade run, whether or not the batch has ambiguous patches.
+        """
+        self.model.mean_probs_step(images).numpy()
+        self.model.mc_probs_step(images, self.num_monte_carlo).numpy()
+        self.full_mc(images)[-1].numpy()
+
+    def cascade_stats(self, iterator, num_steps):
+        """
+        run the cascade and the full Monte Carlo path over the whole dataset.
+        Return:
+            probs: predictive probabilities of the cascade for each example.
+            epistemic: epistemic uncertainty for each example.
+            escalated: whether an example is run with Monte Carlo.
+            labels: one-hot labels.
+            elapsed: inference time of the cascade in seconds.
+            full_elapsed: inference time of the full Monte Carlo path in seconds.
+        """
+        probs_ls, epistemic_ls, escalated_ls, labels_ls = [], [], [], []
+        elapsed, full_elapsed = 0., 0.
+        for step in trange(num_steps):
+            images, labels = iterator.get_next()
+            if step == 0:
+                self.warm_up(images)
+            start = time.perf_counter()
+            probs, epistemic, escalated = self.model.mc_cascade(
+                                            images, self.num_monte_carlo,
+                                            self.band, self.measure)
+            probs_ls.extend(probs.numpy())
+            elapsed += time.perf_counter() - start
+            start = time.perf_counter()
+            self.full_mc(images)[-1].numpy()
+            full_elapsed += time.perf_counter() - start
+            epistemic_ls.extend(epistemic.numpy())
+            escalated_ls.extend(escalated.numpy())
+            labels_ls.extend(labels.numpy())
+        return (np.asarray(probs_ls), np.asarray(epistemic_ls),
+                np.asarray(escalated_ls), np.asarray(labels_ls), 
+                elapsed, full_elapsed)
+
+    def experiment(self):
+        self.load_checkpoint(self.model, self.ckpt_dir)
+        self.prepare_unseen_dataset()
+        msg = "\n--------------------- Monte Carlo Cascade Statistics ---------------------\n\n"
+        write_log(self.log_file, msg)
+
+        all_entropy, all_epistemic = [], []
+        experiment_labels = ["in distribution", "unseen", "kaggle"]
+        for iterator, num_steps, label in \
+                zip([self.in_iter, self.unseen_iter, self.kaggle_iter],
+                    [self.num_in_batches, self.num_unseen_batches,
+                     self.num_kaggle_batches],
+                    experiment_labels):
+            probs, epistemic, escalated, labels, elapsed, full_elapsed = \
+                self.cascade_stats(iterator, num_steps)
+            entropy = -np.sum(probs * np.log(probs + np.finfo(float).eps), axis=1)
+            all_entropy.append(entropy)
+            all_epistemic.append(epistemic)
+            # forward passes per patch, the posterior mean pass included
+            passes = 1 + self.num_monte_carlo * np.mean(escalated)
+            msg = ("{}: {:.3%} patches escalated to Monte Carlo, "
+                    "{:.2f} forward passes per patch, {:.3f} ms per patch, "
+                    "full Monte Carlo {:.3f} ms per patch\n"
+                    .format(label, np.mean(escalated), passes,
+                            1000 * elapsed / probs.shape[0],
+                            1000 * full_elapsed / probs.shape[0]))
+            if label == "in distribution":
+                acc = np.mean(np.argmax(probs, axis=1) == np.argmax(labels, axis=1))
+                msg += "test accuracy: {:.3%}\n".format(acc)
+            write_log(self.log_file, msg)
+
+        entropy_fpr, entropy_tpr, entropy_auroc = [], [], []
+        epistemic_fpr, epistemic_tpr, epistemic_auroc = [], [], []
+        for out_entropy, out_epistemic, plotname in zip(all_entropy[1:],
+                                                        all_epistemic[1:],
+                                                        experiment_labels[1:]):
+            fpr, tpr, opt_thr, auroc = self.roc(all_entropy[0], out_entropy)
+            msg = (plotname + ' entropy\n'
+                "false positive rate: {:.3%}, "
+                "true positive rate: {:.3%}, "
+                "threshold: {:.5}\n".format(opt_thr[0], opt_thr[1], opt_thr[2]))
+            write_log(self.log_file, msg)
+            entropy_fpr.append(fpr)
+            entropy_tpr.append(tpr)
+            entropy_auroc.append(auroc)
+            fpr, tpr, opt_thr, auroc = self.roc(all_epistemic[0], out_epistemic)
+            msg = (plotname + ' epistemic\n'
+                "false positive rate: {:.3%}, "
+                "true positive rate: {:.3%}, "
+                "threshold: {:.5}\n".format(opt_thr[0], opt_thr[1], opt_thr[2]))
+            write_log(self.log_file, msg)
+            epistemic_fpr.append(fpr)
+            epistemic_tpr.append(tpr)
+            epistemic_auroc.append(auroc)
+        plot_curve(experiment_labels[1:],
+                [entropy_fpr, epistemic_fpr], 
+                [entropy_tpr, epistemic_tpr], 
+                [entropy_auroc, epistemic_auroc], 
+                xlabel="False Positive Rate",
+                ylabel="True Positive Rate",
+                labels=["entropy", "epistemic"],
+                suptitle="Monte Carlo Cascade",
+                fname=self.roc_path)
+
+
+class StudentStats(MCStats):
+    """
+    OOD detection with the uncertainty predicted by a distilled StudentCNN,
+    one forward pass per patch instead of an ensemble or Monte Carlo draws.
+    """
+    def __init__(self, params, model, context=None):
+        super(StudentStats, self).__init__(params, model, context)
+        self.degradation_id = self.params.student_stats.degradation_id
+        self.degradation_factor = self.params.student_stats.degradation_factor
+        self.ckpt_dir = self.params.student_stats.ckpt_dir
+        # the student has a single deterministic pass
+        self.num_monte_carlo = 1
+
+    @tf.function
+    def student_step(self, images):
+        logits, uncertainty = self.model(images, return_uncertainty=True)
+        softmax = tf.nn.softmax(logits)
+        max_softmax_cls = tf.one_hot(tf.math.argmax(softmax, axis=1),
+                                    len(self.params.dataloader.brand_models))
+        return uncertainty, max_softmax_cls
+
+    def student_stats(self, iterator, num_steps):
+        """
+        predicted entropy and epistemic uncertainty for each example.
+        """
+        uncertainty_ls = []
+        cls_count = [0 for m in self.params.dataloader.brand_models]
+        for step in trange(num_steps):
+            images, _ = iterator.get_next()
+            uncertainty, max_softmax_cls = self.student_step(images)
+            cls_count = [sum(x) for x in zip(tf.math.reduce_sum(
+                                                max_softmax_cls, axis=0),
+                                            cls_count)]
+            uncertainty_ls.extend(uncertainty.numpy())
+        uncertainty_ls = np.asarray(uncertainty_ls)
+        return uncertainty_ls[:, 0], uncertainty_ls[:, 1], cls_count
+
+    def experiment(self):
+        self.load_checkpoint(self.model, self.ckpt_dir)
+        self.prepare_unseen_dataset()
+        msg = "\n--------------------- Student Statistics ---------------------\n\n"
+        write_log(self.log_file, msg)
+
+        in_entropy, in_epistemic, _ = self.student_stats(self.in_iter,
+                                                    self.num_in_batches)
+        unseen_entropy, unseen_epistemic, unseen_cls_count = \
+            self.student_stats(self.unseen_iter, self.num_unseen_batches)
+        kaggle_entropy, kaggle_epistemic, kaggle_cls_count = \
+            self.student_stats(self.kaggle_iter, self.num_kaggle_batches)
+        degradation_entropy = []
+        degradation_epistemic = []
+        degradation_cls_count = []
+        degradation_labels = []
+        for name, factor in zip(self.degradation_id,
+                                self.degradation_factor):
+            iterator = self.prepare_degradation_dataset(name, factor)
+            entropy, epistemic, cls_count = \
+                self.student_stats(iterator, self.num_in_batches)
+            degradation_entropy.append(entropy)
+            degradation_epistemic.append(epistemic)
+            degradation_cls_count.append(cls_count)
+            degradation_labels.append(' '.join([name, str(factor)]))
+
+        all_entropy = [in_entropy, unseen_entropy, kaggle_entropy]
+        all_entropy.extend(degradation_entropy)
+        all_epistemic = [in_epistemic, unseen_epistemic, kaggle_epistemic]
+        all_epistemic.extend(degradation_epistemic)
+        all_cls_count = [unseen_cls_count, kaggle_cls_count]
+        all_cls_count.extend(degradation_cls_count)
+        experiment_labels = ["in distribution", "unseen", "kaggle"]
+        experiment_labels.extend(degradation_labels)
+        for out_entropy, out_epistemic, cls_count, label in zip(all_entropy[1:], 
+                                                                all_epistemic[1:], 
+                                                                all_cls_count, 
+                                                                experiment_labels[1:]):
+            self.log_in_out(in_entropy, in_epistemic,
+                            out_entropy, out_epistemic,
+                            cls_count, self.num_monte_carlo,
+                            label)
+
+        entropy_fpr, entropy_tpr, entropy_auroc = [], [], []
+        epistemic_fpr, epistemic_tpr, epistemic_auroc = [], [], []
+        for out_entropy, out_epistemic, plotname in zip(all_entropy[1:],
+                                                        all_epistemic[1:],
+                                                        experiment_labels[1:]):
+            fpr, tpr, opt_thr, auroc = self.roc(in_entropy, out_entropy)
+            msg = (plotname + ' entropy\n'
+                "false positive rate: {:.3%}, "
+                "true positive rate: {:.3%}, "
+                "threshold: {:.5}\n".format(opt_thr[0], opt_thr[1], opt_thr[2]))
+            write_log(self.log_file, msg)
+            entropy_fpr.append(fpr)
+            entropy_tpr.append(tpr)
+            entropy_auroc.append(auroc)
+            fpr, tpr, opt_thr, auroc = self.roc(in_epistemic, out_epistemic)
+            msg = (plotname + ' epistemic\n'
+                "false positive rate: {:.3%}, "
+                "true positive rate: {:.3%}, "
+                "threshold: {:.5}\n".format(opt_thr[0], opt_thr[1], opt_thr[2]))
+            write_log(self.log_file, msg)
+            epistemic_fpr.append(fpr)
+            epistemic_tpr.append(tpr)
+            epistemic_auroc.append(auroc)
+        plot_curve(experiment_labels[1:],
+                [entropy_fpr, epistemic_fpr], 
+                [entropy_tpr, epistemic_tpr], 
+                [entropy_auroc, epistemic_auroc], 
+                xlabel="False Positive Rate",
+                ylabel="True Positive Rate",
+                labels=["entropy", "epistemic"],
+                suptitle="Distilled Student",
+                fname=self.params.student_stats.roc_path)
+
+
+class PruningStats(MCStats):
+    """
+    prune the BNN with the signal-to-noise ratio of the weight posteriors
+    at several sparsity levels and compare accuracy, AUROC, number of 
+    parameters and latency with the unpruned model.
+    """
+    def __init__(self, params, model, context=None):
+        super(PruningStats, self).__init__(params, model, context)
+        self.num_monte_carlo = self.params.pruning_stats.num_monte_carlo
+        self.ckpt_dir = self.params.pruning_stats.ckpt_dir
+        self.sparsity_levels = self.params.pruning_stats.sparsity_levels
+        self.export_dir = self.params.pruning_stats.export_dir
+
+    def pruned_stats(self, model, iterator, num_steps):
+        """
+        Monte Carlo predictions of a (pruned) model over the whole dataset.
+        Return:
+            mc_softmax_prob: shape of [num_monte_carlo, # examples, num_cls].
+            elapsed: inference time in seconds.
+        """
+        # trace a new function for each model, eval_step is bound to self.model.
+        softmax_step = tf.function(lambda images: tf.nn.softmax(model(images)))
+        mc_softmax_prob = []
+        elapsed = 0.
+        for step in trange(num_steps):
+            images, _ = iterator.get_next()
+            start = time.perf_counter()
+            mc_softmax_prob.append(np.stack([softmax_step(images).numpy()
+                                    for i in range(self.num_monte_carlo)]))
+            elapsed += time.perf_counter() - start
+        return np.concatenate(mc_softmax_prob, axis=1), elapsed
+
+    def level_stats(self, model, name):
+        """
+        accuracy, OOD AUROC, number of parameters and latency of one model.
+        """
+        brand_models = self.params.dataloader.brand_models
+        labels = np.asarray([brand_models.index(
+                    os.path.split(os.path.dirname(path))[-1])
+                    for path in self.in_img_paths])
+        in_mc_s_prob, elapsed = self.pruned_stats(model, self.in_iter,
+                                                  self.num_in_batches)
+        in_entropy, in_epistemic = self.image_uncertainty(in_mc_s_prob)
+        pred = np.argmax(np.mean(in_mc_s_prob, axis=0), axis=1)
+        total, nonzero = count_params(model)
+        stats = {'filters': [int(f) for f in model.filters],
+                 'params': total,
+                 'nonzero_params': nonzero,
+                 'latency_ms': 1000 * elapsed / len(pred),
+                 'accuracy': float(np.mean(pred == labels)),
+                 'entropy_auroc': {},
+                 'epistemic_auroc': {}}
+        for iterator, num_steps, ood_name in \
+                [(self.unseen_iter, self.num_unseen_batches, "unseen"),
+                 (self.kaggle_iter, self.num_kaggle_batches, "kaggle")]:
+            out_mc_s_prob, _ = self.pruned_stats(model, iterator, num_steps)
+            out_entropy, out_epistemic = self.image_uncertainty(out_mc_s_prob)
+            stats['entropy_auroc'][ood_name] = \
+                self.roc(in_entropy, out_entropy)[-1]
+            stats['epistemic_auroc'][ood_name] = \
+                self.roc(in_epistemic, out_epistemic)[-1]
+        msg = ("{}: filters {}, {} parameters ({} non-zero), "
+                "{:.3f} ms per patch, test accuracy: {:.3%}\n"
+                "entropy AUROC: {}, epistemic AUROC: {}\n\n".format(
+                    name, stats['filters'], stats['params'], 
+                    stats['nonzero_params'], stats['latency_ms'],
+                    stats['accuracy'], stats['entropy_auroc'],
+                    stats['epistemic_auroc']))
+        write_log(self.log_file, msg)
+        return stats
+
+    def experiment(self):
+        # fails before the data is loaded if the model cannot be pruned
+        pruner = SNRPruner(self.params, self.model)
+        self.load_checkpoint(self.model, self.ckpt_dir)
+        self.prepare_unseen_dataset()
+        msg = "\n--------------------- Pruning Statistics ---------------------\n\n"
+        write_log(self.log_file, msg)
+
+        report = {'unpruned': self.level_stats(self.model, 'unpruned')}
+        for channel_sparsity, weight_sparsity in self.sparsity_levels:
+            name = 'channel {} weight {}'.format(channel_sparsity, weight_sparsity)
+            pruned = pruner.prune(channel_sparsity, weight_sparsity)
+            pruner.save(pruned, os.path.join(self.export_dir,
+                        'channel_{}_weight_{}'.format(channel_sparsity, 
+                                                      weight_sparsity)))
+            report[name] = self.level_stats(pruned, name)
+        with open(self.params.pruning_stats.report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print("report is saved to {}".format(self.params.pruning_stats.report_path))
+
+
+class ImageLevelStats(Experiment):
+    """
+    image-level accuracy from the patches of each test image, with early
+    exit as soon as the image-level decision is confident, compared with
+    using all patches and with the patch-level accuracy.
+    """
+    def __init__(self, params, context=None):
+        super(ImageLevelStats, self).__init__(params, context)
+        self.config = self.params.image_level_stats
+        self.brand_models = self.params.dataloader.brand_models
+
+    def test_images(self):
+        """
+        group the test patches by their source image, the last part of the
+        patch name is the patch index, e.g. 'Canon_Ixus70_0_1_00.png'.
+        Return:
+            images: list of (label, patch paths) of each image.
+        """
+        np.random.seed(self.random_seed)
+        images = []
+        for label, m in enumerate(self.brand_models):
+            d = os.path.join(self.params.dataloader.patch_dir, 'test', m)
+            groups = {}
+            for name in sorted(os.listdir(d)):
+                stem = name.rsplit('_', 1)[0]
+                groups.setdefault(stem, []).append(os.path.join(d, name))
+            images.extend([(label, paths) for paths in groups.values()])
+        np.random.shuffle(images)
+        if self.config.num_images is not None:
+            images = images[:self.config.num_images]
+        return images
+
+    def experiment(self):
+        msg = "\n--------------------- Image Level Statistics ---------------------\n\n"
+        write_log(self.log_file, msg)
+        predictor = build_predictor(self.params, self.config)
+        classifier = ImageClassifier(predictor,
+                                     aggregation=self.config.aggregation,
+                                     confidence=self.config.confidence,
+                                     min_patches=self.config.min_patches,
+                                     step_size=self.config.step_size,
+                                     max_epistemic=self.config.max_epistemic,
+                                     min_score=self.config.min_patch_score)
+        # informativeness scores of the extraction, computed on the fly if missing
+        manifest = read_manifest(self.params.dataloader.patch_dir, 'test')
+        early_corr, full_corr, patch_corr = 0, 0, 0
+        num_patches_used, num_patches_total = 0, 0
+        early_time, full_time = 0., 0.
+        images = self.test_images()
+        for i in trange(len(images)):
+            label, paths = images[i]
+            patches = np.stack([io.imread(path) for path in paths])
+            patches = patches[..., np.newaxis].astype(np.float32) / 255.
+            rel_paths = [os.path.relpath(path, self.params.dataloader.patch_dir)
+                         for path in paths]
+            scores = None
+            if all(path in manifest for path in rel_paths):
+                scores = np.array([manifest[path][-1] for path in rel_paths])
+            start = time.perf_counter()
+            pred, _, mc_softmax_prob = classifier.classify(patches, scores)
+            early_time += time.perf_counter() - start
+            early_corr += int(pred == label)
+            num_patches_used += mc_softmax_prob.shape[1]
+
+            start = time.perf_counter()
+            pred, _, mc_softmax_prob = classifier.classify(patches, scores,
+                                                           early_exit=False)
+            full_time += time.perf_counter() - start
+            full_corr += int(pred == label)
+            patch_pred = np.argmax(np.mean(mc_softmax_prob, axis=0), axis=1)
+            patch_corr += int(np.sum(patch_pred == label))
+            num_patches_total += mc_softmax_prob.shape[1]
+
+        num_images = len(images)
+        msg = ("{} test images, {} aggregation\n"
+                "patch-level accuracy: {:.3%}\n"
+                "image-level accuracy (all patches): {:.3%}, {:.1f} patches "
+                "and {:.3f} s per image\n"
+                "image-level accuracy (early exit): {:.3%}, {:.1f} patches "
+                "and {:.3f} s per image\n\n".format(
+                    num_images, self.config.aggregation,
+                    patch_corr / num_patches_total,
+                    full_corr / num_images, num_patches_total / num_images,
+                    full_time / num_images,
+                    early_corr / num_images, num_patches_used / num_images,
+                    early_time / num_images))
+        write_log(self.log_file, msg)
+
+
+class QuantizationStats(Experiment):
+    """
+    compare the float model with its int8 quantised TensorFlow Lite export
+    in terms of latency, model size, per-class accuracy and OOD AUROC.
+    """
+    def __init__(self, params, model, context=None):
+        super(QuantizationStats, self).__init__(params, context)
+        self.model = model
+        self.model.build(input_shape=(None, 256, 256, 1))
+        self.ckpt_dir = self.params.quantization_stats.ckpt_dir
+        self.posterior_mean = self.params.quantization_stats.posterior_mean
+        self.export_dir = self.params.quantization_stats.export_dir
+        self.num_calibration_batches = \
+            self.params.quantization_stats.num_calibration_batches
+        self.batch_size = self.params.dataloader.batch_size
+
+    @tf.function
+    def float_step(self, images):
+        if self.posterior_mean:
+            return self.model(images, posterior_mean=True)
+        return self.model(images)
+
+    def representative_dataset(self):
+        """
+        calibration set for the int8 quantisation, drawn from the aligned
+        validation patches, so that the test patches are not seen.
+        """
+        calib_img_paths, num_calib_batches = \
+            self.aligned_dataset(os.path.join(
+                self.params.dataloader.patch_dir, 'val'),
+                self.params.dataloader.brand_models,
+                batch_size=self.batch_size,
+                seed=self.random_seed)
+        calib_iter = build_dataset(self.params.dataloader.patch_dir,
+                                   self.params.dataloader.brand_models,
+                                   "calibration",
+                                   self.batch_size,
+                                   calib_img_paths)
+        num_steps = min(num_calib_batches, self.num_calibration_batches)
+        def generator():
+            for step in range(num_steps):
+                images, _ = calib_iter.get_next()
+                yield [images]
+        return generator
+
+    def variant_stats(self, predict_fn):
+        """
+        run one variant of the model over in-distribution and OOD sets.
+        Args:
+            predict_fn: callable mapping a batch of images to logits.
+        Return:
+            stats: latency, throughput, accuracy per class and AUROC per OOD set.
+        """
+        brand_models = self.params.dataloader.brand_models
+        corr_ls = np.zeros(len(brand_models))
+        total_ls = np.zeros(len(brand_models))
+        elapsed = 0.
+        num_images = 0
+        in_max_softmax = []
+        for step in trange(self.num_in_batches):
+            images, labels = self.in_iter.get_next()
+            if step == 0:
+                # untimed, the first batch traces the tf.function
+                np.asarray(predict_fn(images))
+            start = time.perf_counter()
+            logits = np.asarray(predict_fn(images))
+            elapsed += time.perf_counter() - start
+            num_images += logits.shape[0]
+            softmax = tf.nn.softmax(logits).numpy()
+            labels = labels.numpy()
+            correct = np.argmax(softmax, axis=1) == np.argmax(labels, axis=1)
+            corr_ls += np.sum(labels[correct], axis=0)
+            total_ls += np.sum(labels, axis=0)
+            in_max_softmax.extend(np.max(softmax, axis=1))
+        in_max_softmax = np.asarray(in_max_softmax)
+
+        stats = {'latency_ms': 1000 * elapsed / num_images,
+                 'throughput': num_images / elapsed,
+                 'accuracy': float(np.sum(corr_ls) / np.sum(total_ls)),
+                 'class_accuracy': dict(zip(brand_models,
+                                        (corr_ls / total_ls).tolist())),
+                 'auroc': {}}
+        for iterator, num_steps, name in \
+                [(self.unseen_iter, self.num_unseen_batches, "unseen"),
+                 (self.kaggle_iter, self.num_kaggle_batches, "kaggle")]:
+            out_max_softmax = []
+            for step in range(num_steps):
+                images, _ = iterator.get_next()
+                softmax = tf.nn.softmax(np.asarray(predict_fn(images))).numpy()
+                out_max_softmax.extend(np.max(softmax, axis=1))
+            _, _, _, auroc = self.roc(in_max_softmax,
+                                      np.asarray(out_max_softmax),
+                                      inverse=True)
+            stats['auroc'][name] = auroc
+        return stats
+
+    def log_report(self, report):
+        msg = ''
+        for name, stats in report.items():
+            msg += ("{}: size {:.3f} MB, latency {:.3f} ms/patch, "
+                    "{:.1f} patches/s\n".format(name,
+                        stats['size'] / 2**20,
+                        stats['latency_ms'],
+                        stats['throughput']))
+            msg += "test accuracy: {:.3%}\n".format(stats['accuracy'])
+            for m, acc in stats['class_accuracy'].items():
+                msg += '{} accuracy: {:.3%}\n'.format(m, acc)
+            for ood_name, auroc in stats['auroc'].items():
+                msg += '{} AUROC: {}\n'.format(ood_name, auroc)
+            msg += '\n'
+        write_log(self.log_file, msg)
+
+    def experiment(self):
+        self.load_checkpoint(self.model, self.ckpt_dir)
+        self.prepare_unseen_dataset()
+        msg = "\n--------------------- Quantization Statistics ---------------------\n\n"
+        write_log(self.log_file, msg)
+
+        exporter = TFLiteExporter(self.params, self.model,
+                                  self.batch_size, self.posterior_mean)
+        float_path = os.path.join(self.export_dir, 'float32.tflite')
+        int8_path = os.path.join(self.export_dir, 'int8.tflite')
+        exporter.export(float_path)
+        exporter.export(int8_path, self.representative_dataset())
+
+        report = {}
+        report['float'] = self.variant_stats(self.float_step)
+        # the variables of the model include e.g. the posterior stddevs,
+        # which are not part of the exported graph
+        report['float']['size'] = os.path.getsize(float_path)
+        for name, fname in [('float32 tflite', float_path),
+                            ('int8 tflite', int8_path)]:
+            tflite_model = TFLiteModel(fname)
+            report[name] = self.variant_stats(tflite_model)
+            report[name]['size'] = tflite_model.size()
+        for name in report:
+            report[name]['speedup'] = (report[name]['throughput'] /
+                                       report['float']['throughput'])
+        self.log_report(report)
+        with open(self.params.quantization_stats.report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print("report is saved to {}".format(
+                self.params.quantization_stats.report_path))
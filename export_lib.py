@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import tensorflow as tf
+
+
+class TFLiteExporter(object):
+    """
+    export the networks in model_lib to TensorFlow Lite flatbuffers,
+    either in float32 or with full integer (int8) quantisation.
+    """
+    def __init__(self, params, model, batch_size, posterior_mean=False):
+        """
+        Args:
+            params: parameters from the json file.
+            model: trained network, checkpoint has to be restored before.
+            batch_size: fixed batch size of the exported model.
+            posterior_mean: if True, export the deterministic posterior
+                            mean pass of a BayesianCNN.
+        """
+        self.params = params
+        self.model = model
+        self.batch_size = batch_size
+        self.posterior_mean = posterior_mean
+        self.input_shape = [batch_size,
+                            self.params.model.input_shape.width,
+                            self.params.model.input_shape.height,
+                            1]
+
+    def concrete_function(self):
+        """
+        trace the forward pass (outputs logits) with a fixed input signature.
+        """
+        if self.posterior_mean:
+            forward = tf.function(
+                lambda x: self.model(x, posterior_mean=True))
+        else:
+            forward = tf.function(lambda x: self.model(x))
+        return forward.get_concrete_function(
+                    tf.TensorSpec(self.input_shape, tf.float32))
+
+    def export(self, fname, representative_dataset=None):
+        """
+        convert the model and write the flatbuffer to file.
+        Args:
+            fname: output file path of the .tflite model.
+            representative_dataset: callable yielding lists of input batches
+                                    for calibration. If given, weights and
+                                    activations are quantised to int8.
+        Return:
+            size: size of the exported model in bytes.
+        """
+        converter = tf.lite.TFLiteConverter.from_concrete_functions(
+                        [self.concrete_function()])
+        if representative_dataset is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+            # fail instead of silently falling back to float kernels
+            converter.target_spec.supported_ops = \
+                [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        tflite_model = converter.convert()
+        out_dir = os.path.dirname(fname)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(fname, 'wb') as f:
+            f.write(tflite_model)
+        print("model is exported to {}".format(fname))
+        return len(tflite_model)
+
+
+class TFLiteModel(object):
+    """
+    run an exported TensorFlow Lite model with the same interface as the
+    keras models, i.e. images in, logits out.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.interpreter = tf.lite.Interpreter(model_path=fname)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+
+    def size(self):
+        return os.path.getsize(self.fname)
+
+    def __call__(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        self.interpreter.set_tensor(self.input_detail['index'], images)
+        self.interpreter.invoke()
+        logits = self.interpreter.get_tensor(self.output_detail['index'])
+        return np.array(logits, dtype=np.float32)
@@ -0,0 +1,86 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from inference_lib import SlidingWindow, build_predictor
+from utils.misc import configure_devices, get_args, get_params, write_log
+from utils.visualization import configure_plotting, plot_heatmap
+
+
+def read_green(img_path):
+    """
+    decode the green channel of a full-sized image, the other channels are
+    released right after decoding.
+    """
+    img = Image.open(img_path)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    green = np.asarray(img.getchannel('G'))
+    img.close()
+    return green
+
+
+def inference(params):
+    """
+    sliding-window inference over the full sensor area of each image,
+    saves the heatmaps of each image and a summary of the image-level scores.
+    """
+    configure_devices()
+    config = params.inference
+    brand_models = params.dataloader.brand_models
+    if not os.path.exists(config.output_dir):
+        os.makedirs(config.output_dir)
+    img_paths = list(config.image_paths)
+    if config.image_dir is not None:
+        img_paths.extend([os.path.join(config.image_dir, name)
+                          for name in sorted(os.listdir(config.image_dir))])
+    predictor = build_predictor(params, config)
+    sliding_window = SlidingWindow(predictor, config.batch_size,
+                                   overlap=config.overlap)
+    summary = {}
+    for img_path in img_paths:
+        msg = "... Sliding window over {}\n".format(img_path)
+        write_log(params.log.log_file, msg)
+        heatmaps, scores = sliding_window.run(read_green(img_path))
+        name = os.path.splitext(os.path.basename(img_path))[0]
+        np.savez(os.path.join(config.output_dir, name + '.npz'), **heatmaps)
+        if config.plot:
+            plot_heatmap(np.max(heatmaps['probs'], axis=2),
+                        "maximum softmax output",
+                        os.path.join(config.output_dir, name + '_max_softmax.png'))
+            plot_heatmap(heatmaps['entropy'], "entropy",
+                        os.path.join(config.output_dir, name + '_entropy.png'))
+            plot_heatmap(heatmaps['epistemic'], "epistemic uncertainty",
+                        os.path.join(config.output_dir, name + '_epistemic.png'))
+        summary[img_path] = {
+            'brand_model': brand_models[int(np.argmax(scores['probs']))],
+            'probabilities': dict(zip(brand_models, scores['probs'].tolist())),
+            'entropy': float(scores['entropy']),
+            'epistemic': float(scores['epistemic']),
+            'grid': list(heatmaps['entropy'].shape)}
+        msg = "{}: {}, entropy {:.3f}, epistemic {:.4f}\n".format(
+                name, summary[img_path]['brand_model'],
+                summary[img_path]['entropy'], summary[img_path]['epistemic'])
+        write_log(params.log.log_file, msg)
+    with open(os.path.join(config.output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+
+
+def main():
+    try:
+        args = get_args()
+        params = get_params(args.params)
+    except Exception as err:
+        print(err)
+        print("... missing or invalid arguments")
+        exit(0)
+    if not os.path.exists(params.log.log_dir):
+        os.makedirs(params.log.log_dir)
+    for b, m in zip(params.dataloader.brands,
+                    params.dataloader.models):
+        params.dataloader.brand_models.append("_".join([b, m]))
+    configure_plotting(params)
+    inference(params)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import tensorflow as tf
+from concurrent.futures import Future
+from utils.misc import instantiate, write_log
+from utils.patch import patch_scores
+
+
+def restore(model, ckpt_dir):
+    """
+    restore the network weights from the latest checkpoint in ckpt_dir.
+    """
+    model.build(input_shape=(None, 256, 256, 1))
+    latest = tf.train.latest_checkpoint(ckpt_dir)
+    if latest is None:
+        raise Exception("!!! No checkpoint found in {}".format(ckpt_dir))
+    tf.train.Checkpoint(net=model).restore(latest).expect_partial()
+    return latest
+
+def image_scores(mc_softmax_prob):
+    """
+    aggregate the patch predictions of one image.
+    Args:
+        mc_softmax_prob: softmax predictions of the patches, shape of
+                         [# of draws, # of patches, # of classes].
+    Return:
+        probs: mean predictive distribution of the image.
+        entropy: entropy of the mean predictive distribution.
+        epistemic: mean epistemic uncertainty of the patches.
+    """
+    probs = np.mean(mc_softmax_prob, axis=(0, 1))
+    entropy = -np.sum(probs * np.log(probs + np.finfo(float).eps))
+    # sum over the diagonal of the epistemic uncertainty matrix of each patch
+    epistemic = np.mean(np.sum(np.var(mc_softmax_prob, axis=0), axis=1))
+    return probs, entropy, epistemic
+
+
+class BasePredictor(object):
+    """
+    patches in, softmax predictions of shape [# of draws, batch_size,
+    # of classes] out. A deterministic network has a single draw.
+    """
+    def __init__(self, params):
+        self.params = params
+        self.log_file = self.params.log.log_file
+        self.input_signature = [tf.TensorSpec([None,
+                                    self.params.model.input_shape.width,
+                                    self.params.model.input_shape.height,
+                                    1], tf.float32)]
+
+    def predict(self, images):
+        raise NotImplementedError
+
+
+class VanillaPredictor(BasePredictor):
+    def __init__(self, params, model_name, ckpt_dir):
+        super(VanillaPredictor, self).__init__(params)
+        self.model = instantiate("model_lib", model_name)(params)
+        msg = "Restored from {}\n".format(restore(self.model, ckpt_dir))
+        write_log(self.log_file, msg)
+        self.softmax_step = tf.function(
+                        lambda images: tf.nn.softmax(self.model(images)),
+                        input_signature=self.input_signature)
+
+    def predict(self, images):
+        return self.softmax_step(images).numpy()[np.newaxis]
+
+
+class MCPredictor(BasePredictor):
+    def __init__(self, params, model_name, ckpt_dir, num_monte_carlo):
+        super(MCPredictor, self).__init__(params)
+        # the kl term is not used for predictions
+        self.model = instantiate("model_lib", model_name)(params, 1)
+        msg = "Restored from {}\n".format(restore(self.model, ckpt_dir))
+        write_log(self.log_file, msg)
+        self.num_monte_carlo = num_monte_carlo
+        if hasattr(self.model, 'mc_predict'):
+            self.mc_step = tf.function(
+                lambda images: self.model.mc_predict(images, num_monte_carlo),
+                input_signature=self.input_signature)
+        else:
+            self.mc_step = tf.function(
+                lambda images: tf.stack([tf.nn.softmax(self.model(images))
+                                        for _ in range(num_monte_carlo)]),
+                input_signature=self.input_signature)
+
+    def predict(self, images):
+        return self.mc_step(images).numpy()
+
+
+class EnsemblePredictor(BasePredictor):
+    def __init__(self, params, model_name, ckpt_dir, num_ensemble):
+        super(EnsemblePredictor, self).__init__(params)
+        self.models = []
+        for i in range(num_ensemble):
+            model = instantiate("model_lib", model_name)(params)
+            msg = "Restored from {}\n".format(
+                    restore(model, os.path.join(ckpt_dir, str(i))))
+            write_log(self.log_file, msg)
+            self.models.append(model)
+        self.ensemble_step = tf.function(
+                lambda images: tf.stack([tf.nn.softmax(model(images))
+                                        for model in self.models]),
+                input_signature=self.input_signature)
+
+    def predict(self, images):
+        return self.ensemble_step(images).numpy()
+
+
+def build_predictor(params, config):
+    """
+    create the predictor specified in the configuration.
+    Args:
+        params: parameters from the json file.
+        config: namespace with model, ckpt_dir and num_monte_carlo
+                (BNN) or num_ensemble (ensemble).
+    """
+    if config.model in ["BayesianCNN", "LastLayerBayesianCNN"]:
+        return MCPredictor(params, config.model, config.ckpt_dir,
+                           config.num_monte_carlo)
+    elif config.model == "EnsembleCNN":
+        return EnsemblePredictor(params, config.model, config.ckpt_dir,
+                                 config.num_ensemble)
+    return VanillaPredictor(params, config.model, config.ckpt_dir)
+
+
+class DynamicBatcher(object):
+    """
+    collect patches of concurrent requests into batches. A batch is run as
+    soon as it holds max_batch_size patches, or max_wait_ms after its first
+    request arrived. The network runs only in the batching thread.
+    """
+    def __init__(self, predictor, max_batch_size, max_wait_ms):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, patches):
+        """
+        Args:
+            patches: patches of one image, shape of [# of patches, 256, 256, 1].
+        Return:
+            future: resolves to softmax predictions of shape
+                    [# of draws, # of patches, # of classes].
+        """
+        future = Future()
+        self.requests.put((patches, future))
+        return future
+
+    def loop(self):
+        pending = None
+        while True:
+            batch = [pending] if pending is not None else [self.requests.get()]
+            pending = None
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    # keep the request for the next batch
+                    pending = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.run(batch)
+
+    def run(self, batch):
+        try:
+            images = np.concatenate([patches for patches, _ in batch])
+            mc_softmax_prob = self.predictor.predict(images)
+            start = 0
+            for patches, future in batch:
+                end = start + len(patches)
+                future.set_result(mc_softmax_prob[:, start:end])
+                start = end
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+
+
+def patch_informativeness(patches):
+    """
+    informativeness score of the patches, saturated and flat patches
+    (sky, walls) carry little sensor noise and get a low score.
+    Args:
+        patches: shape of [# of patches, 256, 256, 1], range 0-1.
+    Return:
+        scores: the score of utils.patch.patch_scores for each patch.
+    """
+    return patch_scores(patches)[-1]
+
+
+class ImageClassifier(object):
+    """
+    image-level decision from the patches of one image. Patches are fed in
+    order of informativeness, step_size patches per forward pass, and the
+    aggregation stops as soon as the image-level decision is confident.
+    """
+    def __init__(self, predictor, aggregation='mean_log_prob', confidence=0.95,
+                 min_patches=1, step_size=4, max_epistemic=None, min_score=None):
+        """
+        Args:
+            predictor: one of the predictors above.
+            aggregation: 'mean_log_prob' or 'majority'.
+            confidence: stop if the image-level probability (mean_log_prob) 
+                        or the vote share (majority) of the leading class 
+                        reaches it.
+            min_patches: minimum number of patches before stopping.
+            step_size: number of patches per forward pass.
+            max_epistemic: if not None, only stop if the mean epistemic 
+                           uncertainty of the patches is not above it.
+            min_score: if not None, patches with a lower informativeness
+                       score are dropped, the best patch is always kept.
+        """
+        if aggregation not in ['mean_log_prob', 'majority']:
+            raise Exception("!!! Unknown aggregation: {}".format(aggregation))
+        self.predictor = predictor
+        self.aggregation = aggregation
+        self.confidence = confidence
+        self.min_patches = min_patches
+        self.step_size = step_size
+        self.max_epistemic = max_epistemic
+        self.min_score = min_score
+
+    def aggregate(self, mc_softmax_prob):
+        """
+        Args:
+            mc_softmax_prob: shape of [# of draws, # of patches, # of classes].
+        Return:
+            probs: image-level distribution over the classes.
+            confident: whether the decision is confident enough to stop.
+        """
+        patch_probs = np.mean(mc_softmax_prob, axis=0)
+        num_patches = patch_probs.shape[0]
+        if self.aggregation == 'mean_log_prob':
+            log_probs = np.mean(np.log(patch_probs + np.finfo(float).eps), axis=0)
+            probs = np.exp(log_probs - np.max(log_probs))
+            probs = probs / np.sum(probs)
+            confident = np.max(probs) >= self.confidence
+        else:
+            votes = np.bincount(np.argmax(patch_probs, axis=1),
+                                minlength=patch_probs.shape[1])
+            probs = votes / num_patches
+            confident = np.max(probs) >= self.confidence
+        if self.max_epistemic is not None:
+            epistemic = np.mean(np.sum(np.var(mc_softmax_prob, axis=0), axis=1))
+            confident = confident and epistemic <= self.max_epistemic
+        confident = confident and num_patches >= self.min_patches
+        return probs, confident
+
+    def classify(self, patches, scores=None, early_exit=True):
+        """
+        Args:
+            patches: patches of one image, shape of [# of patches, 256, 256, 1].
+            scores: informativeness of the patches, computed if None.
+            early_exit: if False, all patches are used.
+        Return:
+            pred: index of the predicted class.
+            probs: image-level distribution over the classes.
+            mc_softmax_prob: predictions of the patches that were used.
+        """
+        if scores is None:
+            scores = patch_informativeness(patches)
+        order = np.argsort(scores)[::-1]
+        if self.min_score is not None:
+            num_keep = max(1, int(np.sum(scores >= self.min_score)))
+            order = order[:num_keep]
+        mc_softmax_prob = None
+        for start in range(0, len(order), self.step_size):
+            batch = patches[order[start:start + self.step_size]]
+            pred_batch = self.predictor.predict(batch)
+            if mc_softmax_prob is None:
+                mc_softmax_prob = pred_batch
+            else:
+                mc_softmax_prob = np.concatenate([mc_softmax_prob, pred_batch],
+                                                 axis=1)
+            probs, confident = self.aggregate(mc_softmax_prob)
+            if early_exit and confident:
+                break
+        return int(np.argmax(probs)), probs, mc_softmax_prob
+
+
+def tile_positions(length, tile, stride):
+    """
+    start positions of the tiles along one axis, the last tile is aligned
+    with the border so that the whole axis is covered.
+    """
+    if length < tile:
+        return []
+    positions = list(range(0, length - tile + 1, stride))
+    if positions[-1] != length - tile:
+        positions.append(length - tile)
+    return positions
+
+
+class SlidingWindow(object):
+    """
+    tile the full sensor area of an image and stream the tiles in fixed-size
+    batches through the network. Only the decoded green channel and one batch 
+    of tiles are held in memory, the outputs are heatmaps over the tile grid.
+    """
+    def __init__(self, predictor, batch_size, overlap=0, tile=256):
+        """
+        Args:
+            predictor: one of the predictors above.
+            batch_size: number of tiles per forward pass.
+            overlap: overlap of neighbouring tiles in pixels.
+            tile: size of the tiles, the input size of the network.
+        """
+        if not 0 <= overlap < tile:
+            raise Exception("!!! Overlap has to be in [0, {})".format(tile))
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.tile = tile
+        self.stride = tile - overlap
+
+    def batches(self, green, rows, cols):
+        """
+        generate batches of tiles and their grid indices.
+        """
+        tiles, idx = [], []
+        for i, y in enumerate(rows):
+            for j, x in enumerate(cols):
+                tiles.append(green[y:y + self.tile, x:x + self.tile])
+                idx.append((i, j))
+                if len(tiles) == self.batch_size:
+                    yield np.stack(tiles)[..., np.newaxis], idx
+                    tiles, idx = [], []
+        if tiles:
+            yield np.stack(tiles)[..., np.newaxis], idx
+
+    def run(self, green):
+        """
+        Args:
+            green: decoded green channel of the full-sized image, uint8.
+        Return:
+            heatmaps: dict of 'probs' [rows, cols, # of classes], 'entropy' 
+                      and 'epistemic' [rows, cols] over the tile grid.
+            scores: image-level mean predictive distribution, entropy and 
+                    epistemic uncertainty.
+        """
+        rows = tile_positions(green.shape[0], self.tile, self.stride)
+        cols = tile_positions(green.shape[1], self.tile, self.stride)
+        if not rows or not cols:
+            raise Exception("!!! Image is smaller than a tile")
+        probs = None
+        entropy = np.zeros((len(rows), len(cols)), dtype=np.float32)
+        epistemic = np.zeros((len(rows), len(cols)), dtype=np.float32)
+        for tiles, idx in self.batches(green, rows, cols):
+            # same scaling as parse_image
+            mc_softmax_prob = self.predictor.predict(
+                                tiles.astype(np.float32) / 255.)
+            mean_probs = np.mean(mc_softmax_prob, axis=0)
+            if probs is None:
+                probs = np.zeros((len(rows), len(cols), mean_probs.shape[1]),
+                                 dtype=np.float32)
+            tile_entropy = -np.sum(mean_probs * 
+                                np.log(mean_probs + np.finfo(float).eps), axis=1)
+            tile_epistemic = np.sum(np.var(mc_softmax_prob, axis=0), axis=1)
+            for k, (i, j) in enumerate(idx):
+                probs[i, j] = mean_probs[k]
+                entropy[i, j] = tile_entropy[k]
+                epistemic[i, j] = tile_epistemic[k]
+        image_probs = np.mean(probs, axis=(0, 1))
+        image_entropy = -np.sum(image_probs * 
+                                np.log(image_probs + np.finfo(float).eps))
+        heatmaps = {'probs': probs, 'entropy': entropy, 'epistemic': epistemic}
+        scores = {'probs': image_probs, 'entropy': image_entropy,
+                  'epistemic': float(np.mean(epistemic))}
+        return heatmaps, scores
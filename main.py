@@ -1,7 +1,117 @@
 import os
-from train import train_eval
-from experiment import experiment
-from utils.misc import get_args, get_params
+import argparse
+from utils.misc import get_params
+
+def get_args():
+    """
+    get the subcommand and the params path, without subcommand the run
+    block of the parameters decides what is run.
+    Return:
+        args: arguments of the command
+    """
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('command', nargs='?', choices=sorted(COMMANDS),
+                            default=None, help='what to run')
+    argparser.add_argument('-p', '--params', dest='params',
+                            metavar='P', default='None',
+                            help='the parameters file')
+    args = argparser.parse_args()
+    return args
+
+def make_dirs(dirs):
+    for d in dirs:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+def prepare(params):
+    """
+    collect & split in to train, val and test & extract to patches.
+    """
+    from utils.misc import instantiate
+    from utils.resources import configure_resources, stage
+    configure_resources(params)
+    dataloader = instantiate("dataloader_lib",
+                    params.dataloader.name)(params)
+    with stage('prepare'):
+        dataloader.load_data()
+
+def train(params, train=True, evaluate=False):
+    from utils.visualization import configure_plotting
+    from utils.resources import configure_resources, stage
+    from utils.distribute import launch_workers, needs_workers, worker_params
+    from train import train_eval
+    params.run.train = train
+    params.run.evaluate = evaluate
+    # multi-worker training runs this command again in each worker, the
+    # data they share is prepared once before
+    if needs_workers(params):
+        if params.run.prepare:
+            prepare(params)
+        launch_workers(params)
+        return
+    worker_params(params)
+    configure_plotting(params)
+    configure_resources(params)
+    make_dirs([params.trainer.ckpt_dir])
+    with stage('train' if train else 'evaluate'):
+        train_eval(params)
+
+def evaluate(params):
+    train(params, train=False, evaluate=True)
+
+def experiment(params):
+    from utils.visualization import configure_plotting
+    from experiment import experiment
+    configure_plotting(params)
+    experiment(params)
+
+def export(params):
+    """
+    export the trained network of the export block to TensorFlow Lite.
+    """
+    from utils.misc import configure_devices, instantiate
+    from export_lib import TFLiteExporter
+    from inference_lib import restore
+    configure_devices()
+    config = params.export
+    if config.model in ["BayesianCNN", "EB_BayesianCNN", "LastLayerBayesianCNN"]:
+        # the kl term is not used for predictions
+        model = instantiate("model_lib", config.model)(params, 1)
+    elif config.model == "EnsembleCNN":
+        raise Exception("!!! Export the members of the ensemble one by one")
+    else:
+        model = instantiate("model_lib", config.model)(params)
+    restore(model, config.ckpt_dir)
+    TFLiteExporter(params, model, config.batch_size,
+                   config.posterior_mean).export(config.fname)
+
+def serve(params):
+    from serve import serve
+    serve(params)
+
+def inference(params):
+    from utils.visualization import configure_plotting
+    from inference import inference
+    configure_plotting(params)
+    inference(params)
+
+def autotune(params):
+    """
+    sweep batch sizes and threads on this host and save the fastest ones
+    as the host profile.
+    """
+    from autotune_lib import Autotuner
+    make_dirs([params.autotune.work_dir])
+    Autotuner(params).run()
+
+COMMANDS = {'prepare': prepare,
+            'train': train,
+            'evaluate': evaluate,
+            'experiment': experiment,
+            'export': export,
+            'serve': serve,
+            'inference': inference,
+            'autotune': autotune}
 
 def main():
     try:
@@ -13,23 +123,20 @@ def main():
         print("... missing or invalid arguments")
         exit(0)
     # create all dirs that are needed
-    dirs = [params.log.log_dir]
-    for d in dirs:
-        if not os.path.exists(d):
-            os.makedirs(d)
+    make_dirs([params.log.log_dir])
     # concatenate brands and models
-    for b, m in zip(params.dataloader.brands, 
+    for b, m in zip(params.dataloader.brands,
                     params.dataloader.models):
         params.dataloader.brand_models.append("_".join([b, m]))
+    if args.command is not None:
+        COMMANDS[args.command](params)
+        return
+    # without subcommand, as configured in the run block
     if params.run.train or params.run.evaluate:
-        dirs = [params.trainer.ckpt_dir]
-        for d in dirs:
-            if not os.path.exists(d):
-                os.makedirs(d)
-        train_eval(params)
+        train(params, params.run.train, params.run.evaluate)
 
     if params.run.experiment:
         experiment(params)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
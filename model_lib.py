@@ -6,6 +6,41 @@ from tensorflow_probability import distributions as tfd
 keras = tf.keras
 tfd = tfp.distributions
 
+
+def posterior_mean_conv(layer, x):
+    """
+    deterministic forward pass of a flipout convolutional layer, using the
+    means of the weight posteriors instead of sampled perturbations.
+    Args:
+        layer: tfp.layers.Convolution2DFlipout layer.
+        x: input tensor.
+    Return:
+        outputs: activated outputs of the layer.
+    """
+    outputs = tf.nn.convolution(x, layer.kernel_posterior.mean(),
+                                strides=layer.strides,
+                                padding=layer.padding.upper(),
+                                dilations=layer.dilation_rate)
+    if layer.bias_posterior is not None:
+        outputs = tf.nn.bias_add(outputs, layer.bias_posterior.mean())
+    return layer.activation(outputs)
+
+def posterior_mean_dense(layer, x):
+    """
+    deterministic forward pass of a flipout dense layer, using the
+    means of the weight posteriors.
+    Args:
+        layer: tfp.layers.DenseFlipout layer.
+        x: input tensor.
+    Return:
+        outputs: activated outputs of the layer.
+    """
+    outputs = tf.linalg.matmul(x, layer.kernel_posterior.mean())
+    if layer.bias_posterior is not None:
+        outputs = tf.nn.bias_add(outputs, layer.bias_posterior.mean())
+    return layer.activation(outputs)
+
+
 class BaseModel(tf.keras.Model):
     def __init__(self, params):
         super(BaseModel, self).__init__()
@@ -15,15 +50,24 @@ class BaseModel(tf.keras.Model):
 
     def constrained_conv_update(self):
         """
-        weight updates for constrained convolutional layer.
+        weight updates for constrained convolutional layer, the centre of
+        each filter is -1 and the other weights sum up to 1. All filters are
+        updated with a single assign, which also works for mirrored variables
+        in cross-replica context.
         """
         weights = self.constrained_conv_layer.weights[0]
-        for i in range(weights.shape[-1]):
-            weights[2, 2, 0, i].assign(0.)
-            weights[:, :, 0, i].assign(tf.math.divide(weights[:, :, 0, i],
-                                    tf.math.reduce_sum(weights[:, :, 0, i])))
-            weights[2, 2, 0, i].assign(-1.)
-        self.constrained_conv_layer.weights[0].assign(weights)
+        centre = np.zeros(weights.shape, dtype=np.float32)
+        centre[weights.shape[0] // 2, weights.shape[1] // 2] = 1.
+        surround = weights * (1. - centre)
+        surround = surround / tf.math.reduce_sum(surround, axis=[0, 1], keepdims=True)
+        weights.assign(surround - centre)
+
+    def constrained_training(self, training):
+        """
+        whether the call updates the constrained convolutional layer, under a
+        tf.distribute strategy the trainer updates it once per step instead.
+        """
+        return training and not tf.distribute.has_strategy()
 
 class VanillaCNN(BaseModel):
     def __init__(self, params):
@@ -56,7 +100,20 @@ class VanillaCNN(BaseModel):
         self.dense3 = keras.layers.Dense(self.num_cls)
 
     def call(self, x, training=False):
-        if training:
+        x = self.features(x, training=training)
+        x = self.dense1(x)
+        x = keras.layers.Activation('relu')(x)
+        x = self.dense2(x)
+        x = keras.layers.Activation('relu')(x)
+        x = self.dense3(x)
+        return x
+
+    def features(self, x, training=False):
+        """
+        constrained convolutional and convolutional layers, outputs the 
+        flattened features.
+        """
+        if self.constrained_training(training):
             self.constrained_conv_update()
         x = self.constrained_conv_layer(x)
         x = self.conv1(x)
@@ -81,11 +138,6 @@ class VanillaCNN(BaseModel):
         x = keras.layers.MaxPool2D(pool_size=3, 
                                     strides=2)(x)
         x = keras.layers.Flatten()(x)
-        x = self.dense1(x)
-        x = keras.layers.Activation('relu')(x)
-        x = self.dense2(x)
-        x = keras.layers.Activation('relu')(x)
-        x = self.dense3(x)
         return x
 
 
@@ -94,9 +146,36 @@ class EnsembleCNN(VanillaCNN):
         super(EnsembleCNN, self).__init__(params)
 
 
+class StudentCNN(VanillaCNN):
+    """
+    single network distilled from the predictive distribution of an ensemble
+    or a BNN. Besides the logits, an uncertainty head regresses the teacher's 
+    entropy and epistemic uncertainty.
+    """
+    def __init__(self, params):
+        super(StudentCNN, self).__init__(params)
+        self.uncertainty_head = keras.layers.Dense(2, activation='softplus')
+
+    def call(self, x, training=False, return_uncertainty=False):
+        x = self.features(x, training=training)
+        x = self.dense1(x)
+        x = keras.layers.Activation('relu')(x)
+        x = self.dense2(x)
+        x = keras.layers.Activation('relu')(x)
+        logits = self.dense3(x)
+        if return_uncertainty:
+            # [entropy, epistemic uncertainty]
+            return logits, self.uncertainty_head(x)
+        return logits
+
+
 class BayesianCNN(BaseModel):
-    def __init__(self, params, kl_weight):
+    def __init__(self, params, kl_weight, filters=None):
         super(BayesianCNN, self).__init__(params)
+        self.kl_weight = kl_weight
+        # number of filters of the convolutional layers and units of the
+        # hidden dense layers, smaller for pruned models.
+        self.filters = filters if filters is not None else [96, 64, 64, 128, 200, 200]
         self.divergence_fn = (lambda q, p, _: tfd.kl_divergence(q, p) / 
                                 tf.cast(kl_weight, dtype=tf.float32))
         # no non-linearity after constrained layer
@@ -109,7 +188,7 @@ class BayesianCNN(BaseModel):
                 1])
         self.variational_conv1 = \
             tfp.layers.Convolution2DFlipout(
-                96, kernel_size=7,
+                self.filters[0], kernel_size=7,
                 strides=2, padding='same',
                 kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
                     loc_initializer=keras.initializers.GlorotUniform()),
@@ -120,7 +199,7 @@ class BayesianCNN(BaseModel):
                 activation='selu')
         self.variational_conv2 = \
             tfp.layers.Convolution2DFlipout(
-                64, kernel_size=5,
+                self.filters[1], kernel_size=5,
                 strides=1, padding='same',
                 kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
                     loc_initializer=keras.initializers.GlorotUniform()),
@@ -131,7 +210,7 @@ class BayesianCNN(BaseModel):
                 activation='selu')
         self.variational_conv3 = \
             tfp.layers.Convolution2DFlipout(
-                64, kernel_size=5,
+                self.filters[2], kernel_size=5,
                 strides=1, padding='same',
                 kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
                     loc_initializer=keras.initializers.GlorotUniform()),
@@ -142,7 +221,7 @@ class BayesianCNN(BaseModel):
                 activation='selu')
         self.variational_conv4 = \
             tfp.layers.Convolution2DFlipout(
-                128, kernel_size=1,
+                self.filters[3], kernel_size=1,
                 strides=1, padding='same',
                 kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
                     loc_initializer=keras.initializers.GlorotUniform()),
@@ -151,7 +230,7 @@ class BayesianCNN(BaseModel):
                     loc_initializer=keras.initializers.Zeros()),
                 kernel_divergence_fn=self.divergence_fn,
                                 activation='selu')
-        self.dense1 = tfp.layers.DenseFlipout(200,
+        self.dense1 = tfp.layers.DenseFlipout(self.filters[4],
                 kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
                     loc_initializer=keras.initializers.GlorotUniform()),
                 bias_posterior_fn=tfp.layers.default_mean_field_normal_fn(
@@ -159,7 +238,7 @@ class BayesianCNN(BaseModel):
                     loc_initializer=keras.initializers.Zeros()),
                 kernel_divergence_fn=self.divergence_fn,
                 activation='selu')
-        self.dense2 = tfp.layers.DenseFlipout(200,
+        self.dense2 = tfp.layers.DenseFlipout(self.filters[5],
                 kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
                     loc_initializer=keras.initializers.GlorotUniform()),
                 bias_posterior_fn=tfp.layers.default_mean_field_normal_fn(
@@ -174,10 +253,28 @@ class BayesianCNN(BaseModel):
                     is_singular=True,
                     loc_initializer=keras.initializers.Zeros()),
                 kernel_divergence_fn=self.divergence_fn)
+        # the stages of mc_cascade, traced once for any number of patches
+        # and draws.
+        patches = tf.TensorSpec([None, self.params.model.input_shape.height,
+                                 self.params.model.input_shape.width, 1], tf.float32)
+        self.mean_probs_step = tf.function(self.mean_probs,
+                                           input_signature=[patches])
+        self.mc_probs_step = tf.function(self.mc_probs,
+                                         input_signature=[patches,
+                                                          tf.TensorSpec([], tf.int32)])
 
-    def call(self, x, training=False):
-        if training:
+    def call(self, x, training=False, posterior_mean=False):
+        """
+        Args:
+            x: input patches.
+            training: if True, update the constrained convolutional layer.
+            posterior_mean: if True, run a single deterministic pass with 
+                            the posterior means of the flipout layers.
+        """
+        if self.constrained_training(training):
             self.constrained_conv_update()
+        if posterior_mean:
+            return self.posterior_mean_call(x)
         x = self.constrained_conv_layer(x)
         x = self.variational_conv1(x)
         x = keras.layers.MaxPool2D(pool_size=3,
@@ -198,11 +295,213 @@ class BayesianCNN(BaseModel):
         x = self.dense3(x)
         return x
 
+    def posterior_mean_call(self, x):
+        """
+        forward pass with the posterior means, no Flipout perturbations 
+        are sampled, so the outputs are deterministic.
+        """
+        x = self.constrained_conv_layer(x)
+        x = posterior_mean_conv(self.variational_conv1, x)
+        x = keras.layers.MaxPool2D(pool_size=3,
+                                    strides=2,
+                                    padding='SAME')(x)
+        x = posterior_mean_conv(self.variational_conv2, x)
+        x = keras.layers.MaxPool2D(pool_size=3, 
+                                    strides=2)(x)
+        x = posterior_mean_conv(self.variational_conv3, x)
+        x = keras.layers.MaxPool2D(pool_size=3, 
+                                    strides=2)(x)
+        x = posterior_mean_conv(self.variational_conv4, x)
+        x = keras.layers.MaxPool2D(pool_size=3, 
+                                    strides=2)(x)
+        x = keras.layers.Flatten()(x)
+        x = posterior_mean_dense(self.dense1, x)
+        x = posterior_mean_dense(self.dense2, x)
+        x = posterior_mean_dense(self.dense3, x)
+        return x
+
+    def mean_probs(self, x):
+        """
+        softmax predictions of the posterior mean pass.
+        """
+        return tf.nn.softmax(self(x, posterior_mean=True))
+
+    def mc_probs(self, x, num_monte_carlo):
+        """
+        Return:
+            softmax predictions, shape of [num_monte_carlo, batch_size, num_cls].
+        """
+        probs = tf.TensorArray(tf.float32, size=num_monte_carlo)
+        for i in tf.range(num_monte_carlo):
+            probs = probs.write(i, tf.nn.softmax(self(x)))
+        return probs.stack()
+
+    def mc_cascade(self, x, num_monte_carlo, band, measure='max_softmax'):
+        """
+        cheap-first inference: a single posterior mean pass for every patch,
+        Monte Carlo sampling only for the patches whose score of the posterior
+        mean pass falls in the ambiguous band. The number of escalated patches
+        differs from batch to batch, so the two stages run as separate
+        tf.functions and the escalation between them runs eagerly.
+        Args:
+            x: input patches.
+            num_monte_carlo: number of Monte Carlo draws for ambiguous patches.
+            band: [lower, upper] bounds of the ambiguous band.
+            measure: 'max_softmax' or 'entropy' of the posterior mean pass.
+        Return:
+            probs: predictive probabilities, shape of [batch_size, num_cls].
+            epistemic: summed variance of the Monte Carlo draws, zero for
+                       the patches that are not escalated.
+            escalated: boolean mask of the patches run with Monte Carlo.
+        """
+        probs = self.mean_probs_step(x)
+        if measure == 'entropy':
+            score = -tf.math.reduce_sum(
+                        probs * tf.math.log(probs + np.finfo(np.float32).eps), 
+                        axis=1)
+        else:
+            score = tf.math.reduce_max(probs, axis=1)
+        escalated = tf.math.logical_and(score >= band[0], score <= band[1])
+        epistemic = tf.zeros_like(score)
+        idx = tf.where(escalated)
+        if idx.shape[0]:
+            ambiguous = tf.gather_nd(x, idx)
+            mc_probs = self.mc_probs_step(ambiguous, num_monte_carlo)
+            probs = tf.tensor_scatter_nd_update(probs, idx,
+                        tf.math.reduce_mean(mc_probs, axis=0))
+            epistemic = tf.tensor_scatter_nd_update(epistemic, idx,
+                        tf.math.reduce_sum(tf.math.reduce_variance(
+                            mc_probs, axis=0), axis=1))
+        return probs, epistemic, escalated
+
+
+class LastLayerBayesianCNN(BaseModel):
+    """
+    partially stochastic network: deterministic constrained convolutional 
+    and convolutional layers (as VanillaCNN) with a Bayesian dense head. 
+    Monte Carlo draws only resample the head on top of shared features.
+    """
+    def __init__(self, params, kl_weight):
+        super(LastLayerBayesianCNN, self).__init__(params)
+        self.divergence_fn = (lambda q, p, _: tfd.kl_divergence(q, p) / 
+                                tf.cast(kl_weight, dtype=tf.float32))
+        self.constrained_conv_layer = \
+            keras.layers.Conv2D(3, (5, 5), 
+                padding='same',
+                input_shape=[None, 
+                    self.params.model.input_shape.width, 
+                    self.params.model.input_shape.height, 
+                    1])
+        self.conv1 = keras.layers.Conv2D(
+                        96, kernel_size=7,
+                        strides=2, padding='same')
+        self.bn1 = keras.layers.BatchNormalization()
+        self.conv2 = keras.layers.Conv2D(
+                        64, kernel_size=5,
+                        strides=1, padding='same')
+        self.bn2 = keras.layers.BatchNormalization()
+        self.conv3 = keras.layers.Conv2D(
+                        64, kernel_size=5,
+                        strides=1, padding='same')
+        self.bn3 = keras.layers.BatchNormalization()
+        self.conv4 = keras.layers.Conv2D(
+                        128, kernel_size=1,
+                        strides=1, padding='same')
+        self.bn4 = keras.layers.BatchNormalization()
+        self.dense1 = tfp.layers.DenseFlipout(200,
+                kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
+                    loc_initializer=keras.initializers.GlorotUniform()),
+                bias_posterior_fn=tfp.layers.default_mean_field_normal_fn(
+                    is_singular=True,
+                    loc_initializer=keras.initializers.Zeros()),
+                kernel_divergence_fn=self.divergence_fn,
+                activation='selu')
+        self.dense2 = tfp.layers.DenseFlipout(200,
+                kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
+                    loc_initializer=keras.initializers.GlorotUniform()),
+                bias_posterior_fn=tfp.layers.default_mean_field_normal_fn(
+                    is_singular=True,
+                    loc_initializer=keras.initializers.Zeros()),
+                kernel_divergence_fn=self.divergence_fn,
+                activation='selu')
+        self.dense3 = tfp.layers.DenseFlipout(self.num_cls,
+                kernel_posterior_fn=tfp.layers.default_mean_field_normal_fn(
+                    loc_initializer=keras.initializers.GlorotUniform()),
+                bias_posterior_fn=tfp.layers.default_mean_field_normal_fn(
+                    is_singular=True,
+                    loc_initializer=keras.initializers.Zeros()),
+                kernel_divergence_fn=self.divergence_fn)
+
+    def features(self, x, training=False):
+        """
+        deterministic trunk, outputs the flattened features.
+        """
+        if self.constrained_training(training):
+            self.constrained_conv_update()
+        x = self.constrained_conv_layer(x)
+        x = self.conv1(x)
+        x = self.bn1(x, training=training)
+        x = keras.layers.Activation('relu')(x)
+        x = keras.layers.MaxPool2D(pool_size=3,
+                                   strides=2,
+                                   padding='SAME')(x)
+        x = self.conv2(x)
+        x = self.bn2(x, training=training)
+        x = keras.layers.Activation('relu')(x)
+        x = keras.layers.MaxPool2D(pool_size=3, 
+                                    strides=2)(x)
+        x = self.conv3(x)
+        x = self.bn3(x, training=training)
+        x = keras.layers.Activation('relu')(x)
+        x = keras.layers.MaxPool2D(pool_size=3, 
+                                    strides=2)(x)
+        x = self.conv4(x)
+        x = self.bn4(x, training=training)
+        x = keras.layers.Activation('relu')(x)
+        x = keras.layers.MaxPool2D(pool_size=3, 
+                                    strides=2)(x)
+        x = keras.layers.Flatten()(x)
+        return x
+
+    def head(self, x, posterior_mean=False):
+        """
+        Bayesian dense head, outputs logits.
+        """
+        if posterior_mean:
+            x = posterior_mean_dense(self.dense1, x)
+            x = posterior_mean_dense(self.dense2, x)
+            return posterior_mean_dense(self.dense3, x)
+        x = self.dense1(x)
+        x = self.dense2(x)
+        x = self.dense3(x)
+        return x
+
+    def call(self, x, training=False, posterior_mean=False):
+        x = self.features(x, training=training)
+        return self.head(x, posterior_mean=posterior_mean)
+
+    def mc_predict(self, x, num_monte_carlo):
+        """
+        Monte Carlo predictions, the trunk runs once per batch and only
+        the head is sampled num_monte_carlo times.
+        Args:
+            x: input patches.
+            num_monte_carlo: times of sampling from the head.
+        Return:
+            softmax predictions, shape of [num_monte_carlo, batch_size, num_cls].
+        """
+        features = self.features(x)
+        # a graph loop, the head is not unrolled num_monte_carlo times
+        probs = tf.TensorArray(tf.float32, size=num_monte_carlo)
+        for i in tf.range(num_monte_carlo):
+            probs = probs.write(i, tf.nn.softmax(self.head(features)))
+        return probs.stack()
+
 
 # empirical bayes BayesianCNN
 class EB_BayesianCNN(BayesianCNN):
     def __init__(self, params, kl_weight):
-        super(EB_BayesianCNN, self).__init__(params)
+        super(EB_BayesianCNN, self).__init__(params, kl_weight)
         self.divergence_fn = self.make_divergence_fn_for_empirical_bayes(
                         params.HParams['std_prior_scale'], 
                         kl_weight)
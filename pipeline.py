@@ -0,0 +1,334 @@
+import os
+import sys
+import copy
+import json
+import time
+import hashlib
+import subprocess
+from utils.misc import get_args, get_params, instantiate, to_dict, write_log
+from utils.resources import configure_resources, stage
+
+# keys of the dataloader block that determine the data stages
+DATA_KEYS = ['name', 'database', 'database_csv', 'database_image_dir', 'patch_dir',
+             'brands', 'models', 'extract_span', 'num_patch', 'patch_sampling',
+             'random_seed']
+
+
+def fingerprint(*parts):
+    """
+    hash of the json representation of the parts.
+    """
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def file_hash(fname):
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def dir_listing(directory):
+    """
+    names, sizes and modification times of the files in directory,
+    cheap compared to reading the files.
+    """
+    listing = []
+    for root, _, names in sorted(os.walk(directory)):
+        for name in sorted(names):
+            stat = os.stat(os.path.join(root, name))
+            listing.append((os.path.relpath(os.path.join(root, name), directory),
+                            stat.st_size, int(stat.st_mtime)))
+    return listing
+
+
+def load_params(fname):
+    params = get_params(fname)
+    for b, m in zip(params.dataloader.brands,
+                    params.dataloader.models):
+        params.dataloader.brand_models.append("_".join([b, m]))
+    return params
+
+
+class Pipeline(object):
+    """
+    DAG of the stages download -> validate -> split -> extract -> degrade ->
+    train(model) -> evaluate -> experiment. The fingerprint of each stage is
+    computed from its part of the configuration and the fingerprints of its
+    inputs, and saved under state_dir once the stage finished. Stages whose
+    fingerprint is unchanged are skipped, independent trainings run in
+    parallel processes.
+    """
+    def __init__(self, params):
+        self.params = params
+        self.config = self.params.pipeline
+        self.log_file = self.params.log.log_file
+        self.state_dir = self.config.state_dir
+        self.params_dir = os.path.join(self.state_dir, 'params')
+        for d in [self.state_dir, self.params_dir]:
+            if not os.path.exists(d):
+                os.makedirs(d)
+        self.trainings = {t.name: t for t in self.config.train}
+        self.train_params = {t.name: load_params(t.params) for t in self.config.train}
+        self.experiment_params = load_params(self.config.experiment)
+        # all trainings have to share the data stages
+        data_configs = [fingerprint(self.data_config(p))
+                        for p in self.train_params.values()]
+        if len(set(data_configs)) > 1:
+            raise Exception("!!! The trainings use different data, run separate pipelines")
+        self.data_params = list(self.train_params.values())[0]
+        self.dataloader = None
+
+    def data_config(self, params):
+        return {k: getattr(params.dataloader, k) for k in DATA_KEYS}
+
+    def state_path(self, stage):
+        return os.path.join(self.state_dir, stage + '.json')
+
+    def load_state(self, stage):
+        if not os.path.exists(self.state_path(stage)):
+            return None
+        with open(self.state_path(stage)) as f:
+            return json.load(f)
+
+    def save_state(self, stage, fp, outputs=None):
+        state = {'fingerprint': fp, 'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'outputs': outputs}
+        with open(self.state_path(stage), 'w') as f:
+            json.dump(state, f, indent=4)
+
+    def up_to_date(self, stage, fp):
+        state = self.load_state(stage)
+        if state is not None and state['fingerprint'] == fp:
+            msg = "... Skipping {}, unchanged\n".format(stage)
+            write_log(self.log_file, msg)
+            return True
+        msg = "... Running {}\n".format(stage)
+        write_log(self.log_file, msg)
+        return False
+
+    def get_dataloader(self):
+        if self.dataloader is None:
+            self.dataloader = instantiate("dataloader_lib",
+                            self.data_params.dataloader.name)(self.data_params)
+        return self.dataloader
+
+    def download(self):
+        dataloader = self.data_params.dataloader
+        fp = fingerprint(self.data_config(self.data_params),
+                         file_hash(dataloader.database_csv))
+        # the images have to be there as well
+        if not os.path.exists(dataloader.database_image_dir) or \
+                not self.up_to_date('download', fp):
+            self.get_dataloader().download()
+            self.save_state('download', fp)
+        return fp
+
+    def validate(self, download_fp):
+        fp = fingerprint(download_fp, dir_listing(
+                            self.data_params.dataloader.database_image_dir))
+        if not self.up_to_date('validate', fp):
+            dataloader = self.get_dataloader()
+            dataloader.validate()
+            # images deleted by the validation change the listing
+            fp = fingerprint(download_fp, dir_listing(
+                                self.data_params.dataloader.database_image_dir))
+            self.save_state('validate', fp, dataloader.img_path_ls)
+        return fp
+
+    def split(self, validate_fp):
+        fp = fingerprint(validate_fp, self.data_params.dataloader.random_seed)
+        if not self.up_to_date('split', fp):
+            dataloader = self.get_dataloader()
+            dataloader.img_path_ls = list(self.load_state('validate')['outputs'])
+            dataloader.split_ds = []
+            dataloader.split_dataset(self.data_params.dataloader.random_seed)
+            self.save_state('split', fp, dataloader.split_ds)
+        return fp
+
+    def extract(self, split_fp):
+        fp = fingerprint(split_fp, self.data_config(self.data_params))
+        if not os.path.exists(self.data_params.dataloader.patch_dir) or \
+                not self.up_to_date('extract', fp):
+            dataloader = self.get_dataloader()
+            dataloader.split_ds = self.load_state('split')['outputs']
+            dataloader.extract()
+            self.save_state('extract', fp)
+        return fp
+
+    def degrade(self, extract_fp):
+        """
+        unseen data and degraded sets of the experiments.
+        """
+        from experiment import EXPERIMENTS, degradations
+        from experiment_lib import DatasetContext
+        params = self.experiment_params
+        names = [name for name, _, _ in EXPERIMENTS
+                 if getattr(params.experiment, name)]
+        pairs = degradations(params, names)
+        fp = fingerprint(extract_fp, pairs, params.experiment.random_seed,
+                         to_dict(params.unseen_dataloader),
+                         to_dict(params.kaggle_dataloader))
+        if not self.up_to_date('degrade', fp):
+            # the names of the unseen camera models are added to a copy, the
+            # fingerprints are computed from the parameters as configured
+            DatasetContext(copy.deepcopy(params)).prepare(pairs)
+            self.save_state('degrade', fp)
+        return fp
+
+    def stage_params(self, params, stage, **run):
+        """
+        write the parameters of a training/evaluation/experiment stage, the
+        data stages are already done by the pipeline.
+        """
+        config = to_dict(params)
+        config['dataloader']['brand_models'] = []
+        config['run'].update(run)
+        config['run']['prepare'] = False
+        if run.get('experiment'):
+            # the unseen data and the degraded sets are done by the degrade
+            # stage, the names are set as DatasetContext.load_unseen_data does
+            config['experiment']['data_prepared'] = True
+            config['unseen_dataloader']['brand_models'] = [
+                "_".join([b, m]) for b, m in zip(params.unseen_dataloader.brands,
+                                                 params.unseen_dataloader.models)]
+            config['kaggle_dataloader']['brand_models'] = os.listdir(
+                            params.kaggle_dataloader.database_image_dir)
+        fname = os.path.join(self.params_dir, stage + '.json')
+        with open(fname, 'w') as f:
+            json.dump(config, f, indent=4)
+        return fname
+
+    def launch(self, stage, params_file):
+        """
+        Return:
+            process: the stage running main.py.
+            log: its .out file, to close when the process is reaped.
+        """
+        log = open(os.path.join(self.state_dir, stage + '.out'), 'w')
+        msg = "... Started {}\n".format(stage)
+        write_log(self.log_file, msg)
+        process = subprocess.Popen([sys.executable, 'main.py', '-p', params_file],
+                                   stdout=log, stderr=subprocess.STDOUT)
+        return process, log
+
+    def train_evaluate(self, extract_fp):
+        """
+        train the models in parallel as soon as the trainings they depend on
+        (e.g. the teacher of the student) are done, and evaluate each model
+        after its training. Trainings and evaluations share max_parallel.
+        Return:
+            fps: fingerprints of the trainings.
+        """
+        fps, pending, running, evaluations = {}, list(self.trainings), {}, []
+        while pending or running or evaluations:
+            # evaluations first, their trainings are done
+            while evaluations and len(running) < self.config.max_parallel:
+                name, fp = evaluations.pop(0)
+                running['evaluate_' + name] = self.evaluate(name, fp)
+            for name in list(pending):
+                training = self.trainings[name]
+                if any(dep not in fps for dep in training.after):
+                    continue
+                if len(running) >= self.config.max_parallel:
+                    break
+                pending.remove(name)
+                params = self.train_params[name]
+                config = to_dict(params)
+                config['run'] = {}
+                fp = fingerprint(extract_fp, config,
+                                 [fps[dep] for dep in training.after])
+                if self.up_to_date('train_' + name, fp) and \
+                        os.path.exists(params.trainer.ckpt_dir):
+                    fps[name] = fp
+                    if not self.up_to_date('evaluate_' + name, fp):
+                        evaluations.append((name, fp))
+                    continue
+                params_file = self.stage_params(params, 'train_' + name,
+                                    train=True, evaluate=False, experiment=False)
+                running['train_' + name] = \
+                    self.launch('train_' + name, params_file) + (fp,)
+            time.sleep(1)
+            for job, (process, log, fp) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                del running[job]
+                log.close()
+                if process.returncode != 0:
+                    for p, l, _ in running.values():
+                        p.terminate()
+                        p.wait()
+                        l.close()
+                    raise Exception("!!! {} failed, see {}".format(
+                                    job, os.path.join(self.state_dir, job + '.out')))
+                self.save_state(job, fp)
+                msg = "... Finished {}\n".format(job)
+                write_log(self.log_file, msg)
+                if job.startswith('train_'):
+                    name = job[len('train_'):]
+                    fps[name] = fp
+                    evaluations.append((name, fp))
+            if pending and not running and not evaluations and \
+                    all(any(dep not in fps for dep in self.trainings[n].after) for n in pending):
+                raise Exception("!!! Unresolved dependencies of {}".format(", ".join(pending)))
+        return fps
+
+    def evaluate(self, name, fp):
+        params_file = self.stage_params(self.train_params[name], 'evaluate_' + name,
+                                train=False, evaluate=True, experiment=False)
+        return self.launch('evaluate_' + name, params_file) + (fp,)
+
+    def experiment(self, degrade_fp, train_fps):
+        config = to_dict(self.experiment_params)
+        config['run'] = {}
+        fp = fingerprint(degrade_fp, config, sorted(train_fps.values()))
+        if not self.up_to_date('experiment', fp):
+            params_file = self.stage_params(self.experiment_params, 'experiment',
+                                    train=False, evaluate=False, experiment=True)
+            process, log = self.launch('experiment', params_file)
+            returncode = process.wait()
+            log.close()
+            if returncode != 0:
+                raise Exception("!!! Experiment failed, see {}".format(
+                                os.path.join(self.state_dir, 'experiment.out')))
+            self.save_state('experiment', fp)
+        return fp
+
+    def run(self):
+        start = time.time()
+        # the data stages run in this process, the others in their own
+        with stage('download'):
+            download_fp = self.download()
+        with stage('validate'):
+            validate_fp = self.validate(download_fp)
+        with stage('split'):
+            split_fp = self.split(validate_fp)
+        with stage('extract'):
+            extract_fp = self.extract(split_fp)
+        with stage('degrade'):
+            degrade_fp = self.degrade(extract_fp)
+        train_fps = self.train_evaluate(extract_fp)
+        self.experiment(degrade_fp, train_fps)
+        msg = "... Pipeline finished in {:.1f} s\n".format(time.time() - start)
+        write_log(self.log_file, msg)
+
+
+def main():
+    try:
+        args = get_args()
+        params = get_params(args.params)
+    except Exception as err:
+        print(err)
+        print("... missing or invalid arguments")
+        exit(0)
+    if not os.path.exists(params.log.log_dir):
+        os.makedirs(params.log.log_dir)
+    configure_resources(params)
+    Pipeline(params).run()
+
+if __name__ == '__main__':
+    main()
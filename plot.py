@@ -0,0 +1,55 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from utils.visualization import PLOT_SUFFIX, render
+
+
+def get_args():
+    """
+    get the plot data files or directories to render.
+    """
+    argparser = argparse.ArgumentParser(
+        description="render the saved plot data to PNG and/or TikZ")
+    argparser.add_argument('paths', nargs='+',
+                            help='plot data files or directories to search')
+    argparser.add_argument('--no-png', dest='png', action='store_false',
+                            help='do not save the PNG figures')
+    argparser.add_argument('--no-tikz', dest='tikz', action='store_false',
+                            help='do not save the TikZ (.tex) figures')
+    argparser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                            help='number of rendering processes')
+    return argparser.parse_args()
+
+
+def find_plots(paths):
+    """
+    collect the plot data files under the given paths.
+    """
+    data_files = []
+    for path in paths:
+        if os.path.isfile(path):
+            data_files.append(path)
+            continue
+        for root, _, names in sorted(os.walk(path)):
+            data_files.extend(os.path.join(root, name) for name in sorted(names)
+                              if name.endswith(PLOT_SUFFIX))
+    return data_files
+
+
+def main():
+    args = get_args()
+    data_files = find_plots(args.paths)
+    if not data_files:
+        print("... no plot data found")
+        return
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = [executor.submit(render, f, args.png, args.tikz)
+                   for f in data_files]
+        for data_file, future in zip(data_files, futures):
+            try:
+                future.result()
+            except Exception as err:
+                print("!!! Unable to render {}: {}".format(data_file, err))
+
+if __name__ == '__main__':
+    main()
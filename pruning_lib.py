@@ -0,0 +1,142 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+from model_lib import BayesianCNN
+from utils.misc import write_log
+keras = tf.keras
+
+
+def layer_variable(layer, suffix):
+    """
+    find the variable of a flipout layer by the suffix of its name,
+    e.g. 'kernel_posterior_loc' or 'kernel_posterior_untransformed_scale'.
+    """
+    for w in layer.weights:
+        if w.name.split('/')[-1].split(':')[0] == suffix:
+            return w
+    raise Exception("!!! {} has no variable {}".format(layer.name, suffix))
+
+def weight_snr(layer):
+    """
+    signal-to-noise ratio |mu|/sigma of each kernel weight of a flipout layer.
+    """
+    mean = layer.kernel_posterior.mean().numpy()
+    stddev = layer.kernel_posterior.stddev().numpy()
+    return np.abs(mean) / (stddev + np.finfo(np.float32).eps)
+
+def count_params(model):
+    """
+    number of posterior means (kernels and biases) of a BayesianCNN,
+    the total and the non-zero ones.
+    """
+    total, nonzero = 0, 0
+    for w in model.weights:
+        if w.name.split('/')[-1].split(':')[0] in \
+                ['kernel_posterior_loc', 'bias_posterior_loc', 'kernel', 'bias']:
+            total += int(np.prod(w.shape))
+            nonzero += int(np.count_nonzero(w.numpy()))
+    return total, nonzero
+
+
+class SNRPruner(object):
+    """
+    prune a trained BayesianCNN with the signal-to-noise ratio of the weight
+    posteriors. Whole channels (conv) and units (dense) with the lowest mean
+    SNR are removed, so the pruned model has physically smaller layers. The
+    individual low-SNR weights of the remaining channels are set to zero with
+    (almost) zero stddev.
+    """
+    def __init__(self, params, model):
+        # the pruned model is rebuilt as a BayesianCNN with fewer filters,
+        # the other BNNs have different layers and priors.
+        if type(model) is not BayesianCNN:
+            raise Exception("!!! SNR pruning supports BayesianCNN only, not {}".format(
+                            type(model).__name__))
+        self.params = params
+        self.model = model
+        self.log_file = self.params.log.log_file
+        self.layers = [model.variational_conv1, model.variational_conv2,
+                       model.variational_conv3, model.variational_conv4,
+                       model.dense1, model.dense2, model.dense3]
+
+    def channel_ranking(self, channel_sparsity):
+        """
+        indices of the output channels to keep for each flipout layer.
+        the output layer is never pruned.
+        """
+        keep_ls = []
+        for layer in self.layers[:-1]:
+            snr = weight_snr(layer)
+            channel_snr = np.mean(snr.reshape(-1, snr.shape[-1]), axis=0)
+            num_keep = max(1, int(round(len(channel_snr) * (1 - channel_sparsity))))
+            keep = np.sort(np.argsort(channel_snr)[::-1][:num_keep])
+            keep_ls.append(keep)
+        keep_ls.append(np.arange(self.model.num_cls))
+        return keep_ls
+
+    def prune(self, channel_sparsity, weight_sparsity):
+        """
+        build the compacted model.
+        Args:
+            channel_sparsity: fraction of channels/units removed per layer.
+            weight_sparsity: fraction of the remaining weights set to zero
+                             per layer, lowest SNR first.
+        Return:
+            pruned: pruned BayesianCNN.
+        """
+        keep_ls = self.channel_ranking(channel_sparsity)
+        filters = [len(keep) for keep in keep_ls[:-1]]
+        pruned = BayesianCNN(self.params, self.model.kl_weight, filters=filters)
+        pruned.build(input_shape=(None, 256, 256, 1))
+        for w_src, w_dst in zip(self.model.constrained_conv_layer.weights,
+                                pruned.constrained_conv_layer.weights):
+            w_dst.assign(w_src)
+
+        pruned_layers = [pruned.variational_conv1, pruned.variational_conv2,
+                         pruned.variational_conv3, pruned.variational_conv4,
+                         pruned.dense1, pruned.dense2, pruned.dense3]
+        # constrained conv layer has 3 output channels
+        keep_in = np.arange(3)
+        for i, (src, dst) in enumerate(zip(self.layers, pruned_layers)):
+            keep_out = keep_ls[i]
+            loc = layer_variable(src, 'kernel_posterior_loc').numpy()
+            scale = layer_variable(src, 'kernel_posterior_untransformed_scale').numpy()
+            snr = weight_snr(src)
+            if i == 4:
+                # the flattened features of conv4 are ordered (height, width, channel)
+                num_channels = self.layers[3].filters
+                flat_idx = np.arange(loc.shape[0]).reshape(-1, num_channels)
+                keep_in = flat_idx[:, keep_in].ravel()
+            loc = np.take(np.take(loc, keep_in, axis=-2), keep_out, axis=-1)
+            scale = np.take(np.take(scale, keep_in, axis=-2), keep_out, axis=-1)
+            snr = np.take(np.take(snr, keep_in, axis=-2), keep_out, axis=-1)
+            if weight_sparsity > 0:
+                mask = snr <= np.quantile(snr, weight_sparsity)
+                loc[mask] = 0.
+                # softplus(-30) is ~1e-13, i.e. a deterministic zero weight
+                scale[mask] = -30.
+            layer_variable(dst, 'kernel_posterior_loc').assign(loc)
+            layer_variable(dst, 'kernel_posterior_untransformed_scale').assign(scale)
+            bias = layer_variable(src, 'bias_posterior_loc').numpy()
+            layer_variable(dst, 'bias_posterior_loc').assign(bias[keep_out])
+            keep_in = keep_out
+        return pruned
+
+    def save(self, pruned, ckpt_dir):
+        """
+        save the compacted model with its number of filters, so that it can
+        be rebuilt with BayesianCNN(params, kl_weight, filters).
+        """
+        if not os.path.exists(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        ckpt = tf.train.Checkpoint(step=tf.Variable(1),
+                        optimizer=keras.optimizers.Adam(),
+                        net=pruned)
+        manager = tf.train.CheckpointManager(ckpt, ckpt_dir, max_to_keep=1)
+        save_path = manager.save()
+        with open(os.path.join(ckpt_dir, 'filters.json'), 'w') as f:
+            json.dump(pruned.filters, f)
+        msg = "Saved pruned model with filters {}: {}\n".format(
+                pruned.filters, save_path)
+        write_log(self.log_file, msg)
@@ -1,12 +1,5 @@
 #!/bin/bash
-VANILLA=params/vanilla_cnn.json
-python main.py -p $VANILLA
-
-BNN=params/bayesian_cnn.json
-python main.py -p $BNN
-
-ENSEMBLE=params/ensemble_cnn.json
-python main.py -p $ENSEMBLE
-
-EXPERIMENT=params/experiment.json
-python main.py -p $EXPERIMENT
+# data preparation, training of the vanilla CNN, BNN, ensemble and student,
+# evaluation and experiments. Unchanged stages are skipped on reruns.
+PIPELINE=params/pipeline.json
+python pipeline.py -p $PIPELINE
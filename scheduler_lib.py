@@ -0,0 +1,109 @@
+import os
+import copy
+import time
+import multiprocessing
+from utils.misc import write_log
+
+
+class ExperimentScheduler(object):
+    """
+    run independent experiments concurrently, each in its own process with
+    a budget of CPU threads. A new experiment is only started if the
+    estimated memory of the running experiments stays within the limit.
+    Every experiment writes to its own log file, the logs are appended to
+    the main log file once all experiments are finished.
+    """
+    def __init__(self, params, target):
+        """
+        Args:
+            params: parameters from the json file.
+            target: function(params, name, intra_op_threads, inter_op_threads)
+                    running one experiment, it must be importable by the
+                    spawned processes.
+        """
+        self.params = params
+        self.config = self.params.scheduler
+        self.target = target
+        self.log_file = self.params.log.log_file
+        self.num_threads = self.config.num_threads or os.cpu_count()
+        self.intra_op_threads = min(self.config.intra_op_threads, self.num_threads)
+        self.memory_limit = self.config.memory_limit_gb
+        # the most experiments running at once with their thread budget
+        self.max_running = max(1, self.num_threads // self.intra_op_threads)
+
+    def memory_estimate(self, name):
+        return getattr(self.config.memory_estimates_gb, name,
+                       self.config.default_memory_gb)
+
+    def log_path(self, name):
+        return os.path.join(self.params.log.log_dir, 'experiment_{}.log'.format(name))
+
+    def fits(self, name, running):
+        """
+        whether the experiment can start next to the running ones, an
+        experiment exceeding the budgets on its own runs alone.
+        """
+        if not running:
+            return True
+        memory = sum(self.memory_estimate(n) for n in running)
+        threads = len(running) * self.intra_op_threads
+        return (memory + self.memory_estimate(name) <= self.memory_limit and
+                threads + self.intra_op_threads <= self.num_threads)
+
+    def start(self, ctx, name):
+        params = copy.deepcopy(self.params)
+        params.log.log_file = self.log_path(name)
+        # the decoded datasets are cached by each process
+        params.dataloader.cache_memory_mb = \
+            params.dataloader.cache_memory_mb / self.max_running
+        if os.path.exists(params.log.log_file):
+            os.remove(params.log.log_file)
+        process = ctx.Process(target=self.target, name=name,
+                              args=(params, name, self.intra_op_threads,
+                                    self.config.inter_op_threads))
+        process.start()
+        msg = "... Started {} (pid {}, {} threads, ~{} GB)\n".format(
+                name, process.pid, self.intra_op_threads, 
+                self.memory_estimate(name))
+        write_log(self.log_file, msg)
+        return process
+
+    def run(self, names):
+        """
+        Args:
+            names: names of the enabled experiments, in order of priority.
+        Return:
+            results: dict of the exit code and wall time of each experiment.
+        """
+        # tensorflow is not fork-safe once initialised
+        ctx = multiprocessing.get_context('spawn')
+        pending = list(names)
+        running, results = {}, {}
+        while pending or running:
+            while pending and self.fits(pending[0], running):
+                name = pending.pop(0)
+                running[name] = (self.start(ctx, name), time.time())
+            time.sleep(1)
+            for name, (process, start) in list(running.items()):
+                if not process.is_alive():
+                    process.join()
+                    results[name] = (process.exitcode, time.time() - start)
+                    del running[name]
+                    msg = "... Finished {} with exit code {} in {:.0f} s\n".format(
+                            name, process.exitcode, results[name][1])
+                    write_log(self.log_file, msg)
+        self.merge_logs(names, results)
+        return results
+
+    def merge_logs(self, names, results):
+        for name in names:
+            msg = "\n===================== {} (exit code {}, {:.0f} s) =====================\n".format(
+                    name, results[name][0], results[name][1])
+            if os.path.exists(self.log_path(name)):
+                with open(self.log_path(name)) as f:
+                    msg += f.read()
+            with open(self.log_file, 'a') as f:
+                f.write(msg)
+        failed = [name for name in names if results[name][0] != 0]
+        if failed:
+            raise Exception("!!! Experiments failed: {}".format(", ".join(failed)))
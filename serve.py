@@ -0,0 +1,108 @@
+import os
+import io
+import json
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from skimage import io as skio
+from inference_lib import DynamicBatcher, build_predictor, image_scores
+from utils.misc import configure_devices, get_args, get_params, write_log
+from utils.patch import patchify_image
+
+
+def make_handler(params, batcher):
+    """
+    create the request handler, each request is served in its own thread
+    and waits for the predictions from the dynamic batcher.
+    """
+    brand_models = params.dataloader.brand_models
+    extract_span = params.serve.extract_span
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.reply(200, {'status': 'ok'})
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            """
+            POST /predict with the encoded full-sized image as body.
+            """
+            if self.path != '/predict':
+                self.reply(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers['Content-Length'])
+                img = skio.imread(io.BytesIO(self.rfile.read(length)),
+                                  plugin='pil')
+                patches = patchify_image(img, extract_span).reshape((-1, 256, 256, 1))
+            except Exception as err:
+                self.reply(400, {'error': 'unable to decode the image: {}'.format(err)})
+                return
+            # same scaling as parse_image
+            patches = patches.astype(np.float32) / 255.
+            try:
+                mc_softmax_prob = batcher.submit(patches).result()
+            except Exception as err:
+                self.reply(500, {'error': str(err)})
+                return
+            probs, entropy, epistemic = image_scores(mc_softmax_prob)
+            self.reply(200, {
+                'brand_model': brand_models[int(np.argmax(probs))],
+                'probabilities': dict(zip(brand_models, probs.tolist())),
+                'entropy': float(entropy),
+                'epistemic': float(epistemic),
+                'num_patches': len(patches)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(params):
+    """
+    run the camera model identification server on localhost.
+    """
+    configure_devices()
+    predictor = build_predictor(params, params.serve)
+    batcher = DynamicBatcher(predictor,
+                             params.serve.max_batch_size,
+                             params.serve.max_wait_ms)
+    server = ThreadingHTTPServer((params.serve.host, params.serve.port),
+                                 make_handler(params, batcher))
+    msg = "... Serving {} on http://{}:{}\n".format(params.serve.model,
+                                                    params.serve.host,
+                                                    params.serve.port)
+    write_log(params.log.log_file, msg)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def main():
+    try:
+        args = get_args()
+        params = get_params(args.params)
+    except Exception as err:
+        print(err)
+        print("... missing or invalid arguments")
+        exit(0)
+    if not os.path.exists(params.log.log_dir):
+        os.makedirs(params.log.log_dir)
+    for b, m in zip(params.dataloader.brands,
+                    params.dataloader.models):
+        params.dataloader.brand_models.append("_".join([b, m]))
+    serve(params)
+
+if __name__ == '__main__':
+    main()
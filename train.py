@@ -1,47 +1,107 @@
-import os
 import tensorflow as tf
-from utils.data_preparation import build_dataset
-from utils.misc import instantiate, write_log
-gpus = tf.config.experimental.list_physical_devices('GPU')
-tf.config.experimental.set_memory_growth(gpus[0], True)
+from utils.data_preparation import build_dataset, build_patch_index, dataset_cache, \
+    num_train_examples, read_image_list, IndexSampler
+from utils.misc import configure_devices, instantiate, write_log
+from utils.host_profile import apply_host_profile, set_threads
+from utils.distribute import build_strategy
+
+
+def resume_step(ckpt_dir, steps_per_epoch):
+    """
+    number of training steps done before the latest checkpoint, the step
+    variable of the checkpoint counts the epochs starting at 1.
+    """
+    latest = tf.train.latest_checkpoint(ckpt_dir)
+    if latest is None:
+        return 0
+    epochs = int(tf.train.load_variable(latest, 'step/.ATTRIBUTES/VARIABLE_VALUE')) - 1
+    return epochs * steps_per_epoch
 
 
 def train_eval(params):
+    configure_devices()
+    # batch sizes and threads found by the autotune command on this host
+    threads = apply_host_profile(params, 'train')
+    if threads is not None:
+        set_threads(*threads)
+    # None without the distribute block of the trainer
+    strategy = build_strategy(params)
     msg = "... Preparing dataset\n"
     write_log(params.log.log_file, msg)
     # collect & split in to train, val and test & extract to patches
-    dataloader = instantiate("dataloader_lib", 
-                    params.dataloader.name)(params)
-    dataloader.load_data()
+    # the pipeline prepares the data in its own stages
+    if params.run.prepare:
+        dataloader = instantiate("dataloader_lib", 
+                        params.dataloader.name)(params)
+        dataloader.load_data()
     # claculate the kl_weight for BNN.
-    examples_per_epoch = 0
-    for m in params.dataloader.brand_models:
-        examples_per_epoch += len(os.listdir(os.path.join(
-                                params.dataloader.patch_dir, 
-                                "train", m)))
-    if params.model.name in ["BayesianCNN", "EB_BayesianCNN"]:
-        model = instantiate("model_lib", 
-                            params.model.name)(params, examples_per_epoch)
-    else:
-        model = instantiate("model_lib", 
-                    params.model.name)(params)    
-    trainer = instantiate("trainer_lib", params.trainer.name)(params, model)
+    examples_per_epoch = num_train_examples(params)
+    # the variables of the model, the optimizer and the metrics are mirrored
+    with (strategy or tf.distribute.get_strategy()).scope():
+        if params.model.name in ["BayesianCNN", "EB_BayesianCNN", "LastLayerBayesianCNN"]:
+            model = instantiate("model_lib", 
+                                params.model.name)(params, examples_per_epoch)
+        else:
+            model = instantiate("model_lib", 
+                        params.model.name)(params)    
+        if strategy is not None:
+            trainer = instantiate("trainer_lib", params.trainer.name)(params, model, strategy)
+        else:
+            trainer = instantiate("trainer_lib", params.trainer.name)(params, model)
 
     if params.run.train:
         # if True, the minority class will be oversampled during training.
         # if False, the training set will be enforce to have the same amount of data for each class.
         class_imbalance = False if params.dataloader.even_database else True
-        train_iter = build_dataset(params.dataloader.patch_dir,
-                                    params.dataloader.brand_models,
-                                    'train', params.trainer.batch_size,
-                                    class_imbalance=class_imbalance)
+        if params.trainer.name == "DistillationTrainer":
+            # images are served with the cached predictions of the teacher
+            train_iter = trainer.build_train_iter()
+        elif params.dataloader.patch_sampling == 'random':
+            # random patch locations of the full-sized images at every epoch
+            train_iter = build_dataset(params.dataloader.patch_dir,
+                                        params.dataloader.brand_models,
+                                        'random_train', params.trainer.batch_size,
+                                        img_paths=read_image_list(params.dataloader.patch_dir),
+                                        class_imbalance=class_imbalance,
+                                        patches_per_image=params.dataloader.patches_per_image,
+                                        strategy=strategy)
+        elif params.dataloader.sampler == 'index':
+            # exact class weights and global permutations, resumed from the checkpoint
+            paths, labels = build_patch_index(params.dataloader.patch_dir,
+                                        params.dataloader.brand_models,
+                                        min_score=params.dataloader.min_patch_score)
+            class_weights = params.dataloader.class_weights
+            if class_weights is None and class_imbalance:
+                class_weights = 'balanced'
+            sampler = IndexSampler(labels, len(params.dataloader.brand_models),
+                                    class_weights=class_weights,
+                                    seed=params.dataloader.random_seed)
+            start = (resume_step(params.trainer.ckpt_dir, trainer.num_train_steps) 
+                     * params.trainer.batch_size)
+            train_iter = build_dataset(params.dataloader.patch_dir,
+                                        params.dataloader.brand_models,
+                                        'train', params.trainer.batch_size,
+                                        img_paths=paths, sampler=sampler,
+                                        start=start,
+                                        strategy=strategy)
+        else:
+            train_iter = build_dataset(params.dataloader.patch_dir,
+                                        params.dataloader.brand_models,
+                                        'train', params.trainer.batch_size,
+                                        class_imbalance=class_imbalance,
+                                        min_score=params.dataloader.min_patch_score,
+                                        strategy=strategy)
+        # decoded validation patches are reused across epochs if enabled
         val_iter = build_dataset(params.dataloader.patch_dir, 
                                 params.dataloader.brand_models,
-                                'val', params.trainer.batch_size)
+                                'val', params.trainer.batch_size,
+                                cache=dataset_cache(params),
+                                strategy=strategy)
         trainer.train(train_iter, val_iter)
 
     if params.run.evaluate:
         test_iter = build_dataset(params.dataloader.patch_dir,
                                 params.dataloader.brand_models,
-                                'test', params.evaluate.batch_size)
+                                'test', params.evaluate.batch_size,
+                                strategy=strategy)
         trainer.evaluate(test_iter)
\ No newline at end of file
@@ -3,15 +3,26 @@ import datetime
 import numpy as np
 import tensorflow as tf
 from tqdm import trange
-from utils.misc import write_log
+from utils.misc import instantiate, write_log
+from utils.data_preparation import build_dataset, build_distillation_dataset, num_train_examples
 from utils.visualization import plot_weight_posteriors, plot_held_out
+from utils.posterior_stats import PosteriorStats, PERCENTILES
+from utils.profiling import StepTimer, TraceWindow
 from model_lib import VanillaCNN
 keras = tf.keras
 
 
 class BaseTrainer(object):
-    def __init__(self, params):
+    def __init__(self, params, strategy=None):
+        """
+        Args:
+            params: parameters from the json file.
+            strategy: tf.distribute strategy the trainer was created in,
+                      None for the default device.
+        """
         self.params = params
+        self.distributed = strategy is not None
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
         self.constrained_weights = None
         self.brand_models = self.params.dataloader.brand_models
         self.num_cls = len(self.brand_models)
@@ -65,11 +76,14 @@ class BaseTrainer(object):
         Return:
             num_steps: number of step needed to iterate the whole dataset.
         """
-        size = 0
-        for m in self.brand_models:
-            size += len(os.listdir(os.path.join(
-                                    self.params.dataloader.patch_dir, 
-                                    dataset, m)))
+        if dataset == 'train':
+            size = num_train_examples(self.params)
+        else:
+            size = 0
+            for m in self.brand_models:
+                size += len(os.listdir(os.path.join(
+                                        self.params.dataloader.patch_dir, 
+                                        dataset, m)))
         num_steps = ((size + batch_size - 1) // batch_size)
         return num_steps
 
@@ -96,6 +110,14 @@ class BaseTrainer(object):
             tf.summary.scalar('accuracy', self.best_acc, step=self.step_idx)
             self.val_writer.flush()
 
+    def profile_init(self):
+        """
+        initialization for timing the training steps and the profiler trace.
+        """
+        profile = self.params.trainer.profile
+        self.timer = StepTimer(self.params.trainer.batch_size, profile.timing)
+        self.trace = TraceWindow(profile.trace_dir, profile.trace_steps)
+
     def checkpoint_init(self):
         """
         if checkpoint exists, restore the checkpoint. if not, initialize for saving checkpoints. 
@@ -121,9 +143,12 @@ class VanillaTrainer(BaseTrainer):
     """
     training loop for vanilla (baseline) CNN.
     """
-    def __init__(self, params, model):
-        super(VanillaTrainer, self).__init__(params)
+    def __init__(self, params, model, strategy=None):
+        super(VanillaTrainer, self).__init__(params, strategy)
         self.model = model
+        # per-example losses, averaged over the global batch in the train step
+        self.loss_object = keras.losses.CategoricalCrossentropy(
+                            from_logits=True, reduction=keras.losses.Reduction.NONE)
         self.num_train_steps = self.compute_steps('train',
                                         self.params.trainer.batch_size)
         self.num_val_steps = self.compute_steps('val',
@@ -133,13 +158,23 @@ class VanillaTrainer(BaseTrainer):
 
     @tf.function
     def train_step(self, images, labels):
+        if self.distributed:
+            # mirrored variables are only assigned in cross-replica context,
+            # the models skip this update under a strategy
+            self.model.constrained_conv_update()
+        self.strategy.run(self.replica_train_step, args=(images, labels))
+
+    def replica_train_step(self, images, labels):
         with tf.GradientTape() as tape:
             logits = self.model(images, training=True)
-            loss = self.loss_object(labels, logits)
+            per_example_loss = self.loss_object(labels, logits)
+            # the gradients of the replicas are summed
+            loss = tf.nn.compute_average_loss(per_example_loss,
+                            global_batch_size=self.params.trainer.batch_size)
         gradients = tape.gradient(loss, self.model.trainable_weights)
         self.optimizer.apply_gradients(zip(gradients,
                 self.model.trainable_weights))
-        self.train_loss.update_state(loss)
+        self.train_loss.update_state(per_example_loss)
         self.train_acc.update_state(labels, logits)
         if self.step_idx % 150 == 0:
             with self.train_writer.as_default():
@@ -155,6 +190,12 @@ class VanillaTrainer(BaseTrainer):
 
     @tf.function
     def eval_step(self, images, labels):
+        corr_count, total = self.strategy.run(self.replica_eval_step, 
+                                            args=(images, labels))
+        return (self.strategy.reduce(tf.distribute.ReduceOp.SUM, corr_count, axis=None),
+                self.strategy.reduce(tf.distribute.ReduceOp.SUM, total, axis=None))
+
+    def replica_eval_step(self, images, labels):
         with tf.GradientTape() as tape:
             logits = self.model(images)
             loss = self.loss_object(labels, logits)
@@ -172,9 +213,11 @@ class VanillaTrainer(BaseTrainer):
         """
         train and validation.
         """
-        self.model.build(input_shape=(None, 256, 256, 1))
+        with self.strategy.scope():
+            self.model.build(input_shape=(None, 256, 256, 1))
         self.model.summary()
         self.tensorboard_init()
+        self.profile_init()
         self.checkpoint_init()
         stop_count = 0
 
@@ -190,32 +233,39 @@ class VanillaTrainer(BaseTrainer):
             # training loop
             for step in trange(self.num_train_steps):
                 self.step_idx = offset + step
-                images, labels = train_iter.get_next()
-                self.train_step(images, labels)
+                self.trace.step(self.step_idx)
+                with self.timer.phase('wait'):
+                    # images, labels (and teacher outputs for distillation)
+                    batch = train_iter.get_next()
+                with self.timer.phase('compute'):
+                    self.train_step(*batch)
+                    self.timer.sync(self.train_loss.count)
                 # self.constrained_conv_update()
-                self.train_writer.flush()
-
-                with self.train_writer.as_default():
-                    tf.summary.scalar('loss', self.train_loss.result(), step=self.step_idx)
-                    tf.summary.scalar('accuracy', self.train_acc.result(), step=self.step_idx)
+                with self.timer.phase('summary'):
                     self.train_writer.flush()
 
-                if (step+1) % self.params.log.log_step == 0:
-                    msg = (('Epoch: {}, Step: {}, '
-                            'train loss: {:.3f}, train accuracy: {:.3%}\n')
-                            .format(epoch, self.step_idx, 
-                            self.train_loss.result(), 
-                            self.train_acc.result()))
-                    write_log(self.log_file, msg)
+                    with self.train_writer.as_default():
+                        tf.summary.scalar('loss', self.train_loss.result(), step=self.step_idx)
+                        tf.summary.scalar('accuracy', self.train_acc.result(), step=self.step_idx)
+                        self.train_writer.flush()
+
+                    if (step+1) % self.params.log.log_step == 0:
+                        msg = (('Epoch: {}, Step: {}, '
+                                'train loss: {:.3f}, train accuracy: {:.3%}\n')
+                                .format(epoch, self.step_idx, 
+                                self.train_loss.result(), 
+                                self.train_acc.result()))
+                        write_log(self.log_file, msg)
 
             # validation
             corr_ls = [0 for x in self.brand_models]
             total_ls = [0 for x in self.brand_models]
-            for step in trange(self.num_val_steps):
-                images, labels = val_iter.get_next()
-                c, t = self.eval_step(images, labels)
-                corr_ls = [sum(x) for x in zip(corr_ls, c)]
-                total_ls = [sum(x) for x in zip(total_ls, t)]
+            with self.timer.phase('validation'):
+                for step in trange(self.num_val_steps):
+                    images, labels = val_iter.get_next()
+                    c, t = self.eval_step(images, labels)
+                    corr_ls = [sum(x) for x in zip(corr_ls, c)]
+                    total_ls = [sum(x) for x in zip(total_ls, t)]
 
             with self.val_writer.as_default():
                 tf.summary.scalar('loss', self.eval_loss.result(), step=self.step_idx)
@@ -239,13 +289,16 @@ class VanillaTrainer(BaseTrainer):
                 self.best_acc = self.eval_acc.result()
                 self.best_loss = self.eval_loss.result()
                 stop_count = 0
-                save_path = self.manager.save()
+                with self.timer.phase('checkpoint'):
+                    save_path = self.manager.save()
                 msg = "Saved checkpoint for epoch {}: {}\n\n".format(epoch, self.params.trainer.ckpt_dir)
                 write_log(self.log_file, msg)
             else:
                 stop_count += 1
-                if stop_count >= self.params.trainer.patience:
-                    break
+            self.timer.log(self.log_file, self.train_writer, epoch, self.step_idx)
+            if stop_count >= self.params.trainer.patience:
+                break
+        self.trace.close()
         msg = '\n... Finished training\n'
         write_log(self.log_file, msg)
 
@@ -253,7 +306,8 @@ class VanillaTrainer(BaseTrainer):
         """
         evalution.
         """
-        self.model.build(input_shape=(None, 256, 256, 1))
+        with self.strategy.scope():
+            self.model.build(input_shape=(None, 256, 256, 1))
         self.checkpoint_init()
         self.eval_acc.reset_states()
         self.eval_loss.reset_states()
@@ -273,6 +327,127 @@ class VanillaTrainer(BaseTrainer):
             msg = '{} accuracy: {:.3%}\n'.format(m, c / t)
             write_log(self.log_file, msg)
 
+class DistillationTrainer(VanillaTrainer):
+    """
+    distil the mean predictive distribution and the uncertainty of an 
+    ensemble or a BNN (teacher) into a single StudentCNN.
+    """
+    def __init__(self, params, model):
+        super(DistillationTrainer, self).__init__(params, model)
+        # the distillation loss is not distributed, the mean over the batch
+        self.loss_object = keras.losses.CategoricalCrossentropy(from_logits=True)
+        self.teacher = self.params.distillation.teacher
+        self.cache_dir = self.params.distillation.cache_dir
+        self.label_weight = self.params.distillation.label_weight
+        self.uncertainty_weight = self.params.distillation.uncertainty_weight
+        self.soft_loss_object = keras.losses.CategoricalCrossentropy(from_logits=True)
+        self.uncertainty_loss_object = keras.losses.MeanSquaredError()
+
+    def teacher_predictions(self, img_paths):
+        """
+        softmax predictions of every member of the ensemble, or of every 
+        Monte Carlo draw of the BNN.
+        Args:
+            img_paths: image paths.
+        Return:
+            mc_softmax_prob: shape of [# of members/draws, # of images, # of classes].
+        """
+        batch_size = self.params.evaluate.batch_size
+        num_steps = (len(img_paths) + batch_size - 1) // batch_size
+        if self.teacher == "EnsembleCNN":
+            ckpt_dirs = [os.path.join(self.params.distillation.teacher_ckpt_dir, 
+                                      str(i)) 
+                        for i in range(self.params.distillation.num_teacher_samples)]
+        else:
+            ckpt_dirs = [self.params.distillation.teacher_ckpt_dir]
+        mc_softmax_prob = []
+        for ckpt_dir in ckpt_dirs:
+            if self.teacher == "EnsembleCNN":
+                model = instantiate("model_lib", self.teacher)(self.params)
+                num_draws = 1
+            else:
+                # the kl term is not used for predictions
+                model = instantiate("model_lib", self.teacher)(self.params, 1)
+                num_draws = self.params.distillation.num_teacher_samples
+            model.build(input_shape=(None, 256, 256, 1))
+            ckpt = tf.train.Checkpoint(net=model)
+            ckpt.restore(tf.train.latest_checkpoint(ckpt_dir)).expect_partial()
+            msg = "\nRestored teacher from {}\n".format(ckpt_dir)
+            write_log(self.log_file, msg)
+            predict = tf.function(lambda images: tf.nn.softmax(model(images)))
+            for draw in range(num_draws):
+                # a new iterator for each draw starts from the first image.
+                iterator = build_dataset(self.params.dataloader.patch_dir,
+                                        self.brand_models, "teacher",
+                                        batch_size, img_paths)
+                softmax_prob = []
+                for step in trange(num_steps):
+                    images, _ = iterator.get_next()
+                    softmax_prob.extend(predict(images).numpy())
+                # the dataset repeats, the last batch wraps around.
+                mc_softmax_prob.append(softmax_prob[:len(img_paths)])
+        return np.asarray(mc_softmax_prob)
+
+    def teacher_cache(self, dataset):
+        """
+        load the cached teacher outputs, or run the teacher and cache them.
+        Args:
+            dataset: type of dataset, train/val.
+        Return:
+            img_paths: image paths.
+            probs: teacher's mean predictive distribution.
+            uncertainty: teacher's entropy and epistemic uncertainty.
+        """
+        cache_file = os.path.join(self.cache_dir,
+                        '{}_{}.npz'.format(self.teacher, dataset))
+        img_paths = []
+        for m in self.brand_models:
+            d = os.path.join(self.params.dataloader.patch_dir, dataset, m)
+            img_paths.extend([os.path.join(d, f) for f in sorted(os.listdir(d))])
+        if os.path.exists(cache_file):
+            cache = np.load(cache_file)
+            if list(cache['img_paths']) == img_paths:
+                msg = "... Loaded teacher predictions from {}\n".format(cache_file)
+                write_log(self.log_file, msg)
+                return img_paths, cache['probs'], cache['uncertainty']
+        msg = "... Caching teacher predictions for {} set\n".format(dataset)
+        write_log(self.log_file, msg)
+        mc_softmax_prob = self.teacher_predictions(img_paths)
+        probs = np.mean(mc_softmax_prob, axis=0)
+        entropy = -np.sum(probs * np.log(probs + np.finfo(float).eps), axis=1)
+        # sum over the diagonal of the epistemic uncertainty matrix
+        epistemic = np.sum(np.var(mc_softmax_prob, axis=0), axis=1)
+        uncertainty = np.stack([entropy, epistemic], axis=1)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        np.savez(cache_file, img_paths=np.asarray(img_paths),
+                 probs=probs, uncertainty=uncertainty)
+        return img_paths, probs, uncertainty
+
+    def build_train_iter(self):
+        img_paths, probs, uncertainty = self.teacher_cache('train')
+        return build_distillation_dataset(img_paths, self.brand_models,
+                                        self.params.trainer.batch_size,
+                                        probs, uncertainty)
+
+    @tf.function
+    def train_step(self, images, labels, teacher_probs, teacher_uncertainty):
+        with tf.GradientTape() as tape:
+            logits, uncertainty = self.model(images, training=True,
+                                            return_uncertainty=True)
+            soft_loss = self.soft_loss_object(teacher_probs, logits)
+            hard_loss = self.loss_object(labels, logits)
+            uncertainty_loss = self.uncertainty_loss_object(teacher_uncertainty,
+                                                            uncertainty)
+            loss = (soft_loss + self.label_weight * hard_loss + 
+                    self.uncertainty_weight * uncertainty_loss)
+        gradients = tape.gradient(loss, self.model.trainable_weights)
+        self.optimizer.apply_gradients(zip(gradients,
+                self.model.trainable_weights))
+        self.train_loss.update_state(loss)
+        self.train_acc.update_state(labels, logits)
+
+
 class EnsembleTrainer(object):
     def __init__(self, params, model):
         self.params = params
@@ -305,8 +480,8 @@ class EnsembleTrainer(object):
             trainer.evaluate(test_iter)
 
 class BayesianTrainer(BaseTrainer):
-    def __init__(self, params, model):
-        super(BayesianTrainer, self).__init__(params)
+    def __init__(self, params, model, strategy=None):
+        super(BayesianTrainer, self).__init__(params, strategy)
         self.model = model
         self.num_train_steps = self.compute_steps('train',
                                         self.params.trainer.batch_size)
@@ -324,7 +499,38 @@ class BayesianTrainer(BaseTrainer):
         self.optimizer = keras.optimizers.Adam(learning_rate=self.params.trainer.lr)
         self.kl_loss = keras.metrics.Mean(name='kl_loss')
         self.nll_loss = keras.metrics.Mean(name='nll_loss')
+        self.posterior_stats = PosteriorStats(self.params.evaluate.posterior_stats_bins)
     
+    def weight_stats(self, step, prior_fname, posterior_fname):
+        """
+        compute the statistics of the weight distributions of each layer,
+        save them next to the posterior plot and log them to tensorboard.
+        the weights are plotted only if evaluate.plot_weights is set.
+        Args:
+            step: tensorboard step, 0 for initialized and 1 for trained weights.
+            prior_fname: file path of the prior distribution plot.
+            posterior_fname: file path of the posterior plot.
+        """
+        stats = self.posterior_stats.model_stats(self.model)
+        self.posterior_stats.save(stats, posterior_fname + '_stats.npz')
+        if not hasattr(self, 'posterior_writer'):
+            self.posterior_writer = tf.summary.create_file_writer(
+                            os.path.join(self.params.log.tensorboard_dir,
+                                         self.params.run.name,
+                                         'posterior_stats'))
+        self.posterior_stats.log(stats, self.posterior_writer, step)
+        for name, dists in stats.items():
+            posterior = dists['posterior']
+            median = PERCENTILES.index(50.)
+            msg = "... {}: {} weights, median stddev {:.4f}, median SNR {:.3f}, " \
+                  "SNR < 1: {:.1%}\n".format(name, posterior['num_weights'],
+                                            posterior['stddev/percentiles'][median],
+                                            posterior['snr/percentiles'][median],
+                                            posterior['snr/below_1'])
+            write_log(self.log_file, msg)
+        if self.params.evaluate.plot_weights:
+            self.plot_weights(prior_fname, posterior_fname)
+
     def plot_weights(self, prior_fname, posterior_fname):
         """
         plot the weights distribution for each layer.
@@ -356,17 +562,29 @@ class BayesianTrainer(BaseTrainer):
 
     @tf.function
     def train_step(self, images, labels):
+        if self.distributed:
+            # mirrored variables are only assigned in cross-replica context,
+            # the models skip this update under a strategy
+            self.model.constrained_conv_update()
+        self.strategy.run(self.replica_train_step, args=(images, labels))
+
+    def replica_train_step(self, images, labels):
         with tf.GradientTape() as tape:
             logits = self.model(images, training=True)
             nll = self.loss_object(labels, logits)
             kl = sum(self.model.losses)
-            loss = nll + kl
+            # the gradient of the per-example losses nll + kl summed over the
+            # batch, summing the gradients of the replicas gives the one of
+            # the global batch. kl is already divided by the number of
+            # training examples (kl_weight).
+            batch_size = tf.cast(tf.shape(labels)[0], tf.float32)
+            loss = tf.math.reduce_sum(nll) + kl * batch_size
         gradients = tape.gradient(loss, self.model.trainable_weights)
         self.optimizer.apply_gradients(zip(gradients, 
                 self.model.trainable_weights))
         self.kl_loss.update_state(kl)  
         self.nll_loss.update_state(nll)
-        self.train_loss.update_state(loss)
+        self.train_loss.update_state(nll + kl)
         self.train_acc.update_state(labels, logits)
         # show histogram of gradients in tensorboard
         # if self.step_idx % 150 == 0:
@@ -382,12 +600,23 @@ class BayesianTrainer(BaseTrainer):
         #     self.train_writer.flush()
 
     @tf.function
-    def eval_step(self, images, labels):
+    def eval_step(self, images, labels, posterior_mean=False):
+        corr_count, total = self.strategy.run(self.replica_eval_step, 
+                                            args=(images, labels, posterior_mean))
+        return (self.strategy.reduce(tf.distribute.ReduceOp.SUM, corr_count, axis=None),
+                self.strategy.reduce(tf.distribute.ReduceOp.SUM, total, axis=None))
+
+    def replica_eval_step(self, images, labels, posterior_mean=False):
         with tf.GradientTape() as tape:
-            logits = self.model(images)
-            nll = self.loss_object(labels, logits)
-            kl = sum(self.model.losses)
-            loss = nll + kl
+            if posterior_mean:
+                # the flipout layers are not sampled, so there is no kl term.
+                logits = self.model(images, posterior_mean=True)
+                loss = self.loss_object(labels, logits)
+            else:
+                logits = self.model(images)
+                nll = self.loss_object(labels, logits)
+                kl = sum(self.model.losses)
+                loss = nll + kl
         # number of samples for each class
         total = tf.math.reduce_sum(labels, axis=0)
         gt = tf.math.argmax(labels, axis=1)
@@ -399,10 +628,13 @@ class BayesianTrainer(BaseTrainer):
         return corr_count, total
 
     def train(self, train_iter, val_iter):
-        self.model.build(input_shape=(None, 256, 256, 1))
+        with self.strategy.scope():
+            self.model.build(input_shape=(None, 256, 256, 1))
         self.model.summary()
         self.tensorboard_init()
+        self.profile_init()
         self.checkpoint_init()
+        stop_count = 0
 
         msg = ('... Training bayesian convolutional neural network\n\n')
         write_log(self.log_file, msg)
@@ -418,37 +650,43 @@ class BayesianTrainer(BaseTrainer):
             # train
             for step in trange(self.num_train_steps):
                 self.step_idx = offset + step
-                images, labels = train_iter.get_next()
-                self.train_step(images, labels)
+                self.trace.step(self.step_idx)
+                with self.timer.phase('wait'):
+                    images, labels = train_iter.get_next()
+                with self.timer.phase('compute'):
+                    self.train_step(images, labels)
+                    self.timer.sync(self.train_loss.count)
                 # self.constrained_conv_update()
-                self.train_writer.flush()
-
-                with self.train_writer.as_default():
-                    tf.summary.scalar('loss', self.train_loss.result(), step=self.step_idx)
-                    tf.summary.scalar('accuracy', self.train_acc.result(), step=self.step_idx)
-                    tf.summary.scalar('kl_loss', self.kl_loss.result(), step=self.step_idx)
-                    tf.summary.scalar('nll_loss', self.nll_loss.result(), step=self.step_idx)
+                with self.timer.phase('summary'):
                     self.train_writer.flush()
 
-                if (step+1) % self.params.log.log_step == 0:
-                    msg = ('Epoch: {}, Step: {}, '
-                            'train loss: {:.3f}, train accuracy: {:.3%}, '
-                            'kl loss: {:.3f}, nll loss: {:.3f}\n'
-                            .format(epoch, self.step_idx + 1,
-                                    self.train_loss.result(),
-                                    self.train_acc.result(),
-                                    self.kl_loss.result(),
-                                    self.nll_loss.result()))
-                    write_log(self.log_file, msg)
+                    with self.train_writer.as_default():
+                        tf.summary.scalar('loss', self.train_loss.result(), step=self.step_idx)
+                        tf.summary.scalar('accuracy', self.train_acc.result(), step=self.step_idx)
+                        tf.summary.scalar('kl_loss', self.kl_loss.result(), step=self.step_idx)
+                        tf.summary.scalar('nll_loss', self.nll_loss.result(), step=self.step_idx)
+                        self.train_writer.flush()
+
+                    if (step+1) % self.params.log.log_step == 0:
+                        msg = ('Epoch: {}, Step: {}, '
+                                'train loss: {:.3f}, train accuracy: {:.3%}, '
+                                'kl loss: {:.3f}, nll loss: {:.3f}\n'
+                                .format(epoch, self.step_idx + 1,
+                                        self.train_loss.result(),
+                                        self.train_acc.result(),
+                                        self.kl_loss.result(),
+                                        self.nll_loss.result()))
+                        write_log(self.log_file, msg)
 
             # validation
             corr_ls = [0 for x in self.brand_models]
             total_ls = [0 for x in self.brand_models]
-            for step in trange(self.num_val_steps):
-                images, labels = val_iter.get_next()
-                c, t = self.eval_step(images, labels)
-                corr_ls = [sum(x) for x in zip(corr_ls, c)]
-                total_ls = [sum(x) for x in zip(total_ls, t)]
+            with self.timer.phase('validation'):
+                for step in trange(self.num_val_steps):
+                    images, labels = val_iter.get_next()
+                    c, t = self.eval_step(images, labels)
+                    corr_ls = [sum(x) for x in zip(corr_ls, c)]
+                    total_ls = [sum(x) for x in zip(total_ls, t)]
 
             with self.val_writer.as_default():
                 tf.summary.scalar('loss', self.eval_loss.result(), step=self.step_idx)
@@ -471,14 +709,17 @@ class BayesianTrainer(BaseTrainer):
                 self.best_acc = self.eval_acc.result()
                 self.best_loss = self.eval_loss.result()
                 stop_count = 0
-                save_path = self.manager.save()
+                with self.timer.phase('checkpoint'):
+                    save_path = self.manager.save()
                 msg = ("Saved checkpoint for epoch {}: {}\n\n"
                         .format(epoch, save_path))
                 write_log(self.log_file, msg)
             else:
                 stop_count += 1
-                if stop_count >= self.params.trainer.patience:
-                    break
+            self.timer.log(self.log_file, self.train_writer, epoch, self.step_idx)
+            if stop_count >= self.params.trainer.patience:
+                break
+        self.trace.close()
         msg = '\n... Finished training\n'
         write_log(self.log_file, msg)
 
@@ -501,11 +742,12 @@ class BayesianTrainer(BaseTrainer):
         plot_held_out(images, labels, self.brand_models, mc_softmax_prob_out, fname)
 
     def evaluate(self, test_iter):
-        self.model.build(input_shape=(None, 256, 256, 1))
-        self.plot_weights(self.params.evaluate.initialized_prior,
+        with self.strategy.scope():
+            self.model.build(input_shape=(None, 256, 256, 1))
+        self.weight_stats(0, self.params.evaluate.initialized_prior,
                             self.params.evaluate.initialized_posterior)
         self.checkpoint_init()
-        self.plot_weights(self.params.evaluate.trained_prior,
+        self.weight_stats(1, self.params.evaluate.trained_prior,
                     self.params.evaluate.trained_posterior)
         self.eval_acc.reset_states()
         self.eval_loss.reset_states()
@@ -519,7 +761,8 @@ class BayesianTrainer(BaseTrainer):
             # if step % 30 == 0:
             #     self.mc_out_stats(images, labels, self.model, num_monte_carlo=50, 
             #                     fname="results/image_uncertainty_{}.png".format(step))
-            c, t = self.eval_step(images, labels)
+            c, t = self.eval_step(images, labels, 
+                                self.params.evaluate.posterior_mean)
             corr_ls = [sum(x) for x in zip(corr_ls, c)]
             total_ls = [sum(x) for x in zip(total_ls, t)]
         msg ='\n\ntest loss: {:.3f}, test accuracy: {:.3%}\n'.format(self.eval_loss.result(),
@@ -1,12 +1,18 @@
 import os
+import glob
+import atexit
+import hashlib
 import numpy as np
 import tensorflow as tf
 import cv2
+from PIL import Image
 from functools import partial
 from multiprocessing import Pool
 from skimage import io, filters, img_as_ubyte, img_as_float64
 from skimage.util import random_noise
 from tqdm import tqdm, trange
+from utils.patch import informative_patches, manifest_path, read_manifest
+from utils.resources import pool_size, stage, throttled_map
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
@@ -36,12 +42,370 @@ def parse_image(img_path, brand_models):
     # image = tf.image.resize(image, [params.IMG_HEIGHT, params.IMG_WIDTH])
     return image, onehot_label
 
+
+def large_enough(img_paths, patch_size=256):
+    """
+    the images from which patches of patch_size can be cropped, only the
+    headers are read. Smaller images would stop the input pipeline, they
+    are skipped with a warning.
+    """
+    kept = []
+    for img_path in img_paths:
+        with Image.open(img_path) as img:
+            width, height = img.size
+        if height < patch_size or width < patch_size:
+            print("... Skipping {} ({} x {}), smaller than the patches".format(
+                    img_path, width, height))
+            continue
+        kept.append(img_path)
+    return kept
+
+def sample_patches(img_path, num_patches, patch_size=256):
+    """
+    crop patches at random locations from the green channel of a full-sized
+    image, the locations are drawn again at every call. The image is decoded
+    once for all its patches.
+    Args:
+        img_path: full path of the source image.
+        num_patches: number of patches cropped from the image.
+        patch_size: height and width of the patches.
+    Return:
+        patches: shape of [num_patches, patch_size, patch_size, 1] in range 0-1.
+    """
+    image = tf.io.decode_image(tf.io.read_file(img_path), channels=3,
+                               expand_animations=False)
+    green = image[:, :, 1:2]
+    patches = tf.stack([tf.image.random_crop(green, [patch_size, patch_size, 1])
+                        for _ in range(num_patches)])
+    # same scaling as parse_image
+    return tf.image.convert_image_dtype(patches, tf.float32)
+
+def train_image_list(patch_dir):
+    """
+    file listing the training images when the patches are sampled on the fly.
+    """
+    return os.path.join(patch_dir, 'train_images.txt')
+
+def read_image_list(patch_dir):
+    with open(train_image_list(patch_dir)) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def num_train_examples(params):
+    """
+    number of training patches per epoch, i.e. the extracted patches or
+    patches_per_image times the training images for random sampling.
+    """
+    if params.dataloader.patch_sampling == 'random':
+        return (len(read_image_list(params.dataloader.patch_dir)) 
+                * params.dataloader.patches_per_image)
+    if params.dataloader.min_patch_score is not None:
+        return len(informative_patches(params.dataloader.patch_dir, 'train',
+                                       params.dataloader.min_patch_score))
+    examples_per_epoch = 0
+    for m in params.dataloader.brand_models:
+        examples_per_epoch += len(os.listdir(os.path.join(
+                                params.dataloader.patch_dir, 
+                                "train", m)))
+    return examples_per_epoch
+
+def build_patch_index(patch_dir, brand_models, min_score=None):
+    """
+    index of the training patches with their class ids, built from the 
+    manifest (or the class directories) and cached in 'train/index.npz'. 
+    The cache is rebuilt if the manifest is newer or the arguments differ.
+    Args:
+        patch_dir: the directory storing the extracted patches.
+        brand_models: a list of the targeted camera models' name.
+        min_score: if not None, patches with a lower informativeness score
+                   are left out.
+    Return:
+        paths: full paths of the patches, sorted.
+        labels: class id of each patch.
+    """
+    fname = os.path.join(patch_dir, 'train', 'index.npz')
+    manifest_fname = manifest_path(patch_dir, 'train')
+    score = -np.inf if min_score is None else float(min_score)
+    if os.path.exists(fname) and not (os.path.exists(manifest_fname) and
+            os.path.getmtime(manifest_fname) > os.path.getmtime(fname)):
+        index = np.load(fname)
+        if list(index['brand_models']) == list(brand_models) and \
+                float(index['min_score']) == score:
+            return index['paths'], index['labels']
+    manifest = read_manifest(patch_dir, 'train')
+    if manifest:
+        rel_paths = [path for path, scores in sorted(manifest.items())
+                     if scores[-1] >= score]
+    else:
+        if min_score is not None:
+            raise Exception("!!! No patch manifest in {}".format(
+                            os.path.join(patch_dir, 'train')))
+        rel_paths = [os.path.join('train', m, name) for m in brand_models
+                     for name in sorted(os.listdir(os.path.join(patch_dir, 'train', m)))]
+    classes = {m: i for i, m in enumerate(brand_models)}
+    rel_paths = [path for path in rel_paths 
+                 if os.path.split(os.path.dirname(path))[-1] in classes]
+    paths = np.array([os.path.join(patch_dir, path) for path in rel_paths])
+    labels = np.array([classes[os.path.split(os.path.dirname(path))[-1]]
+                       for path in rel_paths], dtype=np.int32)
+    np.savez(fname, paths=paths, labels=labels, 
+             brand_models=np.array(brand_models), min_score=score)
+    return paths, labels
+
+
+class IndexSampler(object):
+    """
+    sampler over the index of the training patches. Every epoch is a global
+    permutation with exactly the requested number of samples per class, and
+    it only depends on the seed and the epoch, so the sequence can be resumed 
+    from any step.
+    """
+    def __init__(self, labels, num_cls, class_weights=None, seed=42):
+        """
+        Args:
+            labels: class id of each sample in the index.
+            num_cls: number of classes.
+            class_weights: None keeps the class frequencies of the index,
+                           'balanced' draws the same number of samples for 
+                           each class, or a list with the weight of each class.
+            seed: random seed of the permutations.
+        """
+        self.class_idx = [np.flatnonzero(labels == c) for c in range(num_cls)]
+        self.epoch_size = len(labels)
+        self.seed = seed
+        if class_weights is None:
+            self.counts = np.array([len(idx) for idx in self.class_idx])
+        else:
+            if class_weights == 'balanced':
+                weights = np.ones(num_cls)
+            else:
+                weights = np.asarray(class_weights, dtype=np.float64)
+            weights = weights / np.sum(weights)
+            # largest remainder, the counts sum up to the epoch size
+            expected = weights * self.epoch_size
+            self.counts = np.floor(expected).astype(int)
+            remainder = self.epoch_size - np.sum(self.counts)
+            self.counts[np.argsort(expected - self.counts)[::-1][:remainder]] += 1
+        for c, idx in enumerate(self.class_idx):
+            if self.counts[c] > 0 and len(idx) == 0:
+                raise Exception("!!! No samples of class {} in the index".format(c))
+
+    def epoch(self, epoch):
+        """
+        Return:
+            order: indices of the samples in the epoch.
+        """
+        rng = np.random.RandomState([self.seed, epoch])
+        slots = np.repeat(np.arange(len(self.class_idx)), self.counts)
+        rng.shuffle(slots)
+        order = np.empty(self.epoch_size, dtype=np.int64)
+        for c, idx in enumerate(self.class_idx):
+            if self.counts[c] == 0:
+                continue
+            # minority classes cycle through several permutations
+            num_cycles = (self.counts[c] + len(idx) - 1) // len(idx)
+            picks = np.concatenate([rng.permutation(idx) 
+                                    for _ in range(num_cycles)])
+            order[slots == c] = picks[:self.counts[c]]
+        return order
+
+    def indices(self, start=0):
+        """
+        endless sequence of sample indices beginning at position start,
+        i.e. the number of samples already seen.
+        """
+        epoch, offset = divmod(start, self.epoch_size)
+        while True:
+            for i in self.epoch(epoch)[offset:]:
+                yield i
+            epoch, offset = epoch + 1, 0
+
+class DatasetCache(object):
+    """
+    materialise the decoded examples of fixed path lists (validation, aligned
+    experiment sets), so that they are decoded only once. Datasets are keyed 
+    by the hash of their paths and kept in a registry shared by all 
+    instances, in memory as long as the budget allows and on disk otherwise.
+    The registry and the memory budget belong to the process, concurrent
+    processes get a share of the budget (see ExperimentScheduler.start).
+    """
+    registry = {}
+    memory_used = 0
+
+    def __init__(self, cache_dir, memory_budget_mb):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget_mb * 1024 ** 2
+
+    def key(self, img_paths, brand_models):
+        # the order of the examples is part of the dataset
+        sha = hashlib.sha1()
+        for path in img_paths:
+            sha.update(path.encode())
+        sha.update(' '.join(brand_models).encode())
+        return sha.hexdigest()
+
+    def dataset(self, img_paths, brand_models):
+        """
+        Return:
+            dataset: finite dataset of decoded (image, onehot_label) in the 
+                     order of img_paths.
+        """
+        img_paths = [p.decode() if isinstance(p, bytes) else str(p) 
+                     for p in img_paths]
+        key = self.key(img_paths, brand_models)
+        if key in DatasetCache.registry:
+            return DatasetCache.registry[key]
+        dataset = (tf.data.Dataset.from_tensor_slices(img_paths)
+                .map(partial(parse_image, brand_models=brand_models), 
+                        num_parallel_calls=AUTOTUNE))
+        # 256 x 256 green channel patches in float32 and the labels
+        size = len(img_paths) * (256 * 256 + len(brand_models)) * 4
+        if DatasetCache.memory_used + size <= self.memory_budget:
+            DatasetCache.memory_used += size
+            dataset = dataset.cache()
+            location = 'memory'
+        else:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # experiments running concurrently must not write the same files
+            location = os.path.join(self.cache_dir, '{}_{}'.format(key, os.getpid()))
+            atexit.register(remove_cache_files, location)
+            dataset = dataset.cache(location)
+            # written in one full pass, a partly consumed iterator would leave
+            # the cache unfinalised and the next iterator fails on its lockfile
+            for _ in dataset:
+                pass
+        print("... Caching {} examples in {}".format(len(img_paths), location))
+        DatasetCache.registry[key] = dataset
+        return dataset
+
+
+def remove_cache_files(location):
+    """
+    remove the files of a tf.data file cache, e.g. when the process exits.
+    """
+    for fname in glob.glob(location + '*'):
+        os.remove(fname)
+
+def dataset_cache(params):
+    """
+    the dataset cache configured in params.dataloader, None if disabled.
+    """
+    if not params.dataloader.cache_decoded:
+        return None
+    return DatasetCache(params.dataloader.cache_dir, 
+                        params.dataloader.cache_memory_mb)
+
+def build_random_patch_dataset(img_paths, brand_models, batch_size,
+                            class_imbalance=False, patches_per_image=8):
+    """
+    build the training set with patches sampled on the fly from full-sized
+    images, every epoch sees new patch locations.
+    Args:
+        img_paths: full paths of the training images.
+        brand_models: a list of the targeted camera models' name.
+        batch_size: desired batch size of the dataset.
+        class_imbalance: if true, use oversampling the monority class.
+        patches_per_image: number of patches cropped from an image each 
+                           time it is drawn.
+    Returns:
+        dataset: dataset yields batches of patches and one-hot labels.
+    """
+    img_paths = large_enough(img_paths)
+
+    def sample(img_path):
+        patches = sample_patches(img_path, patches_per_image)
+        label = tf.strings.split(img_path, os.path.sep)[-2]
+        matches = tf.stack([tf.equal(label, s) 
+                            for s in brand_models], 
+                            axis=-1)
+        onehot_label = tf.cast(matches, tf.float32)
+        onehot_labels = tf.tile(onehot_label[tf.newaxis], [patches_per_image, 1])
+        return patches, onehot_labels
+
+    if class_imbalance:
+        class_datasets = []
+        for m in brand_models:
+            paths = [p for p in img_paths 
+                     if os.path.split(os.path.dirname(p))[-1] == m]
+            class_dataset = (tf.data.Dataset.from_tensor_slices(paths)
+                .shuffle(buffer_size=len(paths)).repeat())
+            class_datasets.append(class_dataset)
+        dataset = tf.data.experimental.sample_from_datasets(class_datasets)
+    else:
+        dataset = (tf.data.Dataset.from_tensor_slices(img_paths)
+                .shuffle(buffer_size=len(img_paths))
+                .repeat())
+    dataset = (dataset.map(sample, num_parallel_calls=AUTOTUNE)
+            .unbatch()
+            # mix the patches of different images within a batch
+            .shuffle(buffer_size=16 * patches_per_image)
+            .batch(batch_size)
+            .prefetch(buffer_size=AUTOTUNE))
+    return dataset
+
+def shard_paths(paths, shard):
+    """
+    the paths read by one input pipeline.
+    Args:
+        shard: (number of input pipelines, index of the pipeline), or None
+               for a single pipeline reading all paths.
+    """
+    if shard is None:
+        return paths
+    num_shards, index = shard
+    return paths[index::num_shards]
+
+def list_files(pattern, shard=None):
+    """
+    like tf.data.Dataset.list_files, the files matching pattern in a new
+    random order each epoch, but only the shard of one input pipeline.
+    """
+    if shard is None:
+        return tf.data.Dataset.list_files(pattern)
+    paths = shard_paths(sorted(glob.glob(pattern)), shard)
+    return tf.data.Dataset.from_tensor_slices(paths).shuffle(buffer_size=len(paths))
+
 def build_dataset(patch_dir, brand_models,
                 dataset_id, batch_size, 
                 img_paths=None, class_imbalance=False,
-                degradation=None, factor=None):
+                degradation=None, factor=None,
+                patches_per_image=8, min_score=None,
+                sampler=None, start=0, cache=None, strategy=None):
     """
     build train, validation, test dataset as well as the dataset for different experiments.
+    Args:
+        the arguments of build_input_pipeline, and
+        strategy: if not None, a tf.distribute strategy. batch_size is the
+                  global batch size, each replica gets its part of every
+                  batch and each worker only reads its shard of the paths.
+    Returns:
+        iterator: the iterator of the generated dataset, of per-replica
+                  values with a strategy.
+    """
+    args = (patch_dir, brand_models, dataset_id)
+    kwargs = dict(img_paths=img_paths, class_imbalance=class_imbalance,
+                  degradation=degradation, factor=factor,
+                  patches_per_image=patches_per_image,
+                  min_score=min_score, sampler=sampler, start=start, cache=cache)
+    if strategy is None:
+        return iter(build_input_pipeline(*args, batch_size, **kwargs))
+
+    def dataset_fn(context):
+        shard = None
+        if context.num_input_pipelines > 1:
+            shard = (context.num_input_pipelines, context.input_pipeline_id)
+        return build_input_pipeline(*args, context.get_per_replica_batch_size(batch_size),
+                                    shard=shard, **kwargs)
+    return iter(strategy.experimental_distribute_datasets_from_function(dataset_fn))
+
+def build_input_pipeline(patch_dir, brand_models,
+                dataset_id, batch_size, 
+                img_paths=None, class_imbalance=False,
+                degradation=None, factor=None,
+                patches_per_image=8, min_score=None,
+                sampler=None, start=0, cache=None, shard=None):
+    """
+    the input pipeline of build_dataset.
     Args:
         patch_dir: the directory storing the extracted patches.
         brand_models: a list of the targeted camera models' name.
@@ -52,20 +416,53 @@ def build_dataset(patch_dir, brand_models,
         degradation: the type of degradation, e.g. jpeg, blur and noise.
         factor: the parameter controls the degradation, quality factor for jpeg 
                 and standard deviation of Gaussian for both blur and noise.
+        patches_per_image: for 'random_train', number of patches sampled 
+                           from an image each time it is drawn.
+        min_score: for 'train', if not None, patches with an informativeness 
+                   score below it in the manifest are dropped.
+        sampler: for 'train', if not None, an IndexSampler over img_paths 
+                 replaces the shuffle buffers.
+        start: number of samples the sampler skips to resume training.
+        cache: if not None, a DatasetCache which decodes the examples of 
+               'val', 'test' and the datasets from img_paths only once.
+        shard: (number of input pipelines, index of the pipeline) if the
+               input is split across workers, see shard_paths.
     Returns:
-        iterator: the iterator of the generated dataset.
+        dataset: the generated dataset.
     """ 
+    # the indices of the sampler refer to all paths, they are sharded instead
+    if img_paths is not None and sampler is None:
+        img_paths = shard_paths(img_paths, shard)
 
     # create training set
-    if dataset_id == 'train':
+    if dataset_id == 'train' and sampler is not None:
+        paths = tf.constant(img_paths)
+        dataset = tf.data.Dataset.from_generator(
+                    partial(sampler.indices, start), 
+                    tf.int64, tf.TensorShape([]))
+        if shard is not None:
+            # every worker draws the same indices and keeps its shard
+            dataset = dataset.shard(*shard)
+        dataset = (dataset.map(lambda i: tf.gather(paths, i))
+                .map(partial(parse_image, brand_models=brand_models), 
+                        num_parallel_calls=AUTOTUNE)
+                .batch(batch_size)
+                .prefetch(buffer_size=AUTOTUNE))
+    elif dataset_id == 'train':
         # use oversampling to counteract the class imbalance
         # https://www.tensorflow.org/tutorials/structured_data/imbalanced_data#oversampling
         if class_imbalance:
             class_datasets = []
             for m in brand_models:
-                class_dataset = (tf.data.Dataset.list_files(
-                    os.path.join(patch_dir, 'train', m)+'/*')
-                    .shuffle(buffer_size=1000).repeat())
+                if min_score is not None:
+                    paths = shard_paths(informative_patches(patch_dir, 'train', 
+                                                            min_score, m), shard)
+                    class_dataset = (tf.data.Dataset.from_tensor_slices(paths)
+                        .shuffle(buffer_size=len(paths)).repeat())
+                else:
+                    class_dataset = (list_files(
+                        os.path.join(patch_dir, 'train', m)+'/*', shard)
+                        .shuffle(buffer_size=1000).repeat())
                 class_datasets.append(class_dataset)
             # uniformly samples in the class_datasets
             dataset = (tf.data.experimental.sample_from_datasets(class_datasets)
@@ -76,26 +473,43 @@ def build_dataset(patch_dir, brand_models,
                     # make sure you always have one batch ready to serve
         else:
             # if not class_imbalance, the dataset is then enforced to be even.
-            dataset = (tf.data.Dataset.list_files(
-                    os.path.join(patch_dir, 'train')+'/*/*')
-                    .repeat()
+            if min_score is not None:
+                dataset = tf.data.Dataset.from_tensor_slices(shard_paths(
+                        informative_patches(patch_dir, 'train', min_score), shard))
+            else:
+                dataset = list_files(
+                        os.path.join(patch_dir, 'train')+'/*/*', shard)
+            dataset = (dataset.repeat()
                     # whole dataset into the buffer ensures good shuffling
                     .shuffle(buffer_size=1000) 
                     .map(partial(parse_image, brand_models=brand_models), 
                             num_parallel_calls=AUTOTUNE)
                     .batch(batch_size)
                     .prefetch(buffer_size=AUTOTUNE))
+    # sample random patches from the full-sized images in img_paths
+    elif dataset_id == 'random_train':
+        dataset = build_random_patch_dataset(img_paths, brand_models, batch_size,
+                                            class_imbalance=class_imbalance,
+                                            patches_per_image=patches_per_image)
+    elif cache is not None and dataset_id != 'degradation':
+        if dataset_id in ['val', 'test']:
+            img_paths = shard_paths(sorted(glob.glob(
+                    os.path.join(patch_dir, dataset_id, '*', '*.png'))), shard)
+        dataset = (cache.dataset(img_paths, brand_models)
+                .repeat()
+                .batch(batch_size)
+                .prefetch(buffer_size=AUTOTUNE))
     elif dataset_id == 'val':
-        dataset = (tf.data.Dataset.list_files(
-                os.path.join(patch_dir, 'val')+'/*/*')
+        dataset = (list_files(
+                os.path.join(patch_dir, 'val')+'/*/*', shard)
                 .repeat()
                 .map(partial(parse_image, brand_models=brand_models), 
                         num_parallel_calls=AUTOTUNE)
                 .batch(batch_size)
                 .prefetch(buffer_size=AUTOTUNE))
     elif dataset_id == 'test':
-        dataset = (tf.data.Dataset.list_files(
-                os.path.join(patch_dir, 'test')+'/*/*')
+        dataset = (list_files(
+                os.path.join(patch_dir, 'test')+'/*/*', shard)
                 .repeat()
                 .map(partial(parse_image, brand_models=brand_models), 
                         num_parallel_calls=AUTOTUNE)
@@ -103,8 +517,9 @@ def build_dataset(patch_dir, brand_models,
                 .prefetch(buffer_size=AUTOTUNE))
     # create dataset for degradation experiment.
     elif dataset_id == 'degradation':
-        dataset = (tf.data.Dataset.list_files(
-                os.path.join("data/degradation", '_'.join('dresden', degradation), factor)+'/*/*')
+        dataset = (list_files(
+                os.path.join("data/degradation", '_'.join('dresden', degradation), factor)+'/*/*',
+                shard)
                 .repeat()
                 .map(partial(parse_image, brand_models=brand_models), 
                         num_parallel_calls=AUTOTUNE)
@@ -117,6 +532,38 @@ def build_dataset(patch_dir, brand_models,
                         num_parallel_calls=AUTOTUNE)
                 .batch(batch_size)
                 .prefetch(buffer_size=AUTOTUNE))
+    return dataset
+
+def build_distillation_dataset(img_paths, brand_models, batch_size,
+                            teacher_probs, teacher_uncertainty):
+    """
+    build the training set for distillation, the teacher's outputs are served
+    from cached predictions alongside the images.
+    Args:
+        img_paths: image paths.
+        brand_models: a list of the targeted camera models' name.
+        batch_size: desired batch size of the dataset.
+        teacher_probs: teacher's mean predictive distribution for each image,
+                       shape of [# of images, # of classes].
+        teacher_uncertainty: teacher's entropy and epistemic uncertainty for 
+                             each image, shape of [# of images, 2].
+    Returns:
+        iterator: the iterator yields images, one-hot labels, teacher 
+                  probabilities and teacher uncertainty.
+    """
+    def parse_with_teacher(img_path, probs, uncertainty):
+        image, onehot_label = parse_image(img_path, brand_models)
+        return image, onehot_label, probs, uncertainty
+
+    dataset = (tf.data.Dataset.from_tensor_slices(
+                (img_paths, 
+                np.asarray(teacher_probs, dtype=np.float32),
+                np.asarray(teacher_uncertainty, dtype=np.float32)))
+            .shuffle(buffer_size=len(img_paths))
+            .repeat()
+            .map(parse_with_teacher, num_parallel_calls=AUTOTUNE)
+            .batch(batch_size)
+            .prefetch(buffer_size=AUTOTUNE))
     iterator = iter(dataset)
     return iterator
 
@@ -147,13 +594,33 @@ def degradate(img_path_ls, img_root, database,
                     'target_dir': target_dir,
                     'post_processing':degradation_id,
                     'factor': factor}]
+    # e.g. prepared by the pipeline or the process scheduling the experiments
+    target_path_ls = [degraded_path(arg) for arg in args_ls]
+    if all(os.path.exists(path) for path in target_path_ls):
+        return target_path_ls
     target_path_ls = []
-    with Pool() as pool:
-        target_path_ls.extend(pool.map(post_processing, args_ls))
+    workers = pool_size('degradate')
+    with stage('degradate/{}/{}'.format(degradation_id, factor)), \
+            Pool(workers) as pool:
+        target_path_ls.extend(throttled_map(pool, workers, post_processing,
+                                            args_ls, 'degradate'))
 
     return target_path_ls
 
 
+def degraded_path(arg):
+    """
+    path of the post-processed image, see post_processing for the arguments.
+    """
+    image_name = os.path.split(arg['img_path'])[-1]
+    target_path = os.path.join(arg['target_dir'],
+                                os.path.split(os.path.dirname(arg['img_path']))[-1],
+                                image_name)
+    if arg['post_processing'] == 'jpeg':
+        target_path = os.path.splitext(target_path)[0] + '.jpg'
+    return target_path
+
+
 def post_processing(arg):
     """
     offline implementation for post processing. The offline version 
@@ -170,16 +637,12 @@ def post_processing(arg):
     Return:
         target_path: path of the saved post process images.
     """
-    image_name = os.path.split(arg['img_path'])[-1]
-    target_path = os.path.join(arg['target_dir'],
-                                os.path.split(os.path.dirname(arg['img_path']))[-1],
-                                image_name)
+    target_path = degraded_path(arg)
     out_fulldir = os.path.split(target_path)[0]
     if not os.path.exists(out_fulldir):
         os.makedirs(out_fulldir, exist_ok=True)
     # using jpeg compression
     if arg['post_processing'] == 'jpeg':
-        target_path = os.path.splitext(target_path)[0] + '.jpg'
         if not os.path.exists(target_path):
             img = io.imread(arg['img_path'])
             io.imsave(target_path, img, plugins='pil', 
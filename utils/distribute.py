@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import subprocess
+import tensorflow as tf
+from utils.host_profile import set_threads
+
+# trainers whose train and eval steps run under a tf.distribute strategy
+DISTRIBUTED_TRAINERS = ['VanillaTrainer', 'BayesianTrainer']
+
+
+def worker_index():
+    """
+    index of this process in the cluster of TF_CONFIG, 0 (the chief) if
+    there is no cluster.
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    return tf_config.get('task', {}).get('index', 0)
+
+def needs_workers(params):
+    """
+    whether this process has to launch the workers of multi-worker
+    training, i.e. it is not a worker itself.
+    """
+    return (params.trainer.distribute.strategy == 'multi_worker' and
+            'TF_CONFIG' not in os.environ)
+
+def launch_workers(params):
+    """
+    run the current command in local worker processes of a multi-worker
+    cluster and wait for them.
+    """
+    config = params.trainer.distribute
+    cluster = {'worker': ['localhost:{}'.format(config.port + i)
+                          for i in range(config.num_workers)]}
+    processes = []
+    for i in range(config.num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps(
+                {'cluster': cluster, 'task': {'type': 'worker', 'index': i}}))
+        processes.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    exit_codes = [p.wait() for p in processes]
+    if any(exit_codes):
+        raise Exception("!!! Workers failed with exit codes {}".format(exit_codes))
+
+def worker_params(params):
+    """
+    the workers other than the chief write their logs, checkpoints and
+    tensorboard summaries to their own files, the chief's are unchanged.
+    No worker prepares the data, the launching process did it once.
+    """
+    if 'TF_CONFIG' not in os.environ:
+        return params
+    params.run.prepare = False
+    index = worker_index()
+    if index == 0:
+        return params
+    suffix = 'worker_{}'.format(index)
+    stem, ext = os.path.splitext(params.log.log_file)
+    params.log.log_file = '{}_{}{}'.format(stem, suffix, ext)
+    params.log.tensorboard_dir = os.path.join(params.log.tensorboard_dir, suffix)
+    params.trainer.ckpt_dir = os.path.join(params.trainer.ckpt_dir, suffix)
+    params.trainer.profile.trace_dir = os.path.join(params.trainer.profile.trace_dir, suffix)
+    return params
+
+def build_strategy(params):
+    """
+    the strategy of the distribute block of the trainer, it has to be built
+    before the first op runs.
+    'mirrored': one replica per GPU, or the CPU split into num_replicas
+                logical devices on CPU-only hosts.
+    'multi_worker': one replica per process of the cluster in TF_CONFIG,
+                    see launch_workers.
+    Return:
+        strategy: tf.distribute strategy, None to train on the default device.
+    """
+    config = params.trainer.distribute
+    if config.strategy is None:
+        return None
+    if params.trainer.name not in DISTRIBUTED_TRAINERS:
+        raise Exception("!!! {} does not support distributed training".format(
+                        params.trainer.name))
+    if config.strategy == 'mirrored':
+        devices = None
+        if not tf.config.experimental.list_physical_devices('GPU'):
+            cpu = tf.config.experimental.list_physical_devices('CPU')[0]
+            tf.config.experimental.set_virtual_device_configuration(
+                cpu, [tf.config.experimental.VirtualDeviceConfiguration()] * config.num_replicas)
+            devices = ['/cpu:{}'.format(i) for i in range(config.num_replicas)]
+        return tf.distribute.MirroredStrategy(devices=devices)
+    if config.strategy == 'multi_worker':
+        # the local workers share the cores
+        threads = config.threads_per_worker or max(1, os.cpu_count() // config.num_workers)
+        set_threads(threads, None)
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    raise Exception("!!! Unknown distribution strategy: {}".format(config.strategy))
@@ -0,0 +1,80 @@
+import os
+import json
+import socket
+from utils.misc import write_log
+
+# configuration of a model taken from each target of the profile
+TARGETS = ['train_step', 'eval_step', 'mc_inference']
+
+
+def profile_path(profile_dir, host=None):
+    """
+    Return:
+        path of the profile of the host, e.g. 'params/hosts/<hostname>.json'.
+    """
+    return os.path.join(profile_dir, (host or socket.gethostname()) + '.json')
+
+def load_profile(profile_dir, host=None):
+    """
+    Return:
+        profile: dict written by the autotune command, None if the host has none.
+    """
+    fname = profile_path(profile_dir, host)
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+def set_threads(intra_op_threads, inter_op_threads):
+    """
+    set the thread pools of tensorflow, before the first op runs.
+    """
+    import tensorflow as tf
+    if intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+def apply_host_profile(params, kind):
+    """
+    replace the thread settings, and the batch sizes if host_profile.batch_size
+    is set, of the parameters with the fastest ones the autotune command found
+    on this host, nothing changes if the host has no profile or a model was
+    not tuned. The trainers keep their batch size by default, it determines
+    the resume step of the checkpoints and the order of the patches.
+    Args:
+        params: parameters from the json file.
+        kind: 'train' uses the threads of the train step, 'experiment' the
+              threads of the Monte Carlo inference.
+    Return:
+        threads: (intra_op_threads, inter_op_threads) to set, or None.
+    """
+    config = params.host_profile
+    profile = load_profile(config.profile_dir)
+    log_file = params.log.log_file
+    if profile is None:
+        msg = "... No host profile in {}, using the configured batch sizes\n".format(
+                config.profile_dir)
+        write_log(log_file, msg)
+        return None
+    if kind == 'train':
+        tuned = profile['models'].get(params.model.name, {})
+        updates = [('train_step', params.trainer), ('eval_step', params.evaluate)]
+        threads_from = 'train_step'
+    else:
+        tuned = profile['models'].get(params.mc_stats.model, {})
+        updates = [('mc_inference', params.dataloader)]
+        threads_from = 'mc_inference'
+    if config.batch_size:
+        for target, block in updates:
+            if target in tuned:
+                block.batch_size = tuned[target]['batch_size']
+                msg = "... Host profile: {} batch size {}\n".format(target, block.batch_size)
+                write_log(log_file, msg)
+    if not config.threads or threads_from not in tuned:
+        return None
+    threads = (tuned[threads_from]['intra_op_threads'],
+               tuned[threads_from]['inter_op_threads'])
+    msg = "... Host profile: intra-op threads {}, inter-op threads {}\n".format(*threads)
+    write_log(log_file, msg)
+    return threads
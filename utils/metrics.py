@@ -0,0 +1,176 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+
+class SortedScores(object):
+    """
+    scores sorted in ascending order, sorted arrays are kept in a small
+    cache so that the in-distribution scores are sorted only once when
+    they are compared with several out-of-distribution sets.
+    """
+    cache = OrderedDict()
+    cache_size = 16
+
+    def __init__(self, scores):
+        self.scores = np.sort(np.asarray(scores, dtype=np.float64).ravel())
+
+    @classmethod
+    def of(cls, scores):
+        if isinstance(scores, SortedScores):
+            return scores
+        scores = np.ascontiguousarray(scores, dtype=np.float64).ravel()
+        # hashing is linear, sorting is not
+        key = hashlib.sha1(scores.tobytes()).hexdigest()
+        if key in cls.cache:
+            cls.cache.move_to_end(key)
+            return cls.cache[key]
+        sorted_scores = cls(scores)
+        cls.cache[key] = sorted_scores
+        while len(cls.cache) > cls.cache_size:
+            cls.cache.popitem(last=False)
+        return sorted_scores
+
+    def __len__(self):
+        return len(self.scores)
+
+
+def merge(neg, pos):
+    """
+    merge the sorted negative and positive scores.
+    Args:
+        neg, pos: SortedScores of the negative and the positive class.
+    Return:
+        thresholds: unique scores in descending order.
+        neg_idx, pos_idx: index of the threshold of each score, the scores
+                          are in ascending order, the indices are not
+                          increasing.
+    """
+    # the concatenation consists of two sorted runs, merged in linear time
+    merged = np.sort(np.concatenate([neg.scores, pos.scores]), kind='mergesort')
+    keep = np.ones(len(merged), dtype=bool)
+    keep[1:] = merged[1:] != merged[:-1]
+    thresholds = merged[keep][::-1]
+    ascending = thresholds[::-1]
+    neg_idx = len(thresholds) - 1 - np.searchsorted(ascending, neg.scores)
+    pos_idx = len(thresholds) - 1 - np.searchsorted(ascending, pos.scores)
+    return thresholds, neg_idx, pos_idx
+
+
+def curve_stats(neg_counts, pos_counts):
+    """
+    AUROC, AUPR and FPR@95TPR from the (weighted) number of negative and
+    positive examples at each threshold, thresholds in descending order.
+    Args:
+        neg_counts, pos_counts: shape of [..., # of thresholds].
+    Return:
+        fpr, tpr: including the starting point (0, 0).
+        auroc, aupr, fpr95.
+    """
+    tp = np.cumsum(pos_counts, axis=-1)
+    fp = np.cumsum(neg_counts, axis=-1)
+    num_pos = tp[..., -1:]
+    num_neg = fp[..., -1:]
+    tpr = tp / num_pos
+    fpr = fp / num_neg
+    zeros = np.zeros(tpr.shape[:-1] + (1,))
+    tpr = np.concatenate([zeros, tpr], axis=-1)
+    fpr = np.concatenate([zeros, fpr], axis=-1)
+    auroc = np.sum(np.diff(fpr, axis=-1) * (tpr[..., 1:] + tpr[..., :-1]) / 2, axis=-1)
+    # average precision, same definition as sklearn
+    precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    aupr = np.sum(np.diff(tpr, axis=-1) * precision, axis=-1)
+    fpr95 = np.take_along_axis(fpr, np.argmax(tpr >= 0.95, axis=-1)[..., np.newaxis],
+                               axis=-1)[..., 0]
+    return fpr, tpr, auroc, aupr, fpr95
+
+
+def optimal_threshold(fpr, tpr, thresholds):
+    """
+    find out the optimal threshold for the ROC curve, where the optimal
+    cutoff is the threshold with (tpr - (1 - fpr)) closest to 0.
+    Args:
+        fpr: false positive rate.
+        tpr: true positive rate.
+        thresholds: the corresponding thresholds.
+    Return:
+        optimal: the optimal fpr, tpr and threshold for the ROC curve.
+    """
+    distance = np.abs(tpr - (1 - fpr))
+    idx = np.argmin(distance)
+    return [fpr[idx], tpr[idx], thresholds[idx]]
+
+
+def roc_stats(safe, risky, inverse=False):
+    """
+    ROC curve, AUROC, AUPR, FPR@95TPR and the optimal cutoff of one
+    in-distribution / out-of-distribution pair, the scores are sorted once.
+    Args:
+        safe: examples that are likely to be in-distribution, array or
+              SortedScores.
+        risky: examples that are likely to be out-of-distribution.
+        inverse: determine which is case is positive class, by defalut,
+                 the risky examples (out-of-distribution) are positive.
+    Return:
+        stats: dict of fpr, tpr, thresholds, optimal, auroc, aupr and fpr95.
+    """
+    neg, pos = SortedScores.of(safe), SortedScores.of(risky)
+    if inverse:
+        neg, pos = pos, neg
+    thresholds, neg_idx, pos_idx = merge(neg, pos)
+    neg_counts = np.bincount(neg_idx, minlength=len(thresholds))
+    pos_counts = np.bincount(pos_idx, minlength=len(thresholds))
+    fpr, tpr, auroc, aupr, fpr95 = curve_stats(neg_counts, pos_counts)
+    # the starting point (0, 0) has a threshold above all scores
+    thresholds = np.concatenate([[thresholds[0] + 1], thresholds])
+    return {'fpr': fpr, 'tpr': tpr, 'thresholds': thresholds,
+            'optimal': optimal_threshold(fpr, tpr, thresholds),
+            'auroc': float(auroc), 'aupr': float(aupr), 'fpr95': float(fpr95)}
+
+
+def bootstrap_ci(safe, risky, inverse=False, num_resamples=1000,
+                 alpha=0.05, seed=42, chunk_size=200):
+    """
+    bootstrap confidence intervals of AUROC, AUPR and FPR@95TPR. Every
+    resample is a vector of counts per example, the statistics of all
+    resamples of a chunk are computed at once from count-weighted
+    cumulative sums over the thresholds.
+    Args:
+        safe, risky, inverse: see roc_stats.
+        num_resamples: number of bootstrap resamples.
+        alpha: the interval covers 1 - alpha.
+        seed: random seed of the resampling.
+        chunk_size: number of resamples processed at once.
+    Return:
+        ci: dict of (lower, upper) of auroc, aupr and fpr95.
+    """
+    neg, pos = SortedScores.of(safe), SortedScores.of(risky)
+    if inverse:
+        neg, pos = pos, neg
+    thresholds, neg_idx, pos_idx = merge(neg, pos)
+    # the scores are ascending, the threshold indices descending, so each
+    # threshold covers a contiguous run of examples
+    neg_order, pos_order = neg_idx[::-1], pos_idx[::-1]
+    neg_starts = np.flatnonzero(np.r_[True, neg_order[1:] != neg_order[:-1]])
+    pos_starts = np.flatnonzero(np.r_[True, pos_order[1:] != pos_order[:-1]])
+    rng = np.random.RandomState(seed)
+    stats = {'auroc': [], 'aupr': [], 'fpr95': []}
+    for start in range(0, num_resamples, chunk_size):
+        size = min(chunk_size, num_resamples - start)
+        counts = []
+        for order, starts, n in [(neg_order, neg_starts, len(neg)),
+                                 (pos_order, pos_starts, len(pos))]:
+            weights = rng.multinomial(n, np.full(n, 1. / n), size=size)
+            run_counts = np.add.reduceat(weights, starts, axis=1)
+            threshold_counts = np.zeros((size, len(thresholds)))
+            threshold_counts[:, order[starts]] = run_counts
+            counts.append(threshold_counts)
+        _, _, auroc, aupr, fpr95 = curve_stats(counts[0], counts[1])
+        stats['auroc'].append(auroc)
+        stats['aupr'].append(aupr)
+        stats['fpr95'].append(fpr95)
+    ci = {}
+    for k, v in stats.items():
+        v = np.concatenate(v)
+        ci[k] = (float(np.quantile(v, alpha / 2)), float(np.quantile(v, 1 - alpha / 2)))
+    return ci
@@ -18,6 +18,22 @@ def get_args():
     args = argparser.parse_args()
     return args
 
+devices_configured = False
+
+def configure_devices():
+    """
+    let tensorflow allocate the memory of the GPUs on demand, nothing to
+    do on CPU-only hosts. It has to be called before the first op runs,
+    later calls do nothing.
+    """
+    global devices_configured
+    if devices_configured:
+        return
+    devices_configured = True
+    import tensorflow as tf
+    for gpu in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
 def get_params(json_file):
     """
     Get params from json file
@@ -34,6 +50,20 @@ def get_params(json_file):
             return -1
     return params
 
+def to_dict(params):
+    """
+    convert the parameters back to (nested) dicts, e.g. to save them as json.
+    Args:
+        params: parameters from the json file.
+    Return:
+        params_dict: parameters as dict.
+    """
+    if isinstance(params, SimpleNamespace):
+        return {k: to_dict(v) for k, v in vars(params).items()}
+    if isinstance(params, list):
+        return [to_dict(v) for v in params]
+    return params
+
 def instantiate(module, cls):
     """
     instantiate the class from a certain module specified in the json file.
@@ -1,15 +1,19 @@
 import os
+import csv
 import numpy as np
 from multiprocessing import Pool
 from skimage.util.shape import view_as_blocks
 from skimage.util import random_noise
 from skimage import io, filters, img_as_ubyte
+from utils.resources import pool_size, stage, throttled_map
+SCORE_FIELDS = ['variance', 'saturation', 'highpass', 'score']
 
 
 def extract_patch(img_path_ls, ds_id, patch_dir,
                 num_patch, extract_span):
     """
-    call the extract function to extract patches from full-sized image.
+    call the extract function to extract patches from full-sized image,
+    and add the informativeness scores of the patches to the manifest.
     Args:
         img_path_ls: paths of images needed to be split into patches.
         ds_id: dataset id, one of ['train', 'val', 'test']. 
@@ -20,15 +24,122 @@ def extract_patch(img_path_ls, ds_id, patch_dir,
                     if it's 'adaptive', it means will adaptively extract 
                     the patches.
     """
+    manifest = read_manifest(patch_dir, ds_id)
+    # images whose patches are already scored, e.g. 'train/Agfa_DC-504/Agfa_DC-504_0_1'
+    scored = set(path.rsplit('_', 1)[0] for path in manifest)
     args_ls = []
     for img_path in img_path_ls:
         args_ls += [{'ds_id':ds_id,
                     'img_path':img_path,
                     'patch_dir':patch_dir,
                     'num_patch': num_patch,
-                    'extract_span': extract_span}]
-    with Pool() as pool:
-        pool.map(extract, args_ls)
+                    'extract_span': extract_span,
+                    'scored': image_prefix(ds_id, img_path) in scored}]
+    workers = pool_size('extract_patch')
+    with stage('extract_patch/' + ds_id), Pool(workers) as pool:
+        rows_ls = throttled_map(pool, workers, extract, args_ls, 'extract_patch')
+    if not any(rows_ls):
+        # every patch is extracted and scored already
+        return
+    for rows in rows_ls:
+        for row in rows:
+            manifest[row[0]] = row[1:]
+    write_manifest(patch_dir, ds_id, manifest)
+
+
+def image_prefix(ds_id, img_path):
+    """
+    relative path of the patches of an image without the patch index.
+    """
+    return os.path.join(ds_id,
+                        os.path.split(os.path.dirname(img_path))[-1],
+                        os.path.splitext(os.path.split(img_path)[-1])[0])
+
+
+def manifest_path(patch_dir, ds_id):
+    """
+    the manifest lists the patches of a dataset with their scores,
+    e.g. 'data/dresden_base/train/manifest.csv'.
+    """
+    return os.path.join(patch_dir, ds_id, 'manifest.csv')
+
+
+def read_manifest(patch_dir, ds_id):
+    """
+    Return:
+        manifest: dict from the patch path relative to patch_dir to its
+                  (variance, saturation, highpass, score).
+    """
+    manifest = {}
+    fname = manifest_path(patch_dir, ds_id)
+    if not os.path.exists(fname):
+        return manifest
+    with open(fname) as f:
+        for row in csv.DictReader(f):
+            manifest[row['path']] = tuple(float(row[k]) for k in SCORE_FIELDS)
+    return manifest
+
+
+def write_manifest(patch_dir, ds_id, manifest):
+    fname = manifest_path(patch_dir, ds_id)
+    if not os.path.exists(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+    # readers never see a partly written manifest
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path'] + SCORE_FIELDS)
+        for path in sorted(manifest):
+            writer.writerow([path] + ['{:.6g}'.format(v) for v in manifest[path]])
+    os.replace(tmp_fname, fname)
+
+
+def informative_patches(patch_dir, ds_id, min_score, brand_model=None):
+    """
+    full paths of the patches whose score is at least min_score.
+    Args:
+        patch_dir: parent directory storing the patches.
+        ds_id: dataset id, one of ['train', 'val', 'test'].
+        min_score: minimum informativeness score.
+        brand_model: if not None, only patches of this camera model.
+    """
+    manifest = read_manifest(patch_dir, ds_id)
+    if not manifest:
+        raise Exception("!!! No patch manifest in {}".format(
+                        os.path.join(patch_dir, ds_id)))
+    paths = []
+    for path, scores in sorted(manifest.items()):
+        if brand_model is not None and \
+                os.path.split(os.path.dirname(path))[-1] != brand_model:
+            continue
+        if scores[-1] >= min_score:
+            paths.append(os.path.join(patch_dir, path))
+    return paths
+
+
+def patch_scores(patches):
+    """
+    informativeness of the patches, saturated and flat patches (sky, walls) 
+    carry little sensor noise.
+    Args:
+        patches: shape of [# of patches, 256, 256] or [# of patches, 256, 256, 1],
+                 range 0-1.
+    Return:
+        variance: pixel variance of each patch.
+        saturation: fraction of clipped pixels (below 1% or above 99%).
+        highpass: mean energy of the Laplacian residual.
+        score: sqrt(highpass) * (1 - saturation), the higher the better.
+    """
+    patches = np.asarray(patches, dtype=np.float32).reshape(
+                (len(patches), patches.shape[1], patches.shape[2]))
+    variance = np.var(patches, axis=(1, 2))
+    saturation = np.mean((patches <= 0.01) | (patches >= 0.99), axis=(1, 2))
+    residual = (4 * patches[:, 1:-1, 1:-1] 
+                - patches[:, :-2, 1:-1] - patches[:, 2:, 1:-1]
+                - patches[:, 1:-1, :-2] - patches[:, 1:-1, 2:])
+    highpass = np.mean(np.square(residual), axis=(1, 2))
+    score = np.sqrt(highpass) * (1 - saturation)
+    return variance, saturation, highpass, score
 
 
 def extract(args):
@@ -40,6 +151,10 @@ def extract(args):
         patch_dir: the parent directory storing the patches.
         num_patch: number of patches being extracted.
         extract_span: size of the region of image to be extracted.
+        scored: whether the patches are already in the manifest.
+    Return:
+        rows: manifest rows (path, variance, saturation, highpass, score)
+              of the patches that were not scored yet.
     """
     if args['extract_span'] == 'adaptive':
         img = io.imread(args['img_path'])
@@ -51,10 +166,8 @@ def extract(args):
     # 'train/Agfa_DC-504/Agfa_DC-504_0_1_00.png' for example,
     # last part is the patch idex.
     # Use PNG for losslessly storing images
-    out_rel_paths = [os.path.join(args['ds_id'],
-                    os.path.split(os.path.dirname(args['img_path']))[-1],
-                    os.path.splitext(os.path.split(args['img_path'])[-1])[0]
-                    +'_'+'{:02}'.format(patch_idx) + '.png')
+    out_rel_paths = [image_prefix(args['ds_id'], args['img_path'])
+                    +'_'+'{:02}'.format(patch_idx) + '.png'
                     for patch_idx in range(args['num_patch'])]
     read_img = False
     for path in out_rel_paths:
@@ -74,6 +187,15 @@ def extract(args):
                 os.makedirs(out_fulldir, exist_ok=True)
             if not os.path.exists(out_fullpath):
                 io.imsave(out_fullpath, patch, check_contrast=False)
+    elif args['scored']:
+        return []
+    else:
+        # patches extracted before the manifest existed
+        patches = np.stack([io.imread(os.path.join(args['patch_dir'], path))
+                            for path in out_rel_paths])
+    scores = patch_scores(patches / 255.)
+    return [(path,) + tuple(float(s[i]) for s in scores)
+            for i, path in enumerate(out_rel_paths)]
 
 
 def patchify(img_path, extract_span): 
@@ -89,6 +211,19 @@ def patchify(img_path, extract_span):
     img = io.imread(img_path)
     if img is None or not isinstance(img, np.ndarray):
         raise Exception('Unable to read the image: {:}'.format(img_path))
+    return patchify_image(img, extract_span)
+
+
+def patchify_image(img, extract_span):
+    """
+    same as patchify, for an image that is already decoded.
+    Args:
+        img: full-sized RGB image, shape of [height, width, 3].
+        extract_span: size of the region of image to be extracted.
+    Return:
+        patches: patches of the green channel, shape of 
+                 [# vertical, # horizontal, 256, 256].
+    """
     center = np.divide(img.shape[:2], 2).astype(int)
     start = np.subtract(center, extract_span/2).astype(int)
     end = np.add(center, extract_span/2).astype(int)
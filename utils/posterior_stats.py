@@ -0,0 +1,118 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+from tensorboard.plugins.histogram import metadata as histogram_metadata
+
+# percentiles of the weight means, stddevs and SNR of each layer
+PERCENTILES = [1., 5., 25., 50., 75., 95., 99.]
+FIELDS = ['mean', 'stddev', 'snr']
+
+
+class PosteriorStats(object):
+    """
+    summary statistics of the kernel distributions of the flipout layers.
+    Fixed-width histograms and percentiles of the weight means, stddevs
+    and signal-to-noise ratios |mu|/sigma are computed in-graph, only the
+    summaries leave the device, not the millions of weights.
+    """
+    def __init__(self, num_bins=50, mean_range=(-1.5, 1.5),
+                 stddev_range=(0., 1.), snr_range=(0., 10.)):
+        """
+        Args:
+            num_bins: number of bins of the histograms.
+            mean_range, stddev_range, snr_range: range of the histograms,
+                values outside the range are counted in the first/last bin.
+        """
+        self.num_bins = num_bins
+        self.ranges = {'mean': mean_range,
+                       'stddev': stddev_range,
+                       'snr': snr_range}
+
+    @tf.function(experimental_relax_shapes=True)
+    def summarize(self, mean, stddev):
+        """
+        Args:
+            mean, stddev: flattened means and stddevs of a kernel.
+        Return:
+            stats: dict of histogram counts, percentiles and moments of each field.
+        """
+        snr = tf.abs(mean) / (stddev + np.finfo(np.float32).eps)
+        stats = {}
+        for field, values in zip(FIELDS, [mean, stddev, snr]):
+            stats[field + '/hist'] = tf.histogram_fixed_width(
+                                        values, self.ranges[field],
+                                        nbins=self.num_bins)
+            stats[field + '/percentiles'] = tfp.stats.percentile(
+                                        values, PERCENTILES,
+                                        interpolation='linear')
+            stats[field + '/mean'] = tf.reduce_mean(values)
+            stats[field + '/std'] = tf.math.reduce_std(values)
+        # fraction of the weights dominated by noise
+        stats['snr/below_1'] = tf.reduce_mean(tf.cast(snr < 1., tf.float32))
+        stats['num_weights'] = tf.size(mean)
+        return stats
+
+    def layer_stats(self, distribution):
+        """
+        statistics of a kernel distribution, e.g. kernel_posterior.
+        """
+        mean = tf.reshape(tf.cast(distribution.mean(), tf.float32), [-1])
+        stddev = tf.reshape(tf.cast(distribution.stddev(), tf.float32), [-1])
+        stddev = tf.broadcast_to(stddev, tf.shape(mean))
+        return {k: v.numpy() for k, v in self.summarize(mean, stddev).items()}
+
+    def model_stats(self, model):
+        """
+        statistics of the prior and posterior of each flipout layer.
+        Return:
+            stats: {layer name: {'prior': stats, 'posterior': stats}}.
+        """
+        stats = {}
+        for layer in model.layers:
+            if 'flipout' not in layer.name:
+                continue
+            stats[layer.name] = {
+                'prior': self.layer_stats(layer.kernel_prior),
+                'posterior': self.layer_stats(layer.kernel_posterior)}
+        return stats
+
+    def bin_edges(self, field):
+        return np.linspace(self.ranges[field][0], self.ranges[field][1],
+                           self.num_bins + 1)
+
+    def save(self, stats, fname):
+        """
+        save the statistics as a compressed npz file, the keys are
+        '<layer>/<prior|posterior>/<statistic>', e.g. 'dense1/posterior/snr/hist'.
+        """
+        arrays = {'percentiles': np.asarray(PERCENTILES)}
+        for field in FIELDS:
+            arrays[field + '/bin_edges'] = self.bin_edges(field)
+        for layer, dists in stats.items():
+            for dist, layer_stats in dists.items():
+                for k, v in layer_stats.items():
+                    arrays['/'.join([layer, dist, k])] = v
+        np.savez_compressed(fname, **arrays)
+
+    def log(self, stats, writer, step):
+        """
+        write the histograms and percentiles to tensorboard, the histograms
+        are written from the counts, the weights are not passed again.
+        """
+        with writer.as_default():
+            for layer, dists in stats.items():
+                for dist, layer_stats in dists.items():
+                    for field in FIELDS:
+                        tag = '/'.join([layer, dist, field])
+                        edges = self.bin_edges(field)
+                        buckets = np.stack([edges[:-1], edges[1:],
+                                            layer_stats[field + '/hist']], axis=1)
+                        tf.summary.write(tag,
+                                tf.constant(buckets, dtype=tf.float64), step=step,
+                                metadata=histogram_metadata.create_summary_metadata(
+                                            display_name=tag, description=''))
+                        for p, v in zip(PERCENTILES, layer_stats[field + '/percentiles']):
+                            tf.summary.scalar('{}/p{:g}'.format(tag, p), v, step=step)
+                    tf.summary.scalar('/'.join([layer, dist, 'snr/below_1']),
+                                      layer_stats['snr/below_1'], step=step)
+            writer.flush()
@@ -0,0 +1,124 @@
+import time
+import numpy as np
+import tensorflow as tf
+from contextlib import contextmanager
+from utils.misc import write_log
+
+# phases of a training step, and the phases that run once per epoch
+STEP_PHASES = ['wait', 'compute', 'summary']
+EPOCH_PHASES = ['validation', 'checkpoint']
+PERCENTILES = [50, 90, 99]
+
+
+class StepTimer(object):
+    """
+    wall time of the phases of the training steps: waiting for the input
+    pipeline (get_next), the train step on the device, writing the summaries,
+    as well as validation and checkpointing once per epoch.
+    """
+    def __init__(self, batch_size, enabled=True):
+        """
+        Args:
+            batch_size: number of patches per step, for the throughput.
+            enabled: if False, the phases are not timed and nothing is synced.
+        """
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.times = {p: [] for p in STEP_PHASES + EPOCH_PHASES}
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.times[name].append(time.perf_counter() - start)
+
+    def sync(self, tensor):
+        """
+        wait for the device, ops are dispatched asynchronously so the compute
+        time would otherwise be counted in the next phase.
+        """
+        if self.enabled:
+            tensor.numpy()
+
+    def epoch_stats(self):
+        """
+        Return:
+            stats: percentiles of the step phases in ms, the total time of
+                   the epoch phases in s, throughput in patches/s and the
+                   fraction of the step time waiting for input.
+        """
+        stats = {}
+        for p in STEP_PHASES:
+            if self.times[p]:
+                for q, v in zip(PERCENTILES, np.percentile(self.times[p], PERCENTILES)):
+                    stats['{}_p{}_ms'.format(p, q)] = 1000 * v
+        for p in EPOCH_PHASES:
+            stats[p + '_s'] = float(np.sum(self.times[p]))
+        step_time = sum(np.sum(self.times[p]) for p in STEP_PHASES)
+        if step_time > 0:
+            stats['patches_per_s'] = len(self.times['compute']) * self.batch_size / step_time
+            stats['input_stall'] = np.sum(self.times['wait']) / step_time
+        return stats
+
+    def log(self, log_file, writer, epoch, step):
+        """
+        write the statistics of the epoch to the log file and tensorboard,
+        and start the next epoch.
+        """
+        if not self.enabled:
+            return
+        stats = self.epoch_stats()
+        msg = "... Epoch {} step times (ms, p{}): ".format(
+                epoch, '/p'.join(str(q) for q in PERCENTILES))
+        msg += ", ".join("{} {}".format(p, '/'.join('{:.1f}'.format(
+                         stats['{}_p{}_ms'.format(p, q)]) for q in PERCENTILES))
+                         for p in STEP_PHASES if self.times[p])
+        msg += "; validation {:.1f} s, checkpoint {:.1f} s".format(
+                stats['validation_s'], stats['checkpoint_s'])
+        if 'patches_per_s' in stats:
+            msg += "; {:.1f} patches/s, input stall {:.1%}".format(
+                    stats['patches_per_s'], stats['input_stall'])
+        write_log(log_file, msg + "\n")
+        with writer.as_default():
+            for k, v in stats.items():
+                tf.summary.scalar('profile/' + k, v, step=step)
+            writer.flush()
+        self.reset()
+
+
+class TraceWindow(object):
+    """
+    capture a tf.profiler trace of the training steps [start, stop).
+    """
+    def __init__(self, log_dir, steps):
+        """
+        Args:
+            log_dir: directory of the trace, open it with tensorboard.
+            steps: [start, stop] global steps, or None for no trace.
+        """
+        self.log_dir = log_dir
+        self.start, self.stop = steps if steps is not None else (None, None)
+        self.active = False
+
+    def step(self, step_idx):
+        """
+        call before each training step.
+        """
+        if self.start is None:
+            return
+        if step_idx == self.start and not self.active:
+            tf.profiler.experimental.start(self.log_dir)
+            self.active = True
+        elif step_idx == self.stop and self.active:
+            self.close()
+
+    def close(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import atexit
+import resource
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# 'report' is the run report file, None disables the monitoring. The pools
+# are sized so that workers * worker memory fits into MemAvailable minus
+# the reserve, the worker memory is raised to the largest worker measured,
+# also by earlier runs writing the same report. During a stage, throttled_map
+# stops handing out tasks while MemAvailable is below the reserve plus one worker.
+settings = {'report': None, 'interval': 1., 'reserve_mb': 2048,
+            'worker_memory_mb': 512, 'max_workers': None}
+stages = []
+worker_memory = {}
+
+
+def configure(report, interval=1., reserve_mb=2048, worker_memory_mb=512,
+              max_workers=None):
+    """
+    Args:
+        report: json file of the run report, None disables the monitoring.
+        interval: sampling interval in seconds.
+        reserve_mb: memory left to the main process and the system.
+        worker_memory_mb: initial estimate of the memory of a pool worker.
+        max_workers: upper bound of the pool size, None for the cpu count.
+    """
+    settings.update(report=report, interval=interval, reserve_mb=reserve_mb,
+                    worker_memory_mb=worker_memory_mb, max_workers=max_workers)
+    # the largest workers of the earlier runs
+    for kind, mb in read_report().get('worker_memory_mb', {}).items():
+        worker_memory[kind] = max(worker_memory.get(kind, 0), mb)
+
+def configure_resources(params):
+    """
+    set the monitoring from the resources block of the parameters, the report
+    is written next to the log file, e.g. 'results/train_run_report.json'.
+    """
+    config = params.resources
+    report = None
+    if config.monitor:
+        report = os.path.splitext(params.log.log_file)[0] + '_run_report.json'
+    configure(report, config.interval, config.reserve_mb,
+              config.worker_memory_mb, config.max_workers)
+
+def read_proc(pid, name):
+    try:
+        with open('/proc/{}/{}'.format(pid, name)) as f:
+            return f.read()
+    except (IOError, OSError):
+        # the process exited or there is no procfs
+        return None
+
+def rss_mb(pid):
+    status = read_proc(pid, 'status')
+    if status is None:
+        return 0.
+    for line in status.splitlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) / 1024.
+    return 0.
+
+def num_fds(pid):
+    try:
+        return len(os.listdir('/proc/{}/fd'.format(pid)))
+    except OSError:
+        return 0
+
+def io_bytes():
+    """
+    bytes read from and written to disk by this process, including its
+    children that have exited.
+    """
+    stats = read_proc('self', 'io')
+    if stats is None:
+        return 0, 0
+    values = dict(line.split(': ') for line in stats.splitlines())
+    return int(values['read_bytes']), int(values['write_bytes'])
+
+def children(pid):
+    """
+    pids of all descendants of pid.
+    """
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        stat = read_proc(entry, 'stat')
+        if stat is None:
+            continue
+        # the command may contain spaces, the fields after it do not
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        parents.setdefault(ppid, []).append(int(entry))
+    descendants, pending = [], [pid]
+    while pending:
+        for child in parents.get(pending.pop(), []):
+            descendants.append(child)
+            pending.append(child)
+    return descendants
+
+def mem_available_mb():
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = f.read()
+    except (IOError, OSError):
+        return None
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) / 1024.
+    return None
+
+def worker_estimate_mb(kind):
+    return max(settings['worker_memory_mb'], worker_memory.get(kind, 0))
+
+def pool_size(kind):
+    """
+    number of pool workers that fit into the available memory when the
+    stage starts, see throttled_map for the tasks during the stage.
+    Args:
+        kind: kind of the stage, e.g. 'extract_patch', the largest worker
+               of its previous runs, in this process or in the report, is
+               used as the memory estimate.
+    """
+    workers = settings['max_workers'] or os.cpu_count()
+    available = mem_available_mb()
+    if available is not None:
+        fit = int((available - settings['reserve_mb']) // worker_estimate_mb(kind))
+        workers = max(1, min(workers, fit))
+    return workers
+
+def memory_low(kind):
+    available = mem_available_mb()
+    return (available is not None and
+            available - settings['reserve_mb'] < worker_estimate_mb(kind))
+
+def throttled_map(pool, workers, func, args_ls, kind):
+    """
+    pool.map(func, args_ls) handing out one task at a time, at most two per
+    worker are queued. While the available memory is below the reserve plus
+    one worker, e.g. because the images of the running tasks are larger than
+    estimated or another process grew, no task is handed out until the
+    oldest one finished.
+    Args:
+        pool, workers: the pool of the stage and its size.
+        kind: kind of the stage, see pool_size.
+    Return:
+        results: in the order of args_ls.
+    """
+    results, pending = [], deque()
+    for args in args_ls:
+        while pending and (len(pending) >= 2 * workers or memory_low(kind)):
+            pending.popleft().wait()
+        result = pool.apply_async(func, (args,))
+        results.append(result)
+        pending.append(result)
+    return [result.get() for result in results]
+
+
+class Sampler(threading.Thread):
+    """
+    sample the memory, the open files and the number of workers of this
+    process and its descendants.
+    """
+    def __init__(self, interval):
+        super(Sampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak_rss_mb = 0.
+        self.peak_worker_rss_mb = 0.
+        self.max_workers = 0
+        self.max_fds = 0
+
+    def sample(self):
+        pid = os.getpid()
+        workers = children(pid)
+        worker_rss = [rss_mb(p) for p in workers]
+        self.peak_rss_mb = max(self.peak_rss_mb, rss_mb(pid) + sum(worker_rss))
+        self.peak_worker_rss_mb = max([self.peak_worker_rss_mb] + worker_rss)
+        self.max_workers = max(self.max_workers, len(workers))
+        self.max_fds = max(self.max_fds, num_fds(pid) + sum(num_fds(p) for p in workers))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+@contextmanager
+def stage(name):
+    """
+    record the resources used while the block runs, does nothing if the
+    monitoring is disabled.
+    """
+    if settings['report'] is None:
+        yield
+        return
+    sampler = Sampler(settings['interval'])
+    sampler.sample()
+    read_start, write_start = io_bytes()
+    start = time.time()
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        read_end, write_end = io_bytes()
+        # e.g. 'extract_patch/train' updates the estimate of 'extract_patch'
+        kind = name.split('/')[0]
+        if sampler.peak_worker_rss_mb > 0:
+            worker_memory[kind] = max(worker_memory.get(kind, 0), sampler.peak_worker_rss_mb)
+        stages.append({
+            'stage': name,
+            'pid': os.getpid(),
+            'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)),
+            'duration_s': time.time() - start,
+            'peak_rss_mb': sampler.peak_rss_mb,
+            'peak_worker_rss_mb': sampler.peak_worker_rss_mb,
+            'max_workers': sampler.max_workers,
+            'max_open_files': sampler.max_fds,
+            'read_mb': (read_end - read_start) / 2**20,
+            'write_mb': (write_end - write_start) / 2**20,
+            # lifetime peaks, ru_maxrss is in KB on linux
+            'process_max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            'children_max_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.})
+        write_report()
+
+def read_report():
+    if settings['report'] is None or not os.path.exists(settings['report']):
+        return {}
+    try:
+        with open(settings['report']) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def write_report():
+    """
+    merge the stages of this process into the report, the stages of other
+    processes with the same log file, e.g. training and evaluation of the
+    pipeline, are kept.
+    """
+    if settings['report'] is None or not stages:
+        return
+    out_dir = os.path.dirname(settings['report'])
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    report = read_report()
+    merged = [s for s in report.get('stages', []) if s['pid'] != os.getpid()] + stages
+    memory = report.get('worker_memory_mb', {})
+    for kind, mb in worker_memory.items():
+        memory[kind] = max(memory.get(kind, 0), mb)
+    tmp_fname = '{}.{}.tmp'.format(settings['report'], os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump({'stages': merged, 'worker_memory_mb': memory,
+                   'settings': settings}, f, indent=4)
+    os.replace(tmp_fname, settings['report'])
+
+atexit.register(write_report)
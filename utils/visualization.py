@@ -1,11 +1,96 @@
+import os
+import atexit
+import pickle
+import multiprocessing
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-import tensorflow as tf
-import tikzplotlib
-import pandas as pd
-color_palette = sns.color_palette()
+from concurrent.futures import ProcessPoolExecutor
+# matplotlib, seaborn and pandas are imported when a figure is drawn, so
+# that saving the plot data stays cheap for the processes that only train
+# or run experiments.
 fz = 20
+# the plot data is saved next to the figure, e.g. 'roc.png.plot.pkl'
+PLOT_SUFFIX = '.plot.pkl'
+
+# 'sync' renders right away, 'background' in a process pool and 'lazy' only 
+# saves the plot data, to be rendered with plot.py.
+settings = {'mode': 'sync', 'png': True, 'tikz': True, 'workers': 2}
+executor = None
+futures = []
+
+def configure(mode, png=True, tikz=True, workers=2):
+    """
+    set how plots are rendered.
+    Args:
+        mode: 'sync', 'background' or 'lazy'.
+        png: whether to save the figures as PNG.
+        tikz: whether to save the figures as standalone TikZ (.tex).
+        workers: number of rendering processes in 'background' mode.
+    """
+    if mode not in ['sync', 'background', 'lazy']:
+        raise Exception("!!! Unknown plot mode: {}".format(mode))
+    settings.update(mode=mode, png=png, tikz=tikz, workers=workers)
+
+def configure_plotting(params):
+    """
+    set the rendering from the plot block of the parameters.
+    """
+    configure(params.plot.mode, params.plot.png, 
+              params.plot.tikz, params.plot.workers)
+
+def save_plot(kind, fname, **data):
+    """
+    save the plot data immediately and render it as configured.
+    Args:
+        kind: name of the renderer in RENDERERS.
+        fname: output file path of the figure.
+        data: arguments of the renderer.
+    """
+    global executor
+    out_dir = os.path.dirname(fname)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    data_file = fname + PLOT_SUFFIX
+    with open(data_file, 'wb') as f:
+        pickle.dump({'kind': kind, 'fname': fname, 'data': data}, f)
+    if settings['mode'] == 'sync':
+        render(data_file, settings['png'], settings['tikz'])
+    elif settings['mode'] == 'background':
+        if executor is None:
+            # rendering must not fork the (multi-threaded) tensorflow process
+            executor = ProcessPoolExecutor(settings['workers'],
+                            mp_context=multiprocessing.get_context('spawn'))
+        futures.append(executor.submit(render, data_file, 
+                                       settings['png'], settings['tikz']))
+    return data_file
+
+def render(data_file, png=True, tikz=True):
+    """
+    render the figure of a saved plot data file.
+    """
+    with open(data_file, 'rb') as f:
+        plot = pickle.load(f)
+    fig = RENDERERS[plot['kind']](**plot['data'])
+    # heatmaps are raster images, they are not exported to TikZ
+    save_figure(fig, plot['fname'], png, tikz and plot['kind'] not in RASTER_ONLY)
+    return plot['fname']
+
+def save_figure(fig, fname, png, tikz):
+    import matplotlib.pyplot as plt
+    if tikz:
+        import tikzplotlib
+        tikzplotlib.save(fname + ".tex", figure=fig, standalone=True)
+    if png:
+        fig.savefig(fname, bbox_inches='tight')
+    plt.close(fig)
+    print("image is saved to {}".format(fname))
+
+@atexit.register
+def wait():
+    """
+    wait for the plots rendered in the background.
+    """
+    while futures:
+        futures.pop(0).result()
 
 def histogram(data, labels, title, xlabel, fname):
     """
@@ -17,7 +102,14 @@ def histogram(data, labels, title, xlabel, fname):
         xlabel: x axis's label.
         fnmae: output file path.
     """
-    plt.figure(figsize=(20, 20))
+    save_plot('histogram', fname, data=[np.asarray(d) for d in data], 
+              labels=labels, title=title, xlabel=xlabel)
+
+def draw_histogram(data, labels, title, xlabel):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    color_palette = sns.color_palette()
+    fig = plt.figure(figsize=(20, 20))
     sns.set()
     for i, (d, l) in enumerate(zip(data, labels)):
         plt.hist(d, label=l, color=color_palette[i] ,bins=20, alpha=0.3)
@@ -27,9 +119,7 @@ def histogram(data, labels, title, xlabel, fname):
     plt.legend(loc=0, fontsize=fz)
     plt.tick_params(axis='both', which='minor', labelsize=fz)
     # plt.xlim(left=-0.0, right=1.05)
-    tikzplotlib.save(fname + ".tex", standalone=True)
-    plt.savefig(fname, bbox_inches='tight')
-    print("image is saved to {}".format(fname))
+    return fig
 
 def plot_curve(plotname,
             x_list, y_list, area_list,
@@ -48,6 +138,17 @@ def plot_curve(plotname,
         suptitle: subtitle for each subplot.
         fname: output file path.
     """
+    save_plot('curve', fname, plotname=plotname, x_list=x_list, y_list=y_list,
+              area_list=area_list, xlabel=xlabel, ylabel=ylabel, labels=labels,
+              suptitle=suptitle)
+
+def draw_curve(plotname,
+            x_list, y_list, area_list,
+            xlabel, ylabel, labels,
+            suptitle):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    color_palette = sns.color_palette()
     cols = len(plotname)
     rows = 1
     fig = plt.figure(figsize=(5*cols, 5*rows))
@@ -66,9 +167,7 @@ def plot_curve(plotname,
                 ax.set_ylabel(ylabel, fontsize=15)
     ax.grid(True)
     fig.suptitle(suptitle)
-    tikzplotlib.save(fname + ".tex", standalone=True)
-    fig.savefig(fname, bbox_inches='tight')
-    print("image is saved to {}".format(fname))
+    return fig
 
 def plot_weight_posteriors(names, qm_vals, qs_vals, fname):
     """
@@ -83,13 +182,20 @@ def plot_weight_posteriors(names, qm_vals, qs_vals, fname):
                 posterior standard deviations of weight varibles.
         fname: Python `str` filename to save the plot to.
     """
+    save_plot('weight_posteriors', fname, names=list(names), 
+              qm_vals=[np.asarray(qm).ravel() for qm in qm_vals],
+              qs_vals=[np.asarray(qs).ravel() for qs in qs_vals])
+
+def draw_weight_posteriors(names, qm_vals, qs_vals):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     fig = plt.figure(figsize=(12, 6))
     sns.set()
 
     ax = fig.add_subplot(1, 2, 1)
     for c, (n, qm) in enumerate(zip(names, qm_vals)):
-        sns.distplot(tf.reshape(qm, shape=[-1]), ax=ax, label=n)
-        # sns.histplot(tf.reshape(qm, shape=[-1]), color=color_palette[c], ax=ax, label=n, 
+        sns.distplot(qm, ax=ax, label=n)
+        # sns.histplot(qm, color=color_palette[c], ax=ax, label=n, 
         #                         stat="density", kde=True, binrange=(0, 0.1))
     ax.set_title('weight means')
     ax.set_xlim([-1.5, 1.5])
@@ -97,16 +203,14 @@ def plot_weight_posteriors(names, qm_vals, qs_vals, fname):
 
     ax = fig.add_subplot(1, 2, 2)
     for c, (n, qs) in enumerate(zip(names, qs_vals)):
-        sns.distplot(tf.reshape(qs, shape=[-1]), ax=ax)
-        # sns.histplot(tf.reshape(qs, shape=[-1]), color=color_palette[c], ax=ax, label=n, 
+        sns.distplot(qs, ax=ax)
+        # sns.histplot(qs, color=color_palette[c], ax=ax, label=n, 
         #                         stat="density", kde=True, binrange=(0, 0.1))
     ax.set_title('weight stddevs')
     ax.set_xlim([0, 1.])
     fig.tight_layout()
     ax.grid(True)
-    tikzplotlib.save(fname + ".tex", standalone=True)
-    fig.savefig(fname, bbox_inches='tight')
-    print("image is saved to {}".format(fname))
+    return fig
 
 def decompose_uncertainties(p_hat):
     """
@@ -146,34 +250,79 @@ def plot_held_out(images, labels, brand_models, mc_softmax_prob, fname):
     entropy, epistemic = image_uncertainty(mc_softmax_prob)
     num_images = len(entropy)
     num_dis_imgs = num_images // 10
+    # only every 10th image is displayed
+    shown = np.arange(num_dis_imgs) * 10
+    save_plot('held_out', fname, images=np.asarray(images)[shown, :, :, 0],
+              brand_models=list(brand_models),
+              mc_softmax_prob=np.asarray(mc_softmax_prob)[:, shown, :],
+              entropy=entropy[shown], epistemic=epistemic[shown],
+              mean_entropy=np.mean(entropy), mean_epistemic=np.mean(epistemic))
+
+def draw_held_out(images, brand_models, mc_softmax_prob, entropy, epistemic,
+                  mean_entropy, mean_epistemic):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import pandas as pd
+    color_palette = sns.color_palette()
+    num_dis_imgs = len(images)
     num_classes = len(brand_models)
+    num_draws = mc_softmax_prob.shape[0]
     fig = plt.figure(figsize=(20, 3*num_dis_imgs))
     d2c = dict(zip(brand_models, color_palette))
     sns.set()
     for i in range(num_dis_imgs):
-        idx = i * 10
         ax = fig.add_subplot(num_dis_imgs, 3, 3*i + 1)
-        ax.imshow(images[idx, :, :, 0], interpolation='None', cmap='gray')
-        # ax.set_title(brand_models[np.argmax(labels.numpy()[idx])])
+        ax.imshow(images[i], interpolation='None', cmap='gray')
         ax.axis('off')
 
+        # the bars of all Monte Carlo samples in one call
         ax = fig.add_subplot(num_dis_imgs, 3, 3*i + 2)
-        for prob_sample in mc_softmax_prob:
-            sns.barplot(np.arange(num_classes), prob_sample[idx, :], alpha=0.1, ax=ax)
-            ax.set_ylim([0, 1])
-            ax.set_xticklabels(brand_models, fontdict={'fontsize':7})
-        ax.set_title("entropy: {:.3f}".format(entropy[idx]))
+        ax.bar(np.tile(np.arange(num_classes), num_draws), 
+               mc_softmax_prob[:, i, :].ravel(),
+               color=[color_palette[c % len(color_palette)] 
+                      for c in range(num_classes)] * num_draws,
+               alpha=0.1)
+        ax.set_ylim([0, 1])
+        ax.set_xticks(np.arange(num_classes))
+        ax.set_xticklabels(brand_models, fontdict={'fontsize':7})
+        ax.set_title("entropy: {:.3f}".format(entropy[i]))
 
         ax = fig.add_subplot(num_dis_imgs, 3, 3*i + 3)
-        df = pd.DataFrame(mc_softmax_prob[:,idx,:], columns=brand_models)
+        df = pd.DataFrame(mc_softmax_prob[:, i, :], columns=brand_models)
         ax = df.mean(axis=0).plot(kind='bar', color=map(d2c.get, df.columns), 
-                                    yerr=df.std(axis=0), rot=0, capsize=5)
+                                    yerr=df.std(axis=0), rot=0, capsize=5, ax=ax)
         ax.set_ylim([0, 1])
         ax.set_xticklabels(brand_models, fontdict={'fontsize': 8})
-        ax.set_title("entropy: {:.3f}".format(epistemic[idx]))
+        ax.set_title("entropy: {:.3f}".format(epistemic[i]))
 
     fig.suptitle('Held-out nats: {:.3f}\n'
-                'mean epistemic uncertainty: {:.3f}'.format(np.mean(entropy), np.mean(epistemic), y=1.1))
+                'mean epistemic uncertainty: {:.3f}'.format(mean_entropy, mean_epistemic))
     fig.tight_layout()
-    tikzplotlib.save(fname + ".tex", standalone=True)
-    fig.savefig(fname, bbox_inches='tight')
\ No newline at end of file
+    return fig
+
+def plot_heatmap(heatmap, title, fname):
+    """
+    plot a heatmap over the tile grid of a full-sized image.
+    Args:
+        heatmap: 2D array, one value per tile.
+        title: title of the heatmap.
+        fname: output file path.
+    """
+    save_plot('heatmap', fname, heatmap=np.asarray(heatmap), title=title)
+
+def draw_heatmap(heatmap, title):
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(10, 10 * heatmap.shape[0] / heatmap.shape[1]))
+    ax = fig.add_subplot(1, 1, 1)
+    im = ax.imshow(heatmap, interpolation='nearest', cmap='viridis')
+    fig.colorbar(im, ax=ax)
+    ax.set_title(title, fontsize=fz)
+    ax.axis('off')
+    return fig
+
+RENDERERS = {'histogram': draw_histogram,
+             'curve': draw_curve,
+             'weight_posteriors': draw_weight_posteriors,
+             'held_out': draw_held_out,
+             'heatmap': draw_heatmap}
+RASTER_ONLY = ['heatmap']